@@ -9,4 +9,9 @@ Please take a moment to read LICENSE.txt. It's short.
 __author__ = "Ryan McGuire (ryan@enigmacurry.com)"
 __version__ = '0.8-DEV'
 
-from .site_init import zip_site_init
+
+def zip_site_init():
+    """Zip up the site_init templates, see site_init.zip_site_init
+    """
+    from .site_init import zip_site_init
+    zip_site_init()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Markdown filter.
+
+Setting up a Markdown instance (and its extensions) costs more than
+converting a short post, so each thread keeps one and resets it between
+documents.
+
+Extensions are enabled in _config.py, e.g.:
+
+  filters.markdown.extensions.def_list.enabled = True
+
+or given as a list of names:
+
+  filters.markdown.extensions = ["def_list", "tables"]
+"""
+import threading
+try:
+    import markdown
+except ImportError:
+    markdown = None
+
+from blogofile.cache import HierarchicalCache as HC
+
+config = HC(
+    name="Markdown",
+    description="Convert Markdown to HTML",
+    author="Ryan McGuire",
+    url="http://www.blogofile.com",
+    thread_safe=True,
+    pure=True,
+    # Their versions are part of the filter cache key:
+    packages=["Markdown"],
+    # Markdown extensions to load, and their settings:
+    extensions=HC(),
+    extension_configs={},
+    output_format="xhtml",
+    )
+
+# The Markdown instance of each thread:
+_local = threading.local()
+
+# Extensions that Markdown 3 removed -> what replaces them, or None when
+# what they did is built in now:
+removed_extensions = {"headerid": "toc", "smart_strong": None}
+
+
+def init():
+    if markdown is None:
+        raise ImportError("The markdown filter needs the Markdown package")
+
+
+def __extension_name(name):
+    """The name to load an extension by, or None to skip it.
+    """
+    version = getattr(markdown, "__version_info__", (2,))
+    if version[0] >= 3 and name in removed_extensions:
+        return removed_extensions[name]
+    return name
+
+
+def enabled_extensions():
+    """Return the names of the Markdown extensions to load, and their
+    settings: (names, {name: settings})
+    """
+    if isinstance(config.extensions, dict):
+        wanted = sorted(name for name, ext in config.extensions.items()
+                        if isinstance(ext, dict) and ext.get("enabled"))
+    else:
+        wanted = list(config.extensions)
+    names = []
+    for name in wanted:
+        name = __extension_name(name)
+        if name is not None and name not in names:
+            names.append(name)
+    configs = {}
+    for name, settings in config.extension_configs.items():
+        name = __extension_name(name)
+        if name in names:
+            configs[name] = dict(settings)
+    return names, configs
+
+
+def get_markdown():
+    """Return the Markdown instance of this thread.
+    """
+    md = getattr(_local, "markdown", None)
+    if md is None:
+        extensions, extension_configs = enabled_extensions()
+        md = _local.markdown = markdown.Markdown(
+            extensions=extensions, extension_configs=extension_configs,
+            output_format=config.output_format)
+    return md
+
+
+def run(content):
+    md = get_markdown()
+    try:
+        return md.convert(content)
+    finally:
+        md.reset()
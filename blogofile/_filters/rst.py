@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""reStructuredText filter.
+
+docutils builds its settings from the option parsers of every component,
+for every document, unless it's handed them. They are built once here,
+and each document gets a copy. Each thread keeps its own HTML writer.
+"""
+import copy
+import threading
+try:
+    import docutils.core
+    import docutils.frontend
+    import docutils.parsers.rst
+    import docutils.writers
+except ImportError:
+    docutils = None
+
+from blogofile.cache import HierarchicalCache as HC
+
+config = HC(
+    name="reStructuredText",
+    description="Convert reStructuredText to HTML",
+    author="Ryan McGuire",
+    url="http://www.blogofile.com",
+    thread_safe=True,
+    pure=True,
+    # Their versions are part of the filter cache key:
+    packages=["docutils"],
+    # The docutils writer, and which part of its output to use:
+    writer="html",
+    part="html_body",
+    # Overrides of the docutils settings:
+    settings_overrides={},
+    )
+
+_lock = threading.Lock()
+_settings = None
+# The writer of each thread:
+_local = threading.local()
+
+
+def init():
+    if docutils is None:
+        raise ImportError("The rst filter needs the docutils package")
+
+
+def get_settings():
+    """Return the docutils settings for a document.
+    """
+    global _settings
+    with _lock:
+        if _settings is None:
+            components = (docutils.parsers.rst.Parser,
+                          docutils.writers.get_writer_class(config.writer))
+            try:
+                settings = docutils.frontend.get_default_settings(
+                    *components)
+            except AttributeError:
+                # docutils < 0.19
+                settings = docutils.frontend.OptionParser(
+                    components=components).get_default_values()
+            settings._update_loose(dict(config.settings_overrides))
+            _settings = settings
+    # Publishing a document changes some of its settings:
+    return copy.copy(_settings)
+
+
+def get_writer():
+    """Return the docutils writer of this thread.
+    """
+    writer = getattr(_local, "writer", None)
+    if writer is None:
+        writer = _local.writer = \
+            docutils.writers.get_writer_class(config.writer)()
+    return writer
+
+
+def run(content):
+    parts = docutils.core.publish_parts(
+        content, writer=get_writer(), settings=get_settings())
+    return parts[config.part]
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Syntax highlighting filter, using Pygments.
+
+Highlights blocks of code like:
+
+    $$code(lang=python, linenums=True)
+    print("Hello")
+    $$/code
+
+Arguments are lang (or language), linenums (or linenos), style and
+css_class. Lexers and formatters are made once and reused, and the
+output for each block is memoized by a digest of its language, options
+and code, so blocks that show up again (or posts built again) aren't
+highlighted again.
+"""
+import collections
+import hashlib
+import re
+import threading
+try:
+    import pygments
+    import pygments.formatters
+    import pygments.lexers
+    import pygments.util
+except ImportError:
+    pygments = None
+
+from blogofile.cache import HierarchicalCache as HC
+
+config = HC(
+    name="Syntax Highlighter",
+    description="Highlights blocks of code based on syntax",
+    author="Ryan McGuire",
+    url="http://www.blogofile.com",
+    thread_safe=True,
+    pure=True,
+    # Their versions are part of the filter cache key:
+    packages=["Pygments"],
+    style="murphy",
+    css_class="pygments_murphy",
+    # How many highlighted blocks to remember:
+    memo_size=1024,
+    )
+
+code_block_regex = re.compile(
+    r"(?:^|\s)"                 # $$code must start as a new word
+    r"\$\$code"                 # $$code is the start of the block
+    r"(?P<args>\([^\r\n]*\))?"  # optional arguments are passed in brackets
+    r"[^\r\n]*\r?\n"            # ignore everything else on the 1st line
+    r"(?P<code>.*?)\s*\r?\n"    # code can be anything (non-greedy)
+    r"\$\$/code"                # $$/code ends the block
+    r"(?:$|\s)",                # $$/code must end a word
+    re.DOTALL)
+
+argument_regex = re.compile(
+    r"\s*(?P<name>\w+)\s*=\s*"
+    r"""(?P<value>"[^"]*"|'[^']*'|[^,]*?)\s*(?:,|$)""")
+
+_lock = threading.Lock()
+# Lexers by language, and formatters by (linenums, style, css_class):
+_lexers = {}
+_formatters = {}
+# Highlighted code, by digest:
+_memo = collections.OrderedDict()
+
+
+def init():
+    if pygments is None:
+        raise ImportError("The syntax_highlight filter needs Pygments")
+
+
+def parse_args(args):
+    """Parse the arguments of a $$code block, like "(lang=python)".
+    """
+    parsed = {}
+    if args:
+        for m in argument_regex.finditer(args.strip()[1:-1]):
+            value = m.group("value")
+            if value[:1] in ("'", '"'):
+                value = value[1:-1]
+            parsed[m.group("name")] = value
+    return parsed
+
+
+def get_lexer(language):
+    with _lock:
+        lexer = _lexers.get(language)
+        if lexer is None:
+            try:
+                lexer = pygments.lexers.get_lexer_by_name(language)
+            except pygments.util.ClassNotFound:
+                lexer = pygments.lexers.get_lexer_by_name("text")
+            _lexers[language] = lexer
+        return lexer
+
+
+def get_formatter(linenums, style, css_class):
+    key = (linenums, style, css_class)
+    with _lock:
+        formatter = _formatters.get(key)
+        if formatter is None:
+            formatter = _formatters[key] = pygments.formatters.HtmlFormatter(
+                linenos=linenums, style=style, cssclass=css_class)
+        return formatter
+
+
+def highlight(code, language, linenums, style, css_class):
+    """Return code highlighted as HTML, memoized.
+    """
+    h = hashlib.sha1()
+    for part in (language, str(linenums), style, css_class, code):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    key = h.hexdigest()
+    with _lock:
+        if key in _memo:
+            html = _memo.pop(key)
+            _memo[key] = html
+            return html
+    html = pygments.highlight(code, get_lexer(language),
+                              get_formatter(linenums, style, css_class))
+    with _lock:
+        _memo[key] = html
+        while len(_memo) > config.memo_size:
+            _memo.popitem(last=False)
+    return html
+
+
+def run(content):
+    def substitute(m):
+        args = parse_args(m.group("args"))
+        language = args.get("lang", args.get("language", "text"))
+        linenums = args.get("linenums", args.get("linenos", "false"))
+        html = highlight(m.group("code"), language,
+                         linenums.strip().lower() == "true",
+                         args.get("style", config.style),
+                         args.get("css_class", config.css_class))
+        # Keep the whitespace around the block:
+        block = m.group()
+        return block[:len(block) - len(block.lstrip())] + html + \
+            block[len(block.rstrip()):]
+    return code_block_regex.sub(substitute, content)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""A private cache of compiled filters and controllers.
+
+The modules in _filters and _controllers are imported with
+sys.dont_write_bytecode set, so that no .pyc files end up in the site's
+source. Instead, their code objects are kept in site.bytecode_cache_dir
+(.blogofile-cache/pyc by default): each entry is named by a digest of
+the source path (and the Python bytecode version), followed by a digest
+of the source itself, so a changed source is compiled again and its old
+entry is removed.
+
+Only the module itself (or a package's __init__.py) is cached; modules
+that it imports are imported the usual way.
+"""
+
+__author__ = "Ryan McGuire (ryan@enigmacurry.com)"
+
+import hashlib
+import logging
+import marshal
+import os
+import sys
+import tempfile
+import types
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:
+    # Python < 3.4
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
+
+from .cache import bf
+from . import util
+
+
+logger = logging.getLogger("blogofile.bytecode_cache")
+
+
+def get_cache_dir():
+    """Return the bytecode cache directory, or None if
+    site.bytecode_cache_dir is turned off.
+    """
+    return bf.config.site.bytecode_cache_dir or None
+
+
+def source_file(path):
+    """Return the source file of a module: path itself, or the
+    __init__.py of a package directory.
+    """
+    if os.path.isdir(path):
+        return os.path.join(path, "__init__.py")
+    return path
+
+
+def __entry_prefix(path):
+    h = hashlib.sha1(MAGIC_NUMBER)
+    h.update(os.path.abspath(path).encode("utf-8"))
+    return h.hexdigest() + "-"
+
+
+def compile_source(path, cache_dir=None):
+    """Return the code object of the source file at path, from the cache
+    in cache_dir if it's there and the source didn't change.
+    """
+    with open(path, "rb") as f:
+        source = f.read()
+    if not cache_dir:
+        return compile(source, path, "exec", dont_inherit=True)
+    prefix = __entry_prefix(path)
+    entry = os.path.join(
+        cache_dir, prefix + hashlib.sha1(source).hexdigest() + ".pyc")
+    try:
+        with open(entry, "rb") as f:
+            return marshal.loads(f.read())
+    except (IOError, OSError):
+        pass
+    except (EOFError, ValueError, TypeError):
+        logger.debug("Ignoring bad bytecode cache entry: " + entry)
+    code = compile(source, path, "exec", dont_inherit=True)
+    try:
+        util.mkdir(cache_dir)
+        # Remove the entries of previous versions of the source:
+        for fn in os.listdir(cache_dir):
+            if fn.startswith(prefix):
+                os.remove(os.path.join(cache_dir, fn))
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(marshal.dumps(code))
+        util.replace_file(tmp_path, entry)
+    except (IOError, OSError) as e:
+        # It just gets compiled again next time.
+        logger.warn("Cannot cache bytecode of {0}: {1}".format(path, e))
+    return code
+
+
+def load_module(name, path, cache_dir=None):
+    """Import the module at path (a .py file, or a package directory)
+    as name, compiling it through the cache in cache_dir.
+    """
+    filename = source_file(path)
+    mod = types.ModuleType(name)
+    mod.__file__ = filename
+    if filename != path:
+        mod.__path__ = [path]
+        mod.__package__ = name
+    code = compile_source(filename, cache_dir)
+    sys.modules[name] = mod
+    try:
+        exec(code, mod.__dict__)
+    except:
+        del sys.modules[name]
+        raise
+    # The module may have replaced itself in sys.modules:
+    return sys.modules[name]
@@ -96,6 +96,26 @@ class HierarchicalCache(Cache):
         finally:
             Cache.__setitem__(c, key, item)
 
+
+def merge_settings(config, settings):
+    """Merge settings (e.g. made in _config.py before a filter,
+    controller or plugin was loaded) over its config.
+
+    Nested HierarchicalCaches are merged too. Empty ones were only
+    ever read, not set, so they don't replace anything.
+    """
+    for k, v in settings.items():
+        if v is config.get(k):
+            continue
+        if isinstance(v, HierarchicalCache):
+            if not v:
+                continue
+            if isinstance(config.get(k), HierarchicalCache):
+                merge_settings(config[k], v)
+                continue
+        config[k] = v
+
+
 #The main blogofile cache object, transfers state between templates
 bf = HierarchicalCache()
 
@@ -113,13 +133,17 @@ def reset_bf(assign_modules=True):
     setup_bf()
 
     if assign_modules:
-        from . import config, util, server, filter, controller, template
+        from . import config, util, filter, controller, template
+        from . import event_loop
         bf.config = config
         bf.util = util
-        bf.server = server
+        if "blogofile.server" in sys.modules:
+            # Not imported until it's needed, it's the whole HTTP server:
+            bf.server = sys.modules["blogofile.server"]
         bf.filter = filter
         bf.controller = controller
         bf.template = template
+        bf.event_loop = event_loop
     return bf
 
 setup_bf()
@@ -10,11 +10,10 @@ import logging
 import sys
 import re
 
-import blogofile_bf as bf
 from . import cache
+import blogofile_bf as bf
 from . import controller
 from . import plugin
-from . import site_init
 from . import filter as _filter
 from .cache import HierarchicalCache as HC
 
@@ -49,7 +48,7 @@ reset_config()
 
 
 def default_config_path():
-    return os.path.join(os.path.split(site_init.__file__)[0], "_config.py")
+    return os.path.join(os.path.dirname(__file__), "site_init", "_config.py")
 
 with open(default_config_path()) as dc:
     default_config = dc.read()
@@ -75,14 +74,17 @@ def __load_config(path=None):
     Strategy:
 
       1) Load the default config
-      2) Load the plugins
-      3) Load the site filters and controllers
-      4) Load the user's config.
+      2) Register the built-in filters
+      3) Discover the plugins
+      4) Register the site filters and controllers
+      5) Load the user's config.
+      6) Load the plugins it enables.
 
     This will ensure that we have good default values if the user's
     config is missing something.
     """
     exec(default_config)
+    _filter.preload_builtin_filters()
     plugin.load_plugins()
     _filter.preload_filters()
     controller.load_controllers(namespace=bf.config.controllers)
@@ -102,6 +104,13 @@ def __load_config(path=None):
             cache_object[setting] = v
         else:
             globals()[k] = v
+    # Names bound to a plugin's stub in _config.py, e.g.
+    # blog = plugins.blog or post = plugins.blog.post, now refer to the
+    # plugin's config:
+    for stub, plugin_config in plugin.load_enabled_plugins():
+        for k, v in list(globals().items()):
+            if v is stub:
+                globals()[k] = plugin_config
     recompile()
 
 
@@ -7,7 +7,9 @@ and can generate content for a site.
 Controllers can either be standalone .py files, or they can be modules.
 
 Every controller has a contract to provide the following:
- * a run() method, which accepts no arguments.
+ * a run() method, which accepts no arguments. It (and the optional
+   init() method) can also be a coroutine function, run on the shared
+   event loop, see blogofile.event_loop.
  * A dictionary called "config" containing the following information:
    * name - The human friendly name for the controller.
    * author - The name or group responsible for writing the controller.
@@ -47,15 +49,84 @@ Users can configure a controller in _config.py:
 
 Settings set in _config.py always override any default configuration
 for the controller.
+
+Controllers are only imported once they're enabled and about to run,
+so a disabled controller costs nothing but a directory listing (and
+parsing its module once, to find out whether its own config enables
+it.)
+
+Controllers can also declare, in their config, how they relate to the
+others:
+
+ * after        - names of the controllers that must run before this one.
+ * before       - names of the controllers that must run after this one.
+ * outputs      - paths (or glob patterns) in _site that it writes.
+                  Controllers whose outputs overlap never run at the same
+                  time; the one with the higher priority goes first.
+ * thread_safe  - run() can run in a thread, alongside other controllers.
+                  Rendering templates still happens one at a time.
+ * process_safe - run() can run in a worker process: it only writes files,
+                  nothing later in the build needs the state it sets up.
+
+Controllers that declare neither after nor before run one after the
+other in priority order, as always, whatever else they declare. The
+others run as soon as the controllers they depend on are done,
+concurrently where they allow it.
+
+On incremental builds, a controller that declares what it reads, and
+that nothing else in the build reads what it sets up, is skipped when
+none of it changed since the last build, and its previous outputs are
+kept:
+
+ * inputs       - glob patterns of the source files it reads, e.g.
+                  ["_photos/**/*.jpg"].
+ * config_keys  - dotted names of the settings it uses besides its own,
+                  e.g. ["site.url", "blog.path"].
+ * outputs_only - run() only writes files: templates and other
+                  controllers don't read any state it sets up (like the
+                  blog's list of posts in bf.config.) process_safe
+                  controllers promise as much already.
+
+A skipped controller doesn't set anything up, so controllers without
+outputs_only (or process_safe) always run.
+
+Its own settings and module are always part of its inputs. Controllers
+that a running controller declares it depends on are never skipped. To
+run a controller anyway, build with --force-controller NAME.
+
+Files that controllers write into _site themselves, without
+bf.writer.add_output, are found by comparing _site before and after
+they run. When _site is kept from the previous build (incremental
+builds, site.write_if_changed, the "sync" output mode), those files
+are removed before the controllers run again, so they can write them as
+if _site was empty. A skipped controller keeps the ones that match its
+declared outputs.
 """
 from __future__ import print_function
+import ast
 import sys
 import os
+import fnmatch
+import glob
+import hashlib
 import operator
 import logging
-import imp
+import threading
+try:
+    from concurrent import futures
+except ImportError:
+    # Python < 3.2
+    futures = None
 
 from .cache import bf
+from .cache import HierarchicalCache
+from .cache import merge_settings
+from . import bytecode_cache
+from . import event_loop
+from . import exception
+from . import filter as _filter
+from . import manifest
+from . import util
 
 
 bf.controller = sys.modules['blogofile.controller']
@@ -65,30 +136,195 @@ logger = logging.getLogger("blogofile.controller")
 default_controller_config = {"priority": 50.0,
                              "enabled": False}
 
+# Config keys that put a controller in the dependency graph:
+declarations = ("after", "before", "outputs", "thread_safe", "process_safe")
 
-def __find_controller_names(directory="_controllers"):
-    if(not os.path.isdir(directory)):
-        return
+
+# The controllers found in each directory:
+# absolute directory path -> (directory mtime, {name: (path, mtime)})
+_index = {}
+_index_lock = threading.Lock()
+# The "enabled" setting each controller module's config declares:
+# path -> (mtime, True, False, None if it doesn't, or _unknown)
+_enabled_index = {}
+# A controller whose "enabled" setting is only known once it's imported:
+_unknown = object()
+
+
+def discover_controllers(directory="_controllers"):
+    """Return the controllers in directory: {name: (path, mtime)}
+
+    The path is a standalone .py file or a module directory. Directories
+    are only listed again when their mtime changes.
+    """
+    try:
+        dir_mtime = os.stat(directory).st_mtime
+    except OSError:
+        return {}
+    key = os.path.abspath(directory)
+    with _index_lock:
+        if key in _index and _index[key][0] == dir_mtime:
+            return dict(_index[key][1])
+    controllers = {}
     # Find all the standalone .py files and modules in the _controllers dir
     for fn in os.listdir(directory):
         p = os.path.join(directory, fn)
         if os.path.isfile(p):
             if fn.endswith(".py"):
-                yield fn[:-3]
+                controllers[fn[:-3]] = (p, os.stat(p).st_mtime)
         elif os.path.isdir(p):
-            if os.path.isfile(os.path.join(p, "__init__.py")):
-                yield fn
+            init = os.path.join(p, "__init__.py")
+            if os.path.isfile(init):
+                controllers[fn] = (p, os.stat(init).st_mtime)
+    with _index_lock:
+        _index[key] = (dir_mtime, controllers)
+    return dict(controllers)
+
+
+def register_controller(name, namespace, path, defaults={}):
+    """Register a controller to be loaded from path when it's about to
+    run.
+
+    defaults are applied when it's loaded, like those of
+    load_controller, but an "enabled" default counts right away.
+    """
+    if name not in namespace or "mod" in namespace[name]:
+        namespace[name] = HierarchicalCache()
+    namespace[name].module_path = path
+    namespace[name].module_defaults = dict(defaults)
+
+
+def is_pending(controller):
+    """Is this a controller that is registered, but not loaded yet?
+    """
+    return "module_path" in controller and "mod" not in controller
+
+
+def __literal(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return _unknown
+
+
+def __config_enabled(tree):
+    """The "enabled" setting the config of a parsed controller module
+    declares.
+    """
+    enabled = None
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name) and target.id == "config":
+                value = node.value
+                if isinstance(value, ast.Dict):
+                    enabled = None
+                    for k, v in zip(value.keys, value.values):
+                        key = __literal(k) if k is not None else _unknown
+                        if key is _unknown:
+                            enabled = _unknown
+                        elif key == "enabled":
+                            enabled = __literal(v)
+                elif isinstance(value, ast.Call) and not value.args:
+                    # config = HierarchicalCache(...) or dict(...)
+                    enabled = None
+                    for keyword in value.keywords:
+                        if keyword.arg is None:
+                            enabled = _unknown
+                        elif keyword.arg == "enabled":
+                            enabled = __literal(keyword.value)
+                else:
+                    enabled = _unknown
+            elif isinstance(target, ast.Attribute) and \
+                    isinstance(target.value, ast.Name) and \
+                    target.value.id == "config" and target.attr == "enabled":
+                enabled = __literal(node.value)
+            elif isinstance(target, ast.Subscript) and \
+                    isinstance(target.value, ast.Name) and \
+                    target.value.id == "config":
+                key = target.slice
+                if isinstance(key, getattr(ast, "Index", ())):
+                    # Python < 3.9
+                    key = key.value
+                key = __literal(key)
+                if key is _unknown:
+                    enabled = _unknown
+                elif key == "enabled":
+                    enabled = __literal(node.value)
+    return enabled
+
+
+def module_enabled(path):
+    """Return the "enabled" setting of the config of the controller at
+    path, without importing it: True, False, None if it doesn't set it,
+    or _unknown if only importing it would tell.
+
+    The module's source is parsed instead, once per modification.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "__init__.py")
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _index_lock:
+        if path in _enabled_index and _enabled_index[path][0] == mtime:
+            return _enabled_index[path][1]
+    try:
+        with open(path, "rb") as f:
+            enabled = __config_enabled(ast.parse(f.read(), path))
+    except SyntaxError:
+        # Importing it will report that
+        enabled = _unknown
+    if enabled is not None and enabled is not _unknown:
+        enabled = bool(enabled)
+    with _index_lock:
+        _enabled_index[path] = (mtime, enabled)
+    return enabled
+
+
+def is_enabled(controller):
+    """Is the controller enabled?
+
+    Settings made in _config.py come first, then the module's own
+    config, then the defaults it was registered with. A controller whose
+    module only tells once imported counts as enabled: loading it tells.
+    """
+    if "enabled" in controller:
+        return bool(controller.enabled)
+    if is_pending(controller):
+        enabled = module_enabled(controller.module_path)
+        if enabled is _unknown:
+            return True
+        if enabled is not None:
+            return enabled
+    return bool(controller.get("module_defaults", {}).get("enabled"))
+
+
+def load_pending_controllers(namespace, only_enabled=True):
+    """Load the registered controllers that aren't loaded yet, only the
+    enabled ones unless only_enabled is False.
+    """
+    for name, c in list(namespace.items()):
+        if is_pending(c) and (is_enabled(c) or not only_enabled):
+            path = c.module_path
+            load_controller(name, namespace, os.path.dirname(path),
+                            c.module_defaults)
 
 
 def init_controllers(namespace):
     """Controllers have an optional init method that runs before the run
     method"""
+    load_pending_controllers(namespace)
     # Prune the configured controllers to only those that have a
-    # discoverable implementation:
+    # discoverable implementation, and were imported:
     actual_controllers = {}
     for name, controller in namespace.items():
         if "mod" in controller and type(controller.mod).__name__ == "module":
             actual_controllers[name] = controller
+        elif is_pending(controller):
+            continue
         elif "enabled" in controller and controller.enabled:
             # Throw a fatal error if an enabled controller is unimplemented
             print("Cannot find requested controller: {0}".format(name))
@@ -104,16 +340,20 @@ def init_controllers(namespace):
                 controller.mod.__initialized = True
                 continue
             else:
-                init_method()
+                event_loop.call(init_method)
 
 
 def load_controller(name, namespace, directory="_controllers", defaults={},
                     is_plugin=False):
     """Load a single controller by name.
+
+    If the controller was registered, the settings made for it in the
+    meantime are kept, and override the controller's own config.
     """
     logger.debug("loading controller: {0}"
                  .format(bf.util.path_join(directory, name)))
-    # Don't generate pyc files in the _controllers directory
+    # Don't generate pyc files in the _controllers directory, they're
+    # kept in the bytecode cache instead:
     try:
         initial_dont_write_bytecode = sys.dont_write_bytecode
     except KeyError:
@@ -121,8 +361,13 @@ def load_controller(name, namespace, directory="_controllers", defaults={},
     try:
         try:
             sys.dont_write_bytecode = True
-            controller = imp.load_module(
-                name, *imp.find_module(name, [directory]))
+            path = os.path.join(directory, name)
+            if os.path.isfile(path + ".py"):
+                path += ".py"
+            elif not os.path.isfile(os.path.join(path, "__init__.py")):
+                raise ImportError("No module named " + name)
+            controller = bytecode_cache.load_module(
+                name, path, bytecode_cache.get_cache_dir())
             controller.__initialized = False
             logger.debug("found controller: {0} - {1}"
                          .format(name, controller))
@@ -130,6 +375,11 @@ def load_controller(name, namespace, directory="_controllers", defaults={},
             logger.error(
                 "Cannot import controller : {0} ({1})".format(name, e))
             raise
+        settings = {}
+        if name in namespace and is_pending(namespace[name]):
+            settings = dict(namespace[name])
+            del settings["module_defaults"]
+            del namespace[name]["module_defaults"]
         # Remember the actual imported module
         namespace[name].mod = controller
         # Load the blogofile defaults for controllers:
@@ -161,6 +411,7 @@ def load_controller(name, namespace, directory="_controllers", defaults={},
                         namespace[name][k] = v
             except AttributeError:
                 pass
+        merge_settings(namespace[name], settings)
         # Provide every controller with a logger:
         c_logger = logging.getLogger("blogofile.controllers." + name)
         namespace[name]["logger"] = c_logger
@@ -172,10 +423,14 @@ def load_controller(name, namespace, directory="_controllers", defaults={},
 
 def load_controllers(namespace, directory="_controllers", defaults={}):
     """Find all the controllers in the _controllers directory and
-    import them into the bf context.
+    register them in the bf context.
+
+    They are only imported when they're about to run, see
+    load_pending_controllers.
     """
-    for name in __find_controller_names(directory):
-        load_controller(name, namespace, directory, defaults)
+    controllers = discover_controllers(directory)
+    for name, (path, mtime) in sorted(controllers.items()):
+        register_controller(name, namespace, path, defaults)
 
 
 def defined_controllers(namespaces, only_enabled=True):
@@ -203,6 +458,7 @@ def defined_controllers(namespaces, only_enabled=True):
     """
     controllers = []
     for namespace in namespaces:
+        load_pending_controllers(namespace.controllers, only_enabled)
         for c in list(namespace.controllers.values()):
             # Get only the ones that are enabled:
             if "enabled" not in c or c['enabled'] == False:
@@ -216,17 +472,351 @@ def defined_controllers(namespaces, only_enabled=True):
                               reverse=True)]
 
 
+def is_declared(controller):
+    """Does the controller declare its dependencies or capabilities?
+    """
+    return any(k in controller for k in declarations)
+
+
+def is_ordered(controller):
+    """Does the controller declare which controllers it runs after or
+    before, instead of following priority order?
+    """
+    return "after" in controller or "before" in controller
+
+
+def is_outputs_only(controller):
+    """Does the controller only write files, setting up no state that
+    the rest of the build reads?
+    """
+    return bool(controller.get("outputs_only") or
+                controller.get("process_safe"))
+
+
+def __names(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def __outputs_overlap(c1, c2):
+    for o1 in __names(c1.get("outputs")):
+        for o2 in __names(c2.get("outputs")):
+            if o1 == o2 or fnmatch.fnmatch(o1, o2) or fnmatch.fnmatch(o2, o1):
+                return True
+    return False
+
+
+def __waits_for(graph, i, j):
+    """Does controller i wait, directly or not, for controller j?
+    """
+    stack = [i]
+    seen = set()
+    while stack:
+        k = stack.pop()
+        if k == j:
+            return True
+        if k not in seen:
+            seen.add(k)
+            stack.extend(graph[k])
+    return False
+
+
+def dependency_graph(controllers):
+    """Return, for each of the (name, config) controllers (in priority
+    order), the set of indexes of the controllers it waits for.
+    """
+    by_name = {}
+    for i, (name, c) in enumerate(controllers):
+        by_name.setdefault(name, []).append(i)
+    graph = dict((i, set()) for i in range(len(controllers)))
+    previous = None
+    for i, (name, c) in enumerate(controllers):
+        if not is_ordered(c):
+            # Keep the priority order of the others:
+            if previous is not None:
+                graph[i].add(previous)
+            previous = i
+            continue
+        for other in __names(c.get("after")):
+            if other not in by_name:
+                logger.debug("{0} runs after {1}, which isn't enabled"
+                             .format(name, other))
+            graph[i].update(by_name.get(other, ()))
+        for other in __names(c.get("before")):
+            for j in by_name.get(other, ()):
+                graph[j].add(i)
+    for i, (name, c) in enumerate(controllers):
+        for j in range(i + 1, len(controllers)):
+            if __outputs_overlap(c, controllers[j][1]) and \
+                    not __waits_for(graph, i, j):
+                graph[j].add(i)
+    # Check there is an order to run them in:
+    done = set()
+    while len(done) < len(controllers):
+        ready = [i for i in graph if i not in done and graph[i] <= done]
+        if not ready:
+            raise exception.ControllerDependencyError(
+                "Controllers depend on each other: {0}".format(", ".join(
+                        controllers[i][0] for i in graph if i not in done)))
+        done.update(ready)
+    return graph
+
+
+def __config_value(key):
+    parts = key.split(".")
+    value = getattr(bf.config, parts[0], None)
+    for part in parts[1:]:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def inputs_digest(controller):
+    """Return a digest of everything a controller declares it reads, or
+    None if it doesn't declare its inputs.
+    """
+    if "inputs" not in controller and "config_keys" not in controller:
+        return None
+    h = hashlib.sha1()
+    mod_path = getattr(controller.mod, "__path__", [controller.mod.__file__])
+    h.update(manifest.tree_digest(list(mod_path)).encode("utf-8"))
+    settings = dict((k, v) for k, v in controller.items() if k != "logger")
+    h.update(_filter._config_repr(settings).encode("utf-8"))
+    paths = set()
+    for pattern in __names(controller.get("inputs")):
+        h.update(pattern.encode("utf-8"))
+        try:
+            paths.update(glob.glob(pattern, recursive=True))
+        except TypeError:
+            # Python < 3.5
+            paths.update(glob.glob(pattern))
+    h.update(manifest.tree_digest(sorted(paths)).encode("utf-8"))
+    for key in __names(controller.get("config_keys")):
+        h.update("{0}={1}".format(
+                key, _filter._config_repr(__config_value(key)))
+                 .encode("utf-8"))
+    return h.hexdigest()
+
+
+def __skippable(controllers, names, digests, build_manifest):
+    """Return the indexes of the controllers whose inputs haven't changed
+    since the last build, and that set up nothing the build reads.
+    """
+    forced = __names(bf.config.site.force_controllers)
+    skipped = set()
+    for i, (name, c) in enumerate(controllers):
+        if digests[i] is None or name in forced or names[i] in forced:
+            continue
+        if not is_outputs_only(c):
+            logger.debug("not skipping controller {0}, it isn't declared "
+                         "outputs_only".format(name))
+            continue
+        if build_manifest.is_unchanged(names[i], bf.writer.target_dir,
+                                       digests[i]):
+            skipped.add(i)
+    # Run the controllers that running ones declare they depend on:
+    changed = True
+    while changed:
+        changed = False
+        for i, (name, c) in enumerate(controllers):
+            if i in skipped or not is_declared(c):
+                continue
+            for j, (other, other_c) in enumerate(controllers):
+                if j in skipped and \
+                        (other in __names(c.get("after")) or
+                         name in __names(other_c.get("before"))):
+                    skipped.discard(j)
+                    changed = True
+    return skipped
+
+
+def __source_name(namespace, name):
+    """The manifest source of a controller.
+    """
+    if isinstance(namespace, HierarchicalCache) and "mod" in namespace:
+        # A plugin's controller
+        name = "{0}.{1}".format(
+            namespace.mod.__dist__["config_name"], name)
+    return "<controller:{0}>".format(name)
+
+
+def __run(name, c, source=None, digest=None):
+    logger.info("running controller (priority {0}): {1}"
+                .format(c.priority, c.mod.__file__))
+    build_manifest = bf.writer.manifest if "writer" in bf else None
+    if build_manifest is None or digest is None:
+        event_loop.call(c.mod.run)
+        return
+    build_manifest.begin(source, digest)
+    try:
+        event_loop.call(c.mod.run)
+    finally:
+        build_manifest.end()
+
+
+# The controllers being run, for worker processes:
+_controllers = None
+
+
+def _run_in_process(i):
+    """Run a controller in a worker process.
+
+    Returns (outputs written, write stats, formatted traceback or None)
+    """
+    name, c = _controllers[i]
+    return bf.writer.capture_outputs(__run, name, c)
+
+
+def __process_pool(workers):
+    """Return a ProcessPoolExecutor of workers forked from this process.
+    """
+    import multiprocessing
+    if sys.version_info >= (3, 7):
+        return futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("fork"))
+    # Before Python 3.7 the workers are always forked on POSIX:
+    return futures.ProcessPoolExecutor(workers)
+
+
 def run_all(namespaces):
-    """Run each controller in priority order.
-    """
-    # Get the controllers in priority order:
-    controllers = defined_controllers(namespaces)
-    # Temporarily add _controllers directory onto sys.path
-    for c in controllers:
-        if "run" in dir(c.mod):
-            logger.info("running controller (priority {0}): {1}"
-                        .format(c.priority, c.mod.__file__))
-            c.mod.run()
-        else:
+    """Run each controller, in priority order and following their
+    declared dependencies.
+    """
+    global _controllers
+    controllers = []
+    for namespace in namespaces:
+        load_pending_controllers(namespace.controllers)
+        for name, c in list(namespace.controllers.items()):
+            if "enabled" in c and c.enabled:
+                controllers.append((name, c, __source_name(namespace, name)))
+    # Sort the controllers by priority
+    controllers.sort(key=lambda c: c[1].priority, reverse=True)
+    sources = [source for name, c, source in controllers]
+    controllers = [(name, c) for name, c, source in controllers]
+    graph = dependency_graph(controllers)
+    build_manifest = bf.writer.manifest if "writer" in bf else None
+    if build_manifest is not None:
+        digests = [inputs_digest(c) for name, c in controllers]
+        skipped = __skippable(controllers, sources, digests,
+                              build_manifest)
+    else:
+        digests = [None] * len(controllers)
+        skipped = set()
+    if "writer" in bf:
+        keep = []
+        for i in skipped:
+            keep.extend(__names(controllers[i][1].get("outputs")))
+        bf.writer.begin_controllers(keep)
+    # Where each controller runs:
+    modes = []
+    for i, (name, c) in enumerate(controllers):
+        if i in skipped:
+            logger.info("skipping controller {0}, its inputs haven't "
+                        "changed".format(name))
+            build_manifest.keep(sources[i])
+            modes.append(None)
+        elif "run" not in dir(c.mod):
             logger.debug(
                 "controller {0} has no run() method, skipping it.".format(c))
+            modes.append(None)
+        elif futures is None or not is_declared(c):
+            modes.append("main")
+        elif c.get("process_safe") and "writer" in bf and \
+                util.can_fork(ignore_event_loop=True):
+            modes.append("process")
+        elif c.get("thread_safe"):
+            modes.append("thread")
+        else:
+            modes.append("main")
+    if "writer" in bf:
+        jobs = bf.writer.jobs
+    else:
+        jobs = util.job_count(bf.config.site.jobs)
+    _controllers = controllers
+    threads = None
+    processes = []
+    # future -> controller index:
+    running = {}
+    done = set()
+    waiting = list(range(len(controllers)))
+    try:
+        while waiting or running:
+            ready = [i for i in waiting if graph[i] <= done]
+            for i in ready:
+                if modes[i] is None:
+                    waiting.remove(i)
+                    done.add(i)
+            ready = [i for i in ready if modes[i] is not None]
+            thread_running = any(modes[i] == "thread"
+                                 for i in running.values())
+            to_fork = [i for i in ready if modes[i] == "process"]
+            if to_fork and not thread_running:
+                # Fork while no other controller is running in a thread,
+                # with no threads left alive: those of the thread pool,
+                # of the event loop, and of the process pools forked
+                # before (which waits for their controllers):
+                if threads is not None:
+                    threads.shutdown()
+                    threads = None
+                while processes:
+                    processes.pop().shutdown()
+                if event_loop.prepare_fork() and util.can_fork():
+                    pool = __process_pool(min(jobs, len(to_fork)))
+                    processes.append(pool)
+                    for i in to_fork:
+                        waiting.remove(i)
+                        running[pool.submit(_run_in_process, i)] = i
+                else:
+                    # Coroutines or other threads are running, run them
+                    # here instead:
+                    for i in to_fork:
+                        modes[i] = "main"
+                    to_fork = []
+            if not to_fork:
+                for i in ready:
+                    if modes[i] != "thread":
+                        continue
+                    if threads is None:
+                        threads = futures.ThreadPoolExecutor(jobs)
+                    waiting.remove(i)
+                    running[threads.submit(
+                            __run, controllers[i][0], controllers[i][1],
+                            sources[i], digests[i])] = i
+            main = [i for i in ready if modes[i] == "main"]
+            if main:
+                # The highest priority first:
+                i = main[0]
+                waiting.remove(i)
+                __run(controllers[i][0], controllers[i][1], sources[i],
+                      digests[i])
+                done.add(i)
+            elif running:
+                futures.wait(list(running),
+                             return_when=futures.FIRST_COMPLETED)
+            for f in [f for f in running if f.done()]:
+                i = running.pop(f)
+                result = f.result()
+                if modes[i] == "process":
+                    outputs, stats, error = result
+                    if error is not None:
+                        raise exception.ControllerError(
+                            "Error running controller {0}:\n{1}"
+                            .format(controllers[i][0], error))
+                    if digests[i] is not None:
+                        build_manifest.begin(sources[i], digests[i])
+                    try:
+                        bf.writer.merge_outputs(outputs, stats)
+                    finally:
+                        if digests[i] is not None:
+                            build_manifest.end()
+                done.add(i)
+    finally:
+        _controllers = None
+        if threads is not None:
+            threads.shutdown()
+        for pool in processes:
+            pool.shutdown()
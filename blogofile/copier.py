@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Copy static (non-template) files into the _site directory.
+
+The CopyEngine supports several modes, set with site.copy_mode:
+
+ * copy     - a regular copy of the file.
+ * hardlink - a hard link to the source file.
+ * reflink  - a copy-on-write clone of the source file.
+ * symlink  - a symbolic link to the source file.
+ * auto     - skip files whose size and mtime already match the
+              destination (and their contents, when the mtimes are
+              only whole seconds), otherwise reflink or copy in the
+              kernel.
+
+Whether hard links or reflinks work is checked once per pair of
+source and destination devices; when they don't, the engine falls back
+to copying instead of retrying for every file. Copies run on a thread
+pool.
+
+With write_if_changed, destinations that already have the same contents
+as their source are left untouched, whatever the mode.
+"""
+
+__author__ = "Ryan McGuire (ryan@enigmacurry.com)"
+
+import errno
+import logging
+import os
+import shutil
+import threading
+from . import util
+try:
+    from concurrent import futures
+except ImportError:
+    # Python < 3.2
+    futures = None
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+
+logger = logging.getLogger("blogofile.copier")
+
+modes = ("copy", "hardlink", "reflink", "symlink", "auto")
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+class CopyEngineError(Exception):
+    pass
+
+
+def reflink(src, dst):
+    """Clone src to dst with the FICLONE ioctl.
+
+    Raises OSError if the filesystem (or platform) can't do it.
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflink is not supported")
+    with open(src, "rb") as s:
+        with open(dst, "wb") as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except (IOError, OSError):
+                d.close()
+                os.remove(dst)
+                raise
+
+
+def kernel_copy(src, dst):
+    """Copy src to dst without moving the data through userspace,
+    where the platform allows it.
+    """
+    with open(src, "rb") as s:
+        with open(dst, "wb") as d:
+            size = os.fstat(s.fileno()).st_size
+            for copy_range in (getattr(os, "copy_file_range", None),
+                               getattr(os, "sendfile", None)):
+                if copy_range is None:
+                    continue
+                try:
+                    offset = 0
+                    while offset < size:
+                        if copy_range is os.sendfile:
+                            n = os.sendfile(d.fileno(), s.fileno(), offset,
+                                            size - offset)
+                        else:
+                            n = os.copy_file_range(s.fileno(), d.fileno(),
+                                                   size - offset, offset,
+                                                   offset)
+                        if n == 0:
+                            break
+                        offset += n
+                    return
+                except OSError:
+                    # Not supported for these files, try the next way:
+                    s.seek(0)
+                    d.seek(0)
+                    d.truncate()
+            shutil.copyfileobj(s, d)
+
+
+class CopyEngine(object):
+    """Copy (or link) files, possibly in parallel.
+    """
+    def __init__(self, mode="copy", threads=1, write_if_changed=False):
+        if mode not in modes:
+            raise CopyEngineError(
+                "Unknown copy mode: {0} (choose from {1})"
+                .format(mode, ", ".join(modes)))
+        self.mode = mode
+        self.write_if_changed = write_if_changed
+        self.stats = dict((k, 0) for k in
+                          ("copied", "linked", "reflinked", "skipped"))
+        # (source device, destination device) -> mode that works there:
+        self.__device_modes = {}
+        self.__lock = threading.Lock()
+        self.__futures = []
+        if threads > 1 and futures is not None:
+            self.__executor = futures.ThreadPoolExecutor(threads)
+        else:
+            self.__executor = None
+
+    def copy(self, src, dst):
+        """Copy src to dst, in the background if there is a thread pool.
+        """
+        if self.__executor is None:
+            self.__copy(src, dst)
+        else:
+            self.__futures.append(
+                self.__executor.submit(self.__copy, src, dst))
+
+    def wait(self):
+        """Wait for all pending copies, raising the first error.
+        """
+        pending, self.__futures = self.__futures, []
+        for future in pending:
+            future.result()
+
+    def shutdown(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
+
+    def __count(self, stat):
+        with self.__lock:
+            self.stats[stat] += 1
+
+    def __device_mode(self, src, dst):
+        """Which mode to use for this pair of devices.
+        """
+        devices = (os.stat(src).st_dev,
+                   os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+        with self.__lock:
+            return self.__device_modes.get(devices, self.mode), devices
+
+    def __unsupported(self, devices, mode, error):
+        with self.__lock:
+            if self.__device_modes.get(devices) == "copy":
+                # Another thread found out at the same time
+                return
+            self.__device_modes[devices] = "copy"
+        logger.info("{0} not supported from device {1} to {2} ({3}), "
+                    "falling back to copying".format(
+                mode, devices[0], devices[1], error))
+
+    def __is_current(self, src, dst):
+        """Does dst already have the size and mtime of src?
+
+        An mtime that is a whole second may be all a filesystem
+        remembers, and hides an edit made within that second: then the
+        contents are compared as well.
+        """
+        try:
+            d = os.stat(dst)
+        except OSError:
+            return False
+        s = os.stat(src)
+        if s.st_size != d.st_size:
+            return False
+        try:
+            s_mtime, d_mtime = s.st_mtime_ns, d.st_mtime_ns
+            second = 1000000000
+        except AttributeError:
+            # Python < 3.3
+            s_mtime, d_mtime = s.st_mtime, d.st_mtime
+            second = 1
+        if s_mtime == d_mtime and s_mtime % second:
+            return True
+        if s_mtime // second != d_mtime // second or \
+                (s_mtime % second and d_mtime % second):
+            return False
+        return util.same_contents(dst, src)
+
+    def __copy(self, src, dst):
+        if self.mode == "auto" and self.__is_current(src, dst):
+            self.__count("skipped")
+            return
+        if self.write_if_changed and not os.path.islink(dst) and \
+                util.same_contents(dst, src):
+            self.__count("skipped")
+            return
+        if os.path.lexists(dst):
+            # Left over from a previous build, or written twice.
+            # Don't write through a hard link into the source file.
+            os.remove(dst)
+        if self.mode == "copy":
+            shutil.copyfile(src, dst)
+            self.__count("copied")
+            return
+        if self.mode == "symlink":
+            os.symlink(os.path.abspath(src), dst)
+            self.__count("linked")
+            return
+        mode, devices = self.__device_mode(src, dst)
+        if mode == "hardlink":
+            try:
+                os.link(src, dst)
+                self.__count("linked")
+                return
+            except OSError as e:
+                self.__unsupported(devices, mode, e)
+        elif mode in ("reflink", "auto"):
+            try:
+                reflink(src, dst)
+                self.__count("reflinked")
+            except (IOError, OSError) as e:
+                self.__unsupported(devices, "reflink", e)
+            else:
+                if self.mode == "auto":
+                    shutil.copystat(src, dst)
+                return
+        if self.mode == "auto":
+            kernel_copy(src, dst)
+            # Keep the mtime, so the next build can skip this file:
+            shutil.copystat(src, dst)
+        else:
+            shutil.copyfile(src, dst)
+        self.__count("copied")
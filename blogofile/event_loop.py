@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""The event loop that runs asynchronous controllers and plugins.
+
+A controller's (or plugin's) init() and run() can be coroutine
+functions:
+
+    async def run():
+        posts = await asyncio.gather(*[bf.event_loop.read_source(p)
+                                       for p in paths])
+        ...
+        await bf.event_loop.materialize_template(
+            "post.mako", location, {"post": post})
+
+Blogofile runs every coroutine on one shared event loop, in a
+background thread, and waits for it to finish. The loop is stopped
+whenever the build forks worker processes, and started again when it's
+needed. Controllers that run
+alongside each other (see blogofile.controller) have their coroutines
+interleaved on that loop, so their I/O overlaps.
+
+The helpers here return awaitables that do blocking work - reading
+files, rendering templates - in a pool of site.jobs threads. They can
+only be awaited by coroutines running on this loop.
+
+asyncio is only imported once there's a coroutine to run.
+"""
+
+__author__ = "Ryan McGuire (ryan@enigmacurry.com)"
+
+import functools
+import io
+import logging
+import os
+import sys
+import threading
+try:
+    from collections.abc import Coroutine
+except ImportError:
+    # Python < 3.5, there are no coroutines to run
+    Coroutine = None
+try:
+    import contextvars
+except ImportError:
+    # Python < 3.7
+    contextvars = None
+try:
+    from concurrent import futures
+except ImportError:
+    # Python < 3.2
+    futures = None
+
+from .cache import bf
+from . import util
+
+bf.event_loop = sys.modules['blogofile.event_loop']
+
+
+logger = logging.getLogger("blogofile.event_loop")
+
+_lock = threading.Lock()
+# The loop, the thread running it, and the thread pool of the helpers.
+# They belong to the process that started them (not to forked workers):
+_loop = None
+_thread = None
+_executor = None
+_pid = None
+# How many coroutines run() is waiting for:
+_running = 0
+
+
+def get_loop():
+    """Return the shared event loop, starting it if it isn't running.
+    """
+    import asyncio
+    global _loop, _thread, _executor, _pid
+    with _lock:
+        if _loop is None or _pid != os.getpid():
+            _pid = os.getpid()
+            _executor = None
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_loop.run_forever,
+                                       name="blogofile-event-loop")
+            _thread.daemon = True
+            _thread.start()
+        return _loop
+
+
+def __get_executor():
+    global _executor
+    get_loop()
+    with _lock:
+        if _executor is None:
+            _executor = futures.ThreadPoolExecutor(
+                util.job_count(bf.config.site.jobs))
+        return _executor
+
+
+def is_coroutine(obj):
+    return Coroutine is not None and isinstance(obj, Coroutine)
+
+
+def run(result):
+    """Wait for result, the return value of an init() or run(), if it's
+    a coroutine: run it on the event loop. Returns the value it returns.
+    """
+    if not is_coroutine(result):
+        return result
+    import asyncio
+    global _running
+    loop = get_loop()
+    if threading.current_thread() is _thread:
+        result.close()
+        raise RuntimeError("Cannot wait for a coroutine on the event loop "
+                           "itself, await it instead.")
+    with _lock:
+        _running += 1
+    try:
+        return asyncio.run_coroutine_threadsafe(result, loop).result()
+    finally:
+        with _lock:
+            _running -= 1
+
+
+def is_busy():
+    """Are coroutines running on the event loop of this process?
+
+    It can't be stopped then, see prepare_fork.
+    """
+    with _lock:
+        return _running > 0 and _pid == os.getpid()
+
+
+def is_loop_thread(thread):
+    """Is thread the one running the event loop of this process?
+    """
+    with _lock:
+        return thread is _thread and _pid == os.getpid()
+
+
+def prepare_fork():
+    """Stop the event loop (and its thread pool) before this process
+    forks: forking while their threads run could deadlock the child.
+    It's started again the next time there's a coroutine to run.
+
+    Returns False, and leaves the loop alone, if coroutines are running
+    on it: don't fork then.
+    """
+    if is_busy():
+        return False
+    shutdown()
+    return True
+
+
+def call(function, *args, **kwargs):
+    """Call function, running it on the event loop if it's a coroutine
+    function.
+    """
+    return run(function(*args, **kwargs))
+
+
+def shutdown():
+    """Stop the event loop and the thread pool, if they were started.
+    """
+    global _loop, _thread, _executor, _pid
+    with _lock:
+        loop, thread, executor = _loop, _thread, _executor
+        if _pid != os.getpid():
+            # Started by the process this one was forked from
+            loop = thread = executor = None
+        _loop = _thread = _executor = _pid = None
+    if executor is not None:
+        executor.shutdown()
+    if loop is not None:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def run_in_thread(function, *args, **kwargs):
+    """Return an awaitable of function(*args, **kwargs), called in the
+    thread pool.
+    """
+    import asyncio
+    job = functools.partial(function, *args, **kwargs)
+    if contextvars is not None:
+        # Keep track of what's being built (see blogofile.manifest):
+        job = functools.partial(contextvars.copy_context().run, job)
+    return asyncio.wrap_future(__get_executor().submit(job))
+
+
+def __read(path, encoding):
+    with io.open(path, encoding=encoding) as f:
+        return f.read()
+
+
+def read_source(path, encoding="utf-8"):
+    """Return an awaitable of the text of the file at path.
+    """
+    return run_in_thread(__read, path, encoding)
+
+
+def materialize_template(template_name, location, attrs={}, lookup=None,
+                         caller=None):
+    """Return an awaitable of bf.template.materialize_template.
+
+    Templates are still rendered one at a time, but the controller can
+    go on reading sources in the meantime.
+    """
+    return run_in_thread(bf.template.materialize_template, template_name,
+                         location, attrs=attrs, lookup=lookup,
+                         caller=caller)
@@ -7,3 +7,11 @@ class SourceDirectoryNotFound(Exception):
 
 class FilterNotLoaded(Exception):
     pass
+
+
+class ControllerError(Exception):
+    pass
+
+
+class ControllerDependencyError(ControllerError):
+    pass
@@ -1,47 +1,436 @@
 # -*- coding: utf-8 -*-
+"""Filters
+
+Filters reside in the user's _filters directory (or in plugins), and
+transform content, e.g. markdown to HTML. They are run in chains: a
+chain is a comma separated string (or a sequence) of filter names,
+compiled once into a FilterChain.
+
+Every filter has a run(content) function, and optionally an init()
+function that runs before the site is built. Its config dictionary can
+declare, along with name, description, author and url, what the build
+may do with it:
+
+ * pure         - the output only depends on the input and the config,
+                  so it can be cached between builds (default False.)
+                  The filter's module is part of the cache key, but not
+                  the modules it imports: list the packages it uses in
+                  "packages", e.g. ["Markdown"], and their versions are
+                  part of the key too.
+ * thread_safe  - run() can be called from several threads at once
+                  (default False.)
+ * process_safe - run() works in worker processes (default True.)
+ * streaming    - the filter also has a run_stream(chunks) generator
+                  that transforms an iterable of strings as it goes
+                  (default False.)
+ * cost_hint    - how expensive run() is, relative to 1.0 for a typical
+                  filter like markdown. Chains cheaper than 1.0 in
+                  total aren't worth running in parallel.
+
+Filters are only registered (by name and module path) when the config
+loads; each one is imported, and initialized, the first time a chain or
+get_filter asks for it. Settings for it from the user's _config.py are
+merged over the filter's own defaults at that point.
+
+When the build has a filter cache (site.filter_cache_dir), the outputs of
+pure filters are kept between builds, see filter_cache.
+"""
 from __future__ import print_function
 import sys
 import os
+import re
+import hashlib
 import logging
-import imp
+import threading
 import uuid
+try:
+    from concurrent import futures
+except ImportError:
+    # Python < 3.2
+    futures = None
 
 
 logger = logging.getLogger("blogofile.filter")
 
 from .cache import bf
 from .cache import HierarchicalCache
+from .cache import merge_settings
+from . import bytecode_cache
 from . import exception
+from . import util
 
 bf.filter = sys.modules['blogofile.filter']
 
+try:
+    string_types = basestring
+except NameError:
+    # Python 3
+    string_types = str
+
 default_filter_config = {"name": None,
                          "description": None,
                          "author": None,
-                         "url": None}
+                         "url": None,
+                         # Capabilities, see the module docstring:
+                         "pure": False,
+                         "thread_safe": False,
+                         "process_safe": True,
+                         "streaming": False,
+                         "cost_hint": 1.0}
+
+capabilities = ("pure", "thread_safe", "process_safe", "streaming",
+                "cost_hint")
+
+# The FilterCache of the build in progress, or None:
+output_cache = None
+# (module path, mtime) -> digest of the module file:
+_module_digests = {}
+# distribution name -> installed version, or None:
+_package_versions = {}
+
+# Compiled chains, by chain string or tuple of filter names:
+_chains = {}
+# Bumped whenever filters are (re)loaded or initialized, so compiled
+# chains know to resolve their filters again:
+_generation = 0
+
+
+class FilterChain(object):
+    """A filter chain, parsed once, with its filters resolved the first
+    time it runs.
+
+    Works with either a string or a sequence of filters.
+    """
+    def __init__(self, chain):
+        if isinstance(chain, string_types):
+            self.names = tuple(parse_chain(chain))
+        else:
+            self.names = tuple(chain)
+        # (name, filter module, digest of the module and config, or
+        # None if the filter's output can't be cached):
+        self.__steps = None
+        self.__capabilities = None
+        self.__generation = None
+
+    def __resolve(self):
+        if self.__generation != _generation:
+            steps = []
+            chain_capabilities = {"cost_hint": 0.0}
+            for name in self.names:
+                filter_config = get_filter_config(name)
+                steps.append((name, filter_config.mod,
+                              _filter_digest(filter_config)))
+                for capability, value in get_capabilities(
+                        filter_config).items():
+                    if capability == "cost_hint":
+                        chain_capabilities[capability] += value
+                    else:
+                        chain_capabilities[capability] = value and \
+                            chain_capabilities.get(capability, True)
+            self.__steps = steps
+            self.__capabilities = chain_capabilities
+            self.__generation = _generation
+        return self.__steps
+
+    def filters(self):
+        """Return the filter modules of the chain.
+        """
+        return [f for name, f, digest in self.__resolve()]
+
+    def capabilities(self):
+        """Return the capabilities of the chain as a whole: what all its
+        filters can do, and their total cost_hint.
+        """
+        self.__resolve()
+        return self.__capabilities
+
+    def cache_key(self, content):
+        """Return the filter cache key of content's output, or None if
+        the chain's output can't be cached as a whole.
+        """
+        if output_cache is None:
+            return None
+        key = _digest(content)
+        for name, f, digest in self.__resolve():
+            if digest is None:
+                return None
+            key = _digest(digest, key)
+        return key
+
+    def run(self, content, lookup=True):
+        """Run content through the chain.
+
+        The outputs of consecutive pure filters are looked up in the
+        filter cache as one: they're keyed by the digest of the first
+        one's input and of each filter in turn. With lookup False, they
+        are stored but not looked up, for callers that already did.
+        """
+        debug = logger.isEnabledFor(logging.DEBUG)
+        cache = output_cache
+        # Pure filters not run yet, and the key of their output:
+        pending = []
+        key = None
+        for name, f, digest in self.__resolve():
+            if cache is not None and digest is not None:
+                if key is None:
+                    key = _digest(content)
+                key = _digest(digest, key)
+                pending.append((name, f))
+                continue
+            content = self.__run(pending, key, content, lookup, debug)
+            pending = []
+            key = None
+            if debug:
+                logger.debug("Applying filter: " + name)
+            content = f.run(content)
+        content = self.__run(pending, key, content, lookup, debug)
+        if debug:
+            logger.debug("Content: " + content)
+        return content
+
+    def __run(self, filters, key, content, lookup, debug):
+        if not filters:
+            return content
+        cache = output_cache
+        cached = cache.get(key) if lookup else None
+        if cached is not None:
+            if debug:
+                logger.debug("Filter output cached: " + key)
+            return cached
+        for name, f in filters:
+            if debug:
+                logger.debug("Applying filter: " + name)
+            content = f.run(content)
+        cache.set(key, content)
+        return content
+
+    def stream(self, chunks):
+        """Run an iterable of strings through the chain, yielding the
+        output as it's produced if every filter is streaming, or all of
+        it at once otherwise.
+        """
+        if not self.capabilities()["streaming"]:
+            yield self.run("".join(chunks))
+            return
+        for f in self.filters():
+            chunks = f.run_stream(chunks)
+        for chunk in chunks:
+            yield chunk
+
+    def __str__(self):
+        return ", ".join(self.names)
+
+    def __repr__(self):
+        return "<FilterChain '{0}'>".format(self)
+
+
+def _digest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode("utf-8")
+        h.update(part)
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _config_repr(value):
+    """A repr of a filter's config that is the same from build to build.
+    """
+    if isinstance(value, dict):
+        return "{" + ", ".join(
+            "{0!r}: {1}".format(k, _config_repr(v))
+            for k, v in sorted(value.items()) if k != "mod") + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_config_repr(v) for v in value) + "]"
+    # Don't let object addresses change the key:
+    return re.sub(" at 0x[0-9a-fA-F]+", "", repr(value))
+
+
+def _package_version(name):
+    """Return the installed version of the distribution called name, or
+    None if it isn't installed.
+    """
+    try:
+        return _package_versions[name]
+    except KeyError:
+        pass
+    version = None
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources
+        try:
+            version = pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            pass
+    else:
+        try:
+            version = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            pass
+    _package_versions[name] = version
+    return version
+
+
+def _filter_digest(filter_config):
+    """Digest of a filter's module, config and the versions of the
+    packages it uses, or None if the filter's output can't be cached.
+    """
+    path = getattr(filter_config.mod, "__file__", None)
+    if not filter_config.get("pure", False) or path is None:
+        return None
+    try:
+        key = (path, os.path.getmtime(path))
+    except OSError:
+        return None
+    try:
+        module_digest = _module_digests[key]
+    except KeyError:
+        module_digest = _module_digests[key] = util.file_digest(path)
+    packages = filter_config.get("packages") or ()
+    if isinstance(packages, string_types):
+        packages = [packages]
+    versions = ",".join("{0}={1}".format(package, _package_version(package))
+                        for package in packages)
+    return _digest(module_digest, _config_repr(filter_config), versions)
+
+
+def get_capabilities(filter_config):
+    """Return the capabilities a filter declares in its config.
+    """
+    return dict((capability, filter_config.get(
+        capability, default_filter_config[capability]))
+                for capability in capabilities)
+
+
+def get_chain(chain):
+    """Return the compiled FilterChain for a chain string, or a sequence
+    of filter names.
+    """
+    if isinstance(chain, FilterChain):
+        return chain
+    if isinstance(chain, string_types):
+        key = chain
+    else:
+        key = tuple(chain)
+    try:
+        return _chains[key]
+    except KeyError:
+        return _chains.setdefault(key, FilterChain(chain))
 
 
 def run_chain(chain, content):
     """Run content through a filter chain.
 
-    Works with either a string or a sequence of filters
+    Works with either a string, a sequence of filters or a FilterChain.
     """
     if chain is None:
         return content
-    # lib3to2 interprets str as meaning unicode instead of basestring,
-    # hand craft the translation to python2:
-    if sys.version_info >= (3,):
-        is_str = eval("isinstance(chain, str)")
+    return get_chain(chain).run(content)
+
+
+# The filters that come with blogofile:
+builtin_filters_dir = os.path.join(os.path.dirname(__file__), "_filters")
+
+# Held while a registered filter is loaded:
+_load_lock = threading.RLock()
+
+# The FilterChain of the run_chain_many worker process, and whether it
+# looks up outputs in the filter cache:
+_worker_chain = None
+_worker_lookup = True
+
+
+def _init_chain_worker(names, lookup=True):
+    """Set up a run_chain_many worker process, forked from the build.
+    """
+    global _worker_chain, _worker_lookup
+    _worker_chain = FilterChain(names)
+    _worker_lookup = lookup
+
+
+def _run_worker_chain(content):
+    cache_stats = dict(output_cache.stats) if output_cache else {}
+    content = _worker_chain.run(content, _worker_lookup)
+    return content, dict((k, output_cache.stats[k] - v)
+                         for k, v in cache_stats.items())
+
+
+def run_chain_many(chain, contents, workers=None, chunksize=8):
+    """Run each of contents through a filter chain, in parallel (with one
+    worker per CPU if workers is None.)
+
+    Returns the outputs, in the same order as contents. How they run
+    depends on the capabilities of the chain's filters:
+
+     * outputs already in the filter cache are read in this process, and
+       only the others are handed to workers.
+     * chains cheaper than a cost_hint of 1.0 run serially, the workers
+       would cost more than they save.
+     * process safe chains run in worker processes forked from this one
+       (where it can fork, see util.can_fork), thread safe ones in
+       worker threads, and others serially in this process.
+    """
+    if chain is None:
+        return list(contents)
+    chain = get_chain(chain)
+    contents = list(contents)
+    outputs = [None] * len(contents)
+    # The index and cache key of each content that isn't cached yet:
+    todo = []
+    for i, content in enumerate(contents):
+        key = chain.cache_key(content)
+        if key is not None:
+            outputs[i] = output_cache.get(key)
+        if outputs[i] is None:
+            todo.append(i)
+    lookup = output_cache is None or chain.cache_key("") is None
+    todo_contents = [contents[i] for i in todo]
+    for i, output in zip(todo, _run_chain_parallel(
+            chain, todo_contents, util.job_count(workers), chunksize,
+            lookup)):
+        outputs[i] = output
+    return outputs
+
+
+def _run_chain_parallel(chain, contents, workers, chunksize, lookup):
+    chain_capabilities = chain.capabilities()
+    if workers < 2 or len(contents) < 2 or \
+            chain_capabilities["cost_hint"] < 1.0:
+        strategy = "serial"
+    elif chain_capabilities["process_safe"]:
+        strategy = "process"
+    elif chain_capabilities["thread_safe"] and futures is not None:
+        strategy = "thread"
     else:
-        is_str = eval("isinstance(chain, basestring)")
-    if is_str:
-        chain = parse_chain(chain)
-    for fn in chain:
-        f = get_filter(fn)
-        logger.debug("Applying filter: " + fn)
-        content = f.run(content)
-    logger.debug("Content: " + content)
-    return content
+        strategy = "serial"
+    pool = None
+    if strategy == "process":
+        pool = util.process_pool(
+            workers, _init_chain_worker, (chain.names, lookup))
+        if pool is None:
+            strategy = "serial"
+    logger.debug("Running filter chain {0} on {1} contents: {2}".format(
+            chain, len(contents), strategy))
+    if strategy == "serial":
+        return [chain.run(content, lookup) for content in contents]
+    if strategy == "thread":
+        with futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(
+                lambda content: chain.run(content, lookup), contents))
+    outputs = []
+    try:
+        for content, cache_stats in pool.imap(
+                _run_worker_chain, contents, chunksize):
+            outputs.append(content)
+            for k, v in cache_stats.items():
+                output_cache.stats[k] += v
+    finally:
+        pool.terminate()
+        pool.join()
+    return outputs
 
 
 def parse_chain(chain):
@@ -59,7 +448,9 @@ def parse_chain(chain):
 
 def preload_filters(namespace=None, directory="_filters"):
     """Find all the standalone .py files and modules in the directory
-    specified and load them into namespace specified.
+    specified and register them in the namespace specified.
+
+    They aren't imported until they're used, see get_filter_config.
     """
     if namespace is None:
         namespace = bf.config.filters
@@ -68,37 +459,115 @@ def preload_filters(namespace=None, directory="_filters"):
     for fn in os.listdir(directory):
         p = os.path.join(directory, fn)
         if (os.path.isfile(p) and fn.endswith(".py")):
-            # Load a single .py file:
-            load_filter(fn[:-3], module_path=p, namespace=namespace)
+            # Register a single .py file:
+            register_filter(fn[:-3], module_path=p, namespace=namespace)
         elif (os.path.isdir(p)
               and os.path.isfile(os.path.join(p, "__init__.py"))):
-            # Load a package:
-            load_filter(fn, module_path=p, namespace=namespace)
+            # Register a package:
+            register_filter(fn, module_path=p, namespace=namespace)
+
+
+def preload_builtin_filters(namespace=None):
+    """Register the filters that come with blogofile (markdown, rst and
+    syntax_highlight.) Filters of the same name from plugins or the
+    site's _filters directory replace them.
+    """
+    preload_filters(namespace, builtin_filters_dir)
+
+
+def is_builtin(filter_config):
+    """Is this one of the filters that come with blogofile?
+    """
+    return os.path.dirname(filter_config.get("module_path", "")) == \
+        builtin_filters_dir
+
+
+def register_filter(name, module_path, namespace=None):
+    """Register a filter to be loaded from module_path when it's first
+    used.
+    """
+    if namespace is None:
+        namespace = bf.config.filters
+    if name not in namespace or "mod" in namespace[name]:
+        namespace[name] = HierarchicalCache()
+    namespace[name].module_path = module_path
+
+
+def is_pending(filter_config):
+    """Is this a filter that is registered, but not loaded yet?
+    """
+    return "module_path" in filter_config and "mod" not in filter_config
+
+
+def load_pending_filters(namespace=None, ignore_errors=False):
+    """Load (and initialize) all the registered filters that aren't
+    loaded yet.
+
+    With ignore_errors, filters that fail to load (e.g. because a
+    package they need isn't installed) are skipped. Returns a dictionary
+    of their names and errors.
+    """
+    if namespace is None:
+        namespace = bf.config.filters
+    errors = {}
+    for name in list(namespace.keys()):
+        if is_pending(namespace[name]):
+            try:
+                __load_pending(name, namespace)
+            except Exception as e:
+                if not ignore_errors:
+                    raise
+                errors[name] = e
+    return errors
+
+
+def __load_pending(name, namespace):
+    with _load_lock:
+        # Another thread may have loaded it in the meantime:
+        if is_pending(namespace[name]):
+            load_filter(name, namespace[name].module_path, namespace)
+            __init_filter(name, namespace[name])
+
+
+def __init_filter(name, filt):
+    try:
+        init_method = filt.mod.init
+    except AttributeError:
+        filt.mod.__initialized = True
+        return
+    logger.debug("Initializing filter: " + name)
+    init_method()
+    filt.mod.__initialized = True
 
 
 def init_filters(namespace=None):
     """Filters have an optional init method that runs before the site
     is built.
     """
+    global _generation
     if namespace is None:
         namespace = bf.config.filters
+    _generation += 1
     for name, filt in list(namespace.items()):
         if "mod" in filt \
                 and type(filt.mod).__name__ == "module"\
                 and not filt.mod.__initialized:
-            try:
-                init_method = filt.mod.init
-            except AttributeError:
-                filt.mod.__initialized = True
-                continue
-            logger.debug("Initializing filter: " + name)
-            init_method()
-            filt.mod.__initialized = True
+            __init_filter(name, filt)
 
 
 def get_filter(name, namespace=None):
     """Return an already loaded filter.
     """
+    return get_filter_config(name, namespace).mod
+
+
+def get_filter_config(name, namespace=None):
+    """Return the config namespace of a filter, loading it first if it
+    is only registered.
+
+    Aliases are only known once their filter is loaded, so a name that
+    isn't registered loads all the pending filters of the namespace.
+    """
     if namespace is None:
         if name.startswith("bf") and "." in name:
             # Name is an absolute reference to a filter in a given
@@ -110,14 +579,46 @@ def get_filter(name, namespace=None):
             namespace = bf.config.filters
     if name in namespace and "mod" in namespace[name]:
         logger.debug("Retrieving already loaded filter: " + name)
-        return namespace[name]['mod']
-    else:
-        raise exception.FilterNotLoaded("Filter not loaded: {0}".format(name))
+        return namespace[name]
+    if name not in namespace or not is_pending(namespace[name]):
+        # It may be the alias of a filter that isn't loaded yet:
+        load_pending_filters(namespace)
+    elif is_pending(namespace[name]):
+        __load_pending(name, namespace)
+    if name in namespace and "mod" in namespace[name]:
+        return namespace[name]
+    raise exception.FilterNotLoaded("Filter not loaded: {0}".format(name))
+
+
+def __check_capabilities(name, filter_config):
+    """Normalize the capabilities a filter declares.
+    """
+    for capability in capabilities:
+        if capability == "cost_hint":
+            try:
+                filter_config[capability] = float(filter_config[capability])
+            except (TypeError, ValueError):
+                logger.warn("Filter {0} has an invalid cost_hint: {1!r}"
+                            .format(name, filter_config[capability]))
+                filter_config[capability] = \
+                    default_filter_config[capability]
+        else:
+            filter_config[capability] = bool(filter_config[capability])
+    if filter_config.streaming and \
+            not hasattr(filter_config.mod, "run_stream"):
+        logger.warn("Filter {0} is declared streaming, but has no "
+                    "run_stream function".format(name))
+        filter_config.streaming = False
 
 
 def load_filter(name, module_path, namespace=None):
     """Load a filter from the site's _filters directory.
+
+    If the filter was registered, the settings made for it in the
+    meantime are kept, and override the filter's own config.
     """
+    global _generation
+    _generation += 1
     if namespace is None:
         namespace = bf.config.filters
     try:
@@ -125,31 +626,54 @@ def load_filter(name, module_path, namespace=None):
     except KeyError:
         initial_dont_write_bytecode = False
     try:
-        # Don't generate .pyc files in the _filters directory
+        # Don't generate .pyc files in the _filters directory, they're
+        # kept in the bytecode cache instead:
         sys.dont_write_bytecode = True
-        if module_path.endswith(".py"):
-            mod = imp.load_source(
-                "{0}_{1}".format(name, uuid.uuid4()), module_path)
-        else:
-            mod = imp.load_package(
-                "{0}_{1}".format(name, uuid.uuid4()), module_path)
+        mod = bytecode_cache.load_module(
+            "{0}_{1}".format(name, uuid.uuid4()), module_path,
+            bytecode_cache.get_cache_dir())
         logger.debug("Loaded filter for first time: {0}".format(module_path))
         mod.__initialized = False
-        # Overwrite anything currently in this namespace:
+        # The filter's own defaults, before the namespace is set up (it
+        # may be the filter's config itself):
         try:
-            del namespace[name]
-        except KeyError:
-            pass
-        # If the filter defines it's own configuration, use that as
-        # it's own namespace:
-        if hasattr(mod, "config") and \
-                isinstance(mod.config, HierarchicalCache):
-            namespace[name] = mod.config
+            filter_defaults = list(getattr(mod, "config").items())
+        except AttributeError:
+            filter_defaults = []
+        settings = {}
+        pending = namespace.get(name)
+        if pending is not None and is_pending(pending):
+            # Keep the registered namespace, plugins may share it:
+            settings.update(pending)
+            del settings["module_path"]
+            pending.clear()
+            if hasattr(mod, "config") and \
+                    isinstance(mod.config, HierarchicalCache):
+                pending.update(mod.config)
+                mod.config = pending
+        else:
+            # Overwrite anything currently in this namespace:
+            try:
+                del namespace[name]
+            except KeyError:
+                pass
+            # If the filter defines it's own configuration, use that as
+            # it's own namespace:
+            if hasattr(mod, "config") and \
+                    isinstance(mod.config, HierarchicalCache):
+                namespace[name] = mod.config
         # Load the module into the namespace
         namespace[name].mod = mod
+        # Where it was imported from:
+        namespace[name].module_path = module_path
         # If the filter has any aliases, load those as well
         try:
             for alias in mod.config['aliases']:
+                alias_settings = namespace.get(alias)
+                if alias_settings is not None and \
+                        "mod" not in alias_settings and \
+                        "module_path" not in alias_settings:
+                    settings.update(alias_settings)
                 namespace[alias] = namespace[name]
         except:
             pass
@@ -157,20 +681,18 @@ def load_filter(name, module_path, namespace=None):
         for k, v in list(default_filter_config.items()):
             namespace[name][k] = v
         # Load any filter defined defaults:
-        try:
-            filter_config = getattr(mod, "config")
-            for k, v in list(filter_config.items()):
-                if "." in k:
-                    # This is a hierarchical setting
-                    tail = namespace[name]
-                    parts = k.split(".")
-                    for part in parts[:-1]:
-                        tail = tail[part]
-                    tail[parts[-1]] = v
-                else:
-                    namespace[name][k] = v
-        except AttributeError:
-            pass
+        for k, v in filter_defaults:
+            if "." in k:
+                # This is a hierarchical setting
+                tail = namespace[name]
+                parts = k.split(".")
+                for part in parts[:-1]:
+                    tail = tail[part]
+                tail[parts[-1]] = v
+            else:
+                namespace[name][k] = v
+        merge_settings(namespace[name], settings)
+        __check_capabilities(name, namespace[name])
         return mod
     except:
         logger.error("Cannot load filter: " + name)
@@ -184,12 +706,22 @@ def list_filters(args):
     from . import config, plugin
     config.init_interactive()
     plugin.init_plugins()
+    errors = load_pending_filters(ignore_errors=True)
     # module path -> list of aliases
     filters = {}
+    # module path -> filter config
+    filter_configs = {}
     for name, filt in bf.config.filters.items():
-        if "mod" in filt:
+        if "mod" in filt and name not in errors:
             aliases = filters.get(filt.mod.__file__, [])
             aliases.append(name)
             filters[filt.mod.__file__] = aliases
+            filter_configs[filt.mod.__file__] = filt
     for mod_path, aliases in filters.items():
-        print("{0} - {1}\n".format(", ".join(aliases), mod_path))
+        print("{0} - {1}".format(", ".join(aliases), mod_path))
+        filter_capabilities = get_capabilities(filter_configs[mod_path])
+        print("    {0}\n".format(", ".join(
+            "{0}: {1}".format(capability, filter_capabilities[capability])
+            for capability in capabilities)))
+    for name, error in sorted(errors.items()):
+        print("{0} - cannot be loaded: {1}".format(name, error))
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Benchmark filters and filter chains against a corpus of documents.
+
+`blogofile filters bench` runs every filter of the site (and any chains
+given with --chain) over each document of the corpus, _posts by default,
+and reports for each one:
+
+ * docs_per_sec, mb_per_sec - throughput over the whole corpus.
+ * p50_ms, p99_ms           - latency of a single document.
+ * peak_memory              - the most memory (in bytes) allocated at
+                              once while running over the corpus.
+
+Peak memory is measured with tracemalloc in a separate pass, so that
+tracing doesn't slow down the timed runs. The filter cache is bypassed
+throughout: every document is actually filtered.
+"""
+from __future__ import print_function
+
+__author__ = "Ryan McGuire (ryan@enigmacurry.com)"
+
+import json
+import logging
+import os
+import re
+import sys
+import time
+try:
+    import tracemalloc
+except ImportError:
+    # Python < 3.4
+    tracemalloc = None
+
+from .cache import bf
+from . import filter as _filter
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    # Python < 3.3
+    timer = time.time
+
+
+logger = logging.getLogger("blogofile.filter_bench")
+
+# The YAML header of a post:
+front_matter_regex = re.compile(r"\A---\s*\n.*?\n---\s*\n", re.DOTALL)
+
+
+def read_corpus(directory):
+    """Return the documents in directory (recursively), without the YAML
+    header of posts.
+    """
+    documents = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for fn in sorted(files):
+            path = os.path.join(root, fn)
+            try:
+                with open(path, "rb") as f:
+                    content = f.read().decode("utf-8")
+            except (IOError, UnicodeError) as e:
+                logger.warn("Skipping {0}: {1}".format(path, e))
+                continue
+            documents.append(front_matter_regex.sub("", content, 1))
+    return documents
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0-100) of values, by nearest rank.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(0, int(round(p / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def bench(run, documents, repeat=1):
+    """Benchmark run (a function of one document) over the documents,
+    repeat times.
+
+    Returns a dictionary of the results, see the module docstring.
+    """
+    latencies = []
+    start = timer()
+    for i in range(repeat):
+        for document in documents:
+            t = timer()
+            run(document)
+            latencies.append(timer() - t)
+    elapsed = timer() - start
+    size = sum(len(d.encode("utf-8")) for d in documents) * repeat
+    results = {
+        "docs": len(documents) * repeat,
+        "bytes": size,
+        "seconds": elapsed,
+        "docs_per_sec": len(latencies) / elapsed if elapsed else None,
+        "mb_per_sec": size / elapsed / 2 ** 20 if elapsed else None,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_memory": None,
+    }
+    if tracemalloc is not None:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            tracemalloc.clear_traces()
+            baseline = tracemalloc.get_traced_memory()[0]
+            for document in documents:
+                run(document)
+            results["peak_memory"] = \
+                tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+    return results
+
+
+def bench_filters(args):
+    """Benchmark the site's filters and the chains given on the command
+    line.
+    """
+    from . import config, plugin
+    config.init_interactive(args)
+    plugin.init_plugins()
+    errors = _filter.load_pending_filters(ignore_errors=True)
+    documents = read_corpus(args.corpus)
+    if not documents:
+        print("No documents to benchmark in: {0}".format(args.corpus))
+        sys.exit(1)
+    # Every filter module once, under its first name:
+    benchmarks = []
+    seen = set()
+    for name, filt in sorted(bf.config.filters.items()):
+        if name in errors:
+            continue
+        if "mod" in filt and id(filt.mod) not in seen:
+            seen.add(id(filt.mod))
+            benchmarks.append(("filter", name, filt.mod.run))
+    for chain in args.chain or []:
+        benchmarks.append(
+            ("chain", chain, _filter.FilterChain(chain).run))
+    output_cache, _filter.output_cache = _filter.output_cache, None
+    try:
+        results = []
+        for kind, name, run in benchmarks:
+            logger.info("Benchmarking {0}: {1}".format(kind, name))
+            try:
+                result = bench(run, documents, args.repeat)
+            except Exception as e:
+                logger.error("{0} {1} failed: {2}".format(kind, name, e))
+                result = {"error": str(e)}
+            result.update({"type": kind, "name": name})
+            results.append(result)
+        for name, error in sorted(errors.items()):
+            results.append({"type": "filter", "name": name,
+                            "error": str(error)})
+    finally:
+        _filter.output_cache = output_cache
+    if args.json:
+        print(json.dumps({"corpus": args.corpus, "repeat": args.repeat,
+                          "results": results}, indent=2, sort_keys=True))
+        return
+    row = "{0:<30} {1:>10} {2:>8} {3:>9} {4:>9} {5:>12}"
+    print(row.format("filter / chain", "docs/s", "MB/s", "p50 ms",
+                     "p99 ms", "peak memory"))
+    for result in results:
+        if "error" in result:
+            print("{0:<30} error: {1}".format(result["name"],
+                                               result["error"]))
+            continue
+        print(row.format(
+            result["name"][:30],
+            __format(result["docs_per_sec"], "{0:.1f}"),
+            __format(result["mb_per_sec"], "{0:.2f}"),
+            __format(result["p50_ms"], "{0:.3f}"),
+            __format(result["p99_ms"], "{0:.3f}"),
+            __format(result["peak_memory"], "{0:d}")))
+
+
+def __format(value, spec):
+    if value is None:
+        return "-"
+    return spec.format(value)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""An on-disk cache of filter outputs, shared between builds.
+
+Entries are content addressed: FilterChain keys them by a digest of the
+filter module, the filter's config, the versions of the packages it
+declares, and the input (or the key of the previous filter in the
+chain.) An entry's mtime is bumped each time it
+is used, and trim() evicts the least recently used entries until the
+cache fits in its maximum size.
+
+Only filters that are pure functions of their input and config (they
+don't use the date, read other files, ...) are cached. They opt in by
+setting "pure" to True in their config.
+"""
+
+__author__ = "Ryan McGuire (ryan@enigmacurry.com)"
+
+import logging
+import os
+import tempfile
+import threading
+
+from . import util
+
+
+logger = logging.getLogger("blogofile.filter_cache")
+
+
+class FilterCache(object):
+    """Filter outputs, stored as utf-8 files named by their key.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0}
+        self.__lock = threading.Lock()
+
+    def __path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def __count(self, stat):
+        with self.__lock:
+            self.stats[stat] += 1
+
+    def get(self, key):
+        """Return the cached output for key, or None.
+        """
+        path = self.__path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # The mtime records when the entry was last used:
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.__count("misses")
+            return None
+        self.__count("hits")
+        return data.decode("utf-8")
+
+    def set(self, key, content):
+        """Store the output for key.
+        """
+        if isinstance(content, bytes):
+            return
+        path = self.__path(key)
+        try:
+            util.mkdir(os.path.dirname(path))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(content.encode("utf-8"))
+            util.replace_file(tmp_path, path)
+        except (IOError, OSError, UnicodeError) as e:
+            # The output just doesn't get cached.
+            logger.warn("Cannot cache filter output: {0}".format(e))
+
+    def trim(self):
+        """Evict the least recently used entries until the cache is no
+        bigger than max_size. Returns the number of entries evicted.
+        """
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.directory):
+            for fn in files:
+                path = os.path.join(root, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        evicted = 0
+        if total <= self.max_size:
+            return evicted
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        logger.debug("Evicted {0} filter cache entries".format(evicted))
+        return evicted
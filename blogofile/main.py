@@ -8,6 +8,7 @@ from __future__ import print_function
 __author__ = "Ryan McGuire (ryan@enigmacurry.com)"
 
 import argparse
+import functools
 import locale
 import logging
 import os
@@ -17,14 +18,14 @@ import time
 import platform
 
 from . import __version__
-from . import server
 from . import config
 from . import util
 from . import filter as _filter
+from . import filter_bench
 from . import plugin
+from . import template
 from .cache import bf
 from .exception import SourceDirectoryNotFound
-from .writer import Writer
 
 
 locale.setlocale(locale.LC_ALL, '')
@@ -112,7 +113,32 @@ def _setup_build_parser(subparsers):
     parser = subparsers.add_parser(
         "build", add_help=False,
         help="Build the site from source.")
-    parser.set_defaults(func=do_build)
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="""
+            Only rebuild what changed since the last build
+            (same as setting site.incremental = True)
+            """)
+    parser.add_argument(
+        "-j", "--jobs", type=int, metavar="N",
+        help="""
+            Render templates with N processes, 0 means one per CPU
+            (same as setting site.jobs = N)
+            """)
+    parser.add_argument(
+        "--force-controller", action="append", metavar="NAME",
+        dest="force_controllers",
+        help="""
+            Run controller NAME even if its inputs haven't changed since
+            the last incremental build. Can be given more than once.
+            """)
+    defaults = {
+        "incremental": False,
+        "jobs": None,
+        "force_controllers": None,
+        "func": do_build,
+    }
+    parser.set_defaults(**defaults)
 
 
 def _setup_serve_parser(subparsers):
@@ -168,18 +194,52 @@ def _setup_plugins_parser(subparsers, parser_template):
     plugins_list.set_defaults(func=plugin.list_plugins)
     for p in plugin.iter_plugins():
         # Setup the plugin command parser, if it has one
-        try:
-            plugin_parser_setup = p.__dist__['command_parser_setup']
-        except KeyError:
+        if not p.has_commands:
             continue
+        # The plugin is only imported if its command is used:
         plugin_parser = subparsers.add_parser(
             p.__dist__['config_name'],
-            help="Plugin: " + p.__dist__['description'])
+            help="Plugin: " + p.__dist__['description'],
+            setup=functools.partial(
+                _setup_plugin_commands, p, parser_template))
         plugin_parser.add_argument(
             "--version", action="version",
             version="{name} plugin {version} by {author} -- {url}"
             .format(**p.__dist__))
-        plugin_parser_setup(plugin_parser, parser_template)
+
+
+def _setup_plugin_commands(p, parser_template, plugin_parser):
+    p.load().__dist__['command_parser_setup'](plugin_parser, parser_template)
+
+
+class _CommandParser(argparse.ArgumentParser):
+    """The parser of a sub-command.
+
+    setup, if given, is called with the parser the first time it's
+    needed, to add the rest of its arguments. Plugins' command parsers
+    are set up like this.
+    """
+    def __init__(self, *args, **kwargs):
+        self.__pending_setup = kwargs.pop("setup", None)
+        argparse.ArgumentParser.__init__(self, *args, **kwargs)
+
+    def __setup(self):
+        setup, self.__pending_setup = self.__pending_setup, None
+        if setup is not None:
+            setup(self)
+
+    def parse_known_args(self, args=None, namespace=None):
+        self.__setup()
+        return argparse.ArgumentParser.parse_known_args(
+            self, args, namespace)
+
+    def format_usage(self):
+        self.__setup()
+        return argparse.ArgumentParser.format_usage(self)
+
+    def format_help(self):
+        self.__setup()
+        return argparse.ArgumentParser.format_help(self)
 
 
 def _setup_filters_parser(subparsers):
@@ -193,6 +253,38 @@ def _setup_filters_parser(subparsers):
         "list",
         help="List all the filters installed")
     filters_list.set_defaults(func=_filter.list_filters)
+    filters_bench = filter_subparsers.add_parser(
+        "bench",
+        help="Benchmark the filters against a corpus of documents")
+    filters_bench.add_argument(
+        "--chain", action="append", metavar="CHAIN",
+        help="""
+            A filter chain to benchmark too, e.g.
+            "syntax_highlight, markdown". Can be given more than once.
+            """)
+    filters_bench.add_argument(
+        "--corpus", default="_posts",
+        help="Directory of documents to run through (%(default)s)")
+    filters_bench.add_argument(
+        "--repeat", type=int, default=1,
+        help="Times to run through the corpus (%(default)s)")
+    filters_bench.add_argument(
+        "--json", action="store_true",
+        help="Print the results as JSON")
+    filters_bench.set_defaults(func=filter_bench.bench_filters)
+
+
+def _setup_templates_parser(subparsers):
+    """Set up the parser for the templates sub-command.
+    """
+    parser = subparsers.add_parser(
+        "templates",
+        help="Template tools")
+    template_subparsers = parser.add_subparsers()
+    templates_compile = template_subparsers.add_parser(
+        "compile",
+        help="Compile all the templates into the compiled template cache")
+    templates_compile.set_defaults(func=template.compile_templates)
 
 
 def setup_command_parser():
@@ -200,7 +292,8 @@ def setup_command_parser():
     """
     parser_template = _setup_parser_template()
     parser = argparse.ArgumentParser(parents=[parser_template])
-    subparsers = parser.add_subparsers(title='sub-commands')
+    subparsers = parser.add_subparsers(title='sub-commands',
+                                       parser_class=_CommandParser)
     _setup_help_parser(subparsers)
     _setup_init_parser(subparsers)
     _setup_build_parser(subparsers)
@@ -208,6 +301,7 @@ def setup_command_parser():
     _setup_info_parser(subparsers)
     _setup_plugins_parser(subparsers, parser_template)
     _setup_filters_parser(subparsers)
+    _setup_templates_parser(subparsers)
     return parser, subparsers
 
 
@@ -314,6 +408,7 @@ def do_help(args, parser, subparsers):
 
 
 def do_serve(args):
+    from . import server
     config.init_interactive(args)
     bfserver = server.Server(args.PORT, args.IP_ADDR)
     bfserver.start()
@@ -325,8 +420,15 @@ def do_serve(args):
 
 
 def do_build(args, load_config=True):
+    from .writer import Writer
     if load_config:
         config.init_interactive(args)
+    if getattr(args, "incremental", False):
+        config.site.incremental = True
+    if getattr(args, "jobs", None) is not None:
+        config.site.jobs = args.jobs
+    if getattr(args, "force_controllers", None):
+        config.site.force_controllers = args.force_controllers
     output_dir = util.path_join("_site", util.fs_site_path_helper())
     writer = Writer(output_dir=output_dir)
     logger.debug("Running user's pre_build() function...")
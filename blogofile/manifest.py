@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""Build manifest for incremental builds.
+
+The manifest remembers, for every source file the writer processed,
+its size, mtime and content hash along with the outputs it produced in
+the _site directory. It also stores a digest of the site configuration
+(_config.py, the _templates directory, and the blogofile version.)
+
+On the next incremental build, static files that haven't changed are
+skipped, their previous outputs are kept, and outputs that nobody
+produced this time around are deleted. Templates are always rendered
+again, as their output depends on the state controllers set up in bf
+as well as on their source. If the configuration digest
+changed, the previous manifest is discarded and a full build is done.
+
+Controllers that declare their inputs are recorded as pseudo sources
+too, with a digest of those inputs instead of a file's.
+"""
+
+__author__ = "Ryan McGuire (ryan@enigmacurry.com)"
+
+import hashlib
+import json
+import logging
+import os
+import threading
+try:
+    import contextvars
+except ImportError:
+    # Python < 3.7
+    contextvars = None
+
+from . import util
+
+
+logger = logging.getLogger("blogofile.manifest")
+
+# Pseudo source that collects everything written while controllers run:
+CONTROLLERS = "<controllers>"
+
+
+def tree_digest(paths):
+    """Return a single digest for a set of files and directories.
+
+    Directories are walked recursively. Paths that don't exist are
+    ignored, but still contribute their name so that creating them
+    changes the digest.
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        h.update(path.encode("utf-8"))
+        if os.path.isfile(path):
+            h.update(util.file_digest(path).encode("utf-8"))
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for fn in sorted(files):
+                    p = os.path.join(root, fn)
+                    h.update(p.encode("utf-8"))
+                    h.update(util.file_digest(p).encode("utf-8"))
+    return h.hexdigest()
+
+
+def load_outputs(path):
+    """Return the outputs a previous build recorded with save_outputs:
+    (outputs, controller_outputs), both empty if it didn't.
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return set(), set()
+    return (set(data.get("outputs", [])),
+            set(data.get("controller_outputs", [])))
+
+
+def save_outputs(path, outputs, controller_outputs=()):
+    """Record the outputs (paths relative to _site) of a build, and the
+    files controllers wrote without recording them as outputs.
+    """
+    util.mkdir(os.path.split(path)[0])
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"outputs": sorted(outputs),
+                   "controller_outputs": sorted(controller_outputs)}, f)
+    util.replace_file(tmp_path, path)
+
+
+def snapshot(directory):
+    """Return {path relative to directory: (size, mtime, inode)} for the
+    files in directory.
+    """
+    files = {}
+    for root, dirs, fns in os.walk(directory):
+        rel_root = os.path.relpath(root, directory)
+        for fn in fns:
+            try:
+                st = os.lstat(os.path.join(root, fn))
+            except OSError:
+                continue
+            mtime = getattr(st, "st_mtime_ns", st.st_mtime)
+            files[os.path.normpath(os.path.join(rel_root, fn))] = \
+                (st.st_size, mtime, st.st_ino)
+    return files
+
+
+class Manifest(object):
+    """The set of sources and outputs of a single build.
+    """
+    version = 1
+
+    def __init__(self, path, config_digest):
+        self.path = path
+        self.config_digest = config_digest
+        # source path -> entry, as recorded by the previous build:
+        self.previous = {}
+        # source path -> entry, for the build in progress:
+        self.sources = {}
+        # The source being processed, by each thread (and coroutine):
+        if contextvars is not None:
+            self.__current = contextvars.ContextVar(
+                "current_source", default=None)
+        else:
+            self.__local = threading.local()
+
+    @property
+    def current(self):
+        if contextvars is not None:
+            return self.__current.get()
+        return getattr(self.__local, "current", None)
+
+    @current.setter
+    def current(self, source):
+        if contextvars is not None:
+            self.__current.set(source)
+        else:
+            self.__local.current = source
+
+    def load(self):
+        """Load the manifest of the previous build, if it's still valid.
+
+        Returns True if a usable manifest was found.
+        """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if data.get("version") != self.version:
+            return False
+        if data.get("config_digest") != self.config_digest:
+            logger.info("Configuration has changed since the last build, "
+                        "doing a full rebuild")
+            return False
+        self.previous = data.get("sources", {})
+        return True
+
+    def save(self):
+        """Write the manifest for the build that just completed.
+        """
+        for entry in self.sources.values():
+            entry["outputs"] = sorted(set(entry["outputs"]))
+        util.mkdir(os.path.split(self.path)[0])
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version,
+                       "config_digest": self.config_digest,
+                       "sources": self.sources}, f, sort_keys=True)
+        util.replace_file(tmp_path, self.path)
+
+    def __stat_entry(self, source):
+        st = os.stat(source)
+        prev = self.previous.get(source)
+        if prev and prev.get("size") == st.st_size and \
+                prev.get("mtime") == st.st_mtime:
+            # Same size and mtime, trust the previous hash:
+            digest = prev["digest"]
+        else:
+            digest = util.file_digest(source)
+        return {"size": st.st_size, "mtime": st.st_mtime, "digest": digest}
+
+    def is_unchanged(self, source, output_dir, digest=None):
+        """Is the source identical to last time, with all its outputs
+        still present in output_dir?
+
+        digest is the digest of a pseudo source, files are hashed.
+        """
+        prev = self.previous.get(source)
+        if prev is None or "digest" not in prev:
+            return False
+        if digest is None:
+            try:
+                digest = self.__stat_entry(source)["digest"]
+            except OSError:
+                return False
+        if digest != prev["digest"]:
+            return False
+        for out in prev["outputs"]:
+            if not os.path.exists(util.path_join(output_dir, out)):
+                return False
+        return True
+
+    def keep(self, source):
+        """Carry a source and its outputs over from the previous build.
+        """
+        self.sources[source] = self.previous[source]
+
+    def begin(self, source, digest=None):
+        """Start recording the outputs produced on behalf of source (in
+        this thread or coroutine.)
+
+        digest is the digest of a pseudo source, files are hashed.
+        """
+        if digest is None:
+            entry = self.__stat_entry(source)
+        else:
+            entry = {"digest": digest}
+        entry["outputs"] = []
+        self.sources[source] = entry
+        self.current = source
+
+    def end(self):
+        self.current = None
+
+    def add_output(self, path):
+        """Record that path (relative to the output dir) was written.
+        """
+        source = self.current or CONTROLLERS
+        entry = self.sources.setdefault(source, {"outputs": []})
+        entry["outputs"].append(path)
+
+    def outputs(self):
+        """All the outputs of the build in progress.
+        """
+        outputs = set()
+        for entry in self.sources.values():
+            outputs.update(entry["outputs"])
+        return outputs
+
+    def stale_outputs(self):
+        """Outputs of the previous build that weren't produced this time.
+        """
+        previous = set()
+        for entry in self.previous.values():
+            previous.update(entry["outputs"])
+        return sorted(previous - self.outputs())
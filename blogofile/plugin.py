@@ -3,15 +3,17 @@ from __future__ import print_function
 import logging
 import os
 import os.path
-import pkg_resources
 import sys
 
-from mako.lookup import TemplateLookup
-
 from . import controller
+from . import event_loop
 from . import filter as _filter
+from . import plugin_index
+from . import template
 from .cache import bf
+from .cache import Cache
 from .cache import HierarchicalCache
+from .cache import merge_settings
 
 
 logger = logging.getLogger("blogofile.plugin")
@@ -23,16 +25,28 @@ default_plugin_config = {
 
 reserved_attributes = ["mod", "filters", "controllers", "site_src"]
 
+# config_name -> plugin_index.PluginInfo, of the installed plugins:
+_installed = {}
+# config_name -> PluginStub, of the installed plugins:
+_stubs = {}
+
 
 def iter_plugins():
-    for plugin in pkg_resources.iter_entry_points("blogofile.plugins"):
-        yield plugin.load()
+    """Iterate over the installed plugins, without importing them.
+
+    Each one has the plugin's __dist__ metadata, and a load() method
+    that imports the plugin module.
+    """
+    for plugin in plugin_index.get_plugins():
+        yield plugin
 
 
 def get_by_name(name):
+    """Return the module of the plugin called name, or None.
+    """
     for plugin in iter_plugins():
         if plugin.__dist__['config_name'] == name:
-            return plugin
+            return plugin.load()
 
 
 def list_plugins(args):
@@ -68,15 +82,94 @@ def check_plugin_config(module):
     #             .format(attr)
 
 
+class PluginStub(HierarchicalCache):
+    """The config of an installed plugin, until the plugin is loaded.
+
+    It collects the settings _config.py makes for the plugin. As soon as
+    it's enabled, the plugin is imported and its defaults are filled in
+    where nothing was set yet, so _config.py can read them.
+    """
+    def __setattr__(self, attr, value):
+        HierarchicalCache.__setattr__(self, attr, value)
+        if attr == "enabled" and value:
+            self.__enabled()
+
+    def __setitem__(self, key, item):
+        HierarchicalCache.__setitem__(self, key, item)
+        if key == "enabled" and item:
+            self.__enabled()
+
+    def __enabled(self):
+        for name, stub in _stubs.items():
+            if stub is self:
+                plugin = _installed[name].load()
+                check_plugin_config(plugin)
+                _fill_defaults(self, plugin.config)
+
+
+def _fill_defaults(stub, config):
+    """Fill in the settings of config that aren't set in stub.
+
+    Nested caches of the stub are filled in too, those it doesn't have
+    are shared with config.
+    """
+    for k, v in config.items():
+        if k not in stub:
+            Cache.__setitem__(stub, k, v)
+        elif isinstance(stub[k], HierarchicalCache) and \
+                isinstance(v, HierarchicalCache) and stub[k] is not v:
+            _fill_defaults(stub[k], v)
+
+
+def _replaced_caches(stub, config):
+    """Return the caches of a stub (itself, and the nested ones) with the
+    caches of config that replace them: [(stub cache, config cache)]
+    """
+    replaced = [(stub, config)]
+    for k, v in stub.items():
+        if isinstance(v, HierarchicalCache) and \
+                isinstance(config.get(k), HierarchicalCache) and \
+                config[k] is not v:
+            replaced.extend(_replaced_caches(v, config[k]))
+    return replaced
+
+
 def load_plugins():
-    """Discover all the installed plugins and load them into bf.config.plugins
+    """Discover all the installed plugins, without importing them.
 
-    Load the module itself, the controllers, and the filters.
+    Each one gets a PluginStub in bf.config.plugins, that collects the
+    settings made for it in _config.py. Once those are known,
+    load_enabled_plugins loads the enabled plugins.
     """
+    _installed.clear()
+    _stubs.clear()
     for plugin in iter_plugins():
-        namespace = bf.config.plugins[plugin.__dist__["config_name"]] = \
-            getattr(plugin, "config")
+        name = plugin.__dist__["config_name"]
+        _installed[name] = plugin
+        _stubs[name] = bf.config.plugins[name] = PluginStub()
+
+
+def load_enabled_plugins():
+    """Load the enabled plugins into bf.config.plugins
+
+    Load the module itself, the controllers, and the filters. Settings
+    made in _config.py override the plugin's defaults. Plugins that
+    aren't enabled stay stubs.
+
+    Returns the replaced stubs (and the nested caches in them), and
+    their plugin's config: [(stub, config)]
+    """
+    replaced = []
+    for name, namespace in list(bf.config.plugins.items()):
+        if "mod" in namespace or not namespace.get("enabled") or \
+                name not in _installed:
+            continue
+        plugin = _installed[name].load()
         check_plugin_config(plugin)
+        stub = namespace
+        namespace = bf.config.plugins[name] = getattr(plugin, "config")
+        merge_settings(namespace, stub)
+        replaced.extend(_replaced_caches(stub, namespace))
         namespace.mod = plugin
         plugin_dir = os.path.dirname(sys.modules[plugin.__name__].__file__)
         # Load filters
@@ -88,6 +181,7 @@ def load_plugins():
             namespace=namespace.controllers,
             directory=os.path.join(plugin_dir, "site_src", "_controllers"),
             defaults={"enabled": True})
+    return replaced
 
 
 def init_plugins():
@@ -99,17 +193,25 @@ def init_plugins():
                 sys.exit(1)
             logger.info("Initializing plugin: {0}".format(
                     plugin.mod.__dist__['config_name']))
-            plugin.mod.init()
+            event_loop.call(plugin.mod.init)
             for name, filter_ns in list(plugin.filters.items()):
                 # Filters from plugins load in their own namespace, but
                 # they also load in the regular filter namespace as long as
                 # there isn't already a filter with that name. User filters
                 # from the _filters directory are loaded after plugins, so
                 # they are overlaid on top of these values and take
-                # precedence.
+                # precedence. They replace the built-in filters, but
+                # keep the settings made for those in _config.py.
                 if name not in bf.config.filters:
                     bf.config.filters[name] = filter_ns
-                elif "mod" not in bf.config.filters[name]:
+                elif _filter.is_builtin(bf.config.filters[name]) and \
+                        _filter.is_pending(bf.config.filters[name]):
+                    settings = dict(bf.config.filters[name])
+                    del settings["module_path"]
+                    filter_ns.update(settings)
+                    bf.config.filters[name] = filter_ns
+                elif "mod" not in bf.config.filters[name] and \
+                        not _filter.is_pending(bf.config.filters[name]):
                     filter_ns.update(bf.config.filters[name])
                     bf.config.filters[name] = filter_ns
 
@@ -120,7 +222,7 @@ class PluginTools(object):
     def __init__(self, module_name):
         self.module = sys.modules[module_name]
         self.namespace = self.module.config
-        self.template_lookup = self.__get_template_lookup()
+        self.__template_lookup = None
         self.logger = logging.getLogger(
             "blogofile.plugins.{0}".format(module_name))
 
@@ -134,15 +236,47 @@ class PluginTools(object):
         bf.template.materialize_template(template_name, location, attrs=attrs,
                                          lookup=lookup, caller=self.module)
 
+    def materialize_template_async(self, template_name, location, attrs={},
+                                   lookup=None):
+        """Just like materialize_template, but returns an awaitable, for
+        asynchronous controllers. See bf.event_loop.materialize_template.
+        """
+        if lookup == None:
+            lookup = self.template_lookup
+        return event_loop.materialize_template(
+            template_name, location, attrs=attrs, lookup=lookup,
+            caller=self.module)
+
+    def materialize_many(self, template_name, pages, lookup=None,
+                         workers=None):
+        """Just like bf.template.materialize_many, however, this uses the
+        blog template lookup by default.
+        """
+        if lookup == None:
+            lookup = self.template_lookup
+        bf.template.materialize_many(template_name, pages, lookup=lookup,
+                                     caller=self.module, workers=workers)
+
     def add_template_dir(self, path):
         self.template_lookup.directories.append(path)
 
+    @property
+    def template_lookup(self):
+        """The plugin's Mako lookup, created (importing Mako) when it's
+        first used.
+        """
+        if self.__template_lookup is None:
+            self.__template_lookup = self.__get_template_lookup()
+        return self.__template_lookup
+
     def __get_template_lookup(self):
+        from mako.lookup import TemplateLookup
         return TemplateLookup(
             directories=[
                 os.path.join(self.get_src_dir(), "_templates"), "_templates"],
             input_encoding='utf-8', output_encoding='utf-8',
-            encoding_errors='replace')
+            encoding_errors='replace',
+            modulename_callable=template.mako_module_filename)
 
     def get_src_dir(self):
         return os.path.join(
@@ -150,11 +284,15 @@ class PluginTools(object):
             "site_src")
 
     def initialize_controllers(self):
-        for name, controller in list(self.module.config.controllers.items()):
+        controller.load_pending_controllers(
+            self.module.config.controllers, only_enabled=False)
+        for name, c in list(self.module.config.controllers.items()):
             self.logger.info("Initializing controller: {0}".format(name))
-            controller.mod.init()
+            event_loop.call(c.mod.init)
 
     def run_controllers(self):
-        for name, controller in list(self.module.config.controllers.items()):
+        controller.load_pending_controllers(
+            self.module.config.controllers, only_enabled=False)
+        for name, c in list(self.module.config.controllers.items()):
             self.logger.info("Running controller: {0}".format(name))
-            controller.mod.run()
+            event_loop.call(c.mod.run)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""An index of the installed plugins, cached between runs.
+
+Plugins are found through their "blogofile.plugins" entry points. The
+index records each one's entry point and __dist__ metadata (the parts
+that can be saved as JSON), so listing plugins or looking one up by
+name doesn't import any of them, nor pkg_resources.
+
+The index is kept in $XDG_CACHE_HOME/blogofile/plugin_index.json
+(~/.cache by default). It's built again, importing every plugin once,
+whenever one of the directories on sys.path (site-packages, where
+plugins get installed) has changed since.
+"""
+
+__author__ = "Ryan McGuire (ryan@enigmacurry.com)"
+
+import importlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from . import util
+
+
+logger = logging.getLogger("blogofile.plugin_index")
+
+group = "blogofile.plugins"
+version = 1
+
+# The index of this process, once it's loaded:
+_plugins = None
+
+
+class PluginInfo(object):
+    """An installed plugin, known by its metadata until it's loaded.
+    """
+    def __init__(self, entry_point, value, dist, has_commands=False):
+        self.entry_point = entry_point
+        # "module" or "module:attribute", as in the entry point:
+        self.value = value
+        self.__dist__ = dist
+        self.has_commands = has_commands
+        self.module = None
+
+    def load(self):
+        """Import the plugin module.
+        """
+        if self.module is None:
+            module_name, _, attrs = self.value.partition(":")
+            module = importlib.import_module(module_name.strip())
+            for attr in attrs.strip().split(".") if attrs.strip() else []:
+                module = getattr(module, attr)
+            self.module = module
+        return self.module
+
+    def as_json(self):
+        return {"entry_point": self.entry_point, "value": self.value,
+                "dist": self.__dist__, "has_commands": self.has_commands}
+
+
+def get_index_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "blogofile", "plugin_index.json")
+
+
+def __path_mtimes():
+    """The mtimes of the directories on sys.path, which change when
+    packages are installed into them.
+    """
+    mtimes = {}
+    for path in sys.path:
+        if not path:
+            continue
+        try:
+            mtimes[os.path.abspath(path)] = os.stat(path).st_mtime
+        except OSError:
+            pass
+    return mtimes
+
+
+def __entry_points():
+    """Return (name, value) of the blogofile.plugins entry points.
+    """
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources
+        return [(ep.name, ep.module_name +
+                 (":" + ".".join(ep.attrs) if ep.attrs else ""))
+                for ep in pkg_resources.iter_entry_points(group)]
+    try:
+        eps = metadata.entry_points(group=group)
+    except TypeError:
+        # Python < 3.10
+        eps = metadata.entry_points().get(group, ())
+    found = {}
+    for ep in eps:
+        # A distribution found twice on sys.path is listed twice:
+        found.setdefault(ep.name, ep.value)
+    return sorted(found.items())
+
+
+def __json_metadata(dist):
+    """The parts of a plugin's __dist__ that can be saved in the index.
+    """
+    metadata = {}
+    for k, v in dist.items():
+        if v is None or isinstance(v, (str, int, float, bool)):
+            metadata[k] = v
+    return metadata
+
+
+def build_index():
+    """Find the installed plugins, importing each of them once.
+
+    Returns (the plugins, whether they were all imported fine.)
+    """
+    plugins = []
+    complete = True
+    for name, value in __entry_points():
+        info = PluginInfo(name, value, {})
+        try:
+            dist = info.load().__dist__
+        except Exception as e:
+            logger.error("Cannot load plugin {0}: {1}".format(name, e))
+            complete = False
+            continue
+        info.__dist__ = __json_metadata(dist)
+        info.has_commands = "command_parser_setup" in dist
+        plugins.append(info)
+    return plugins, complete
+
+
+def __read_index(path, key):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if data.get("version") != version or data.get("key") != key:
+        return None
+    return [PluginInfo(**p) for p in data["plugins"]]
+
+
+def __write_index(path, key, plugins):
+    data = {"version": version, "key": key,
+            "plugins": [p.as_json() for p in plugins]}
+    try:
+        util.mkdir(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        util.replace_file(tmp_path, path)
+    except (IOError, OSError) as e:
+        # It just gets built again next time.
+        logger.warn("Cannot save the plugin index: {0}".format(e))
+
+
+def get_plugins():
+    """Return the PluginInfo of every installed plugin.
+    """
+    global _plugins
+    if _plugins is None:
+        path = get_index_path()
+        key = {"python": sys.executable, "paths": __path_mtimes()}
+        plugins = __read_index(path, key)
+        if plugins is None:
+            logger.debug("Building the plugin index: " + path)
+            plugins, complete = build_index()
+            if complete:
+                __write_index(path, key, plugins)
+        _plugins = plugins
+    return list(_plugins)
+
+
+def reset():
+    """Forget the index of this process, it's read again when needed.
+    """
+    global _plugins
+    _plugins = None
@@ -32,10 +32,63 @@ site.author = None
 # Use hard links when copying files. This saves disk space and shortens
 # the time to build sites that copy lots of static files.
 # This is turned off by default though, because hard links are not
-# necessarily what every user wants.
+# necessarily what every user wants. Same as site.copy_mode = "hardlink"
 site.use_hard_links = False
+# How static (non-template) files get into _site:
+#  "copy"     - a regular copy
+#  "hardlink" - hard link to the source file, copy if that's impossible
+#  "reflink"  - copy-on-write clone, on filesystems that support it
+#               (btrfs, XFS), copy otherwise
+#  "symlink"  - symbolic link to the source file
+#  "auto"     - skip files whose size and mtime match the destination,
+#               otherwise reflink or copy in the kernel. With the "wipe"
+#               output mode, _site is then kept between builds, like
+#               with site.write_if_changed
+site.copy_mode = "copy"
+# Number of threads copying static files, 0 means one per CPU
+site.copy_threads = 4
 #Warn when we're overwriting a file?
 site.overwrite_warning = True
+# Incremental builds only copy the static files that changed since the
+# last build (templates are always rendered), and remove the outputs of
+# files that have since been deleted.
+# Any change to _config.py or the _templates directory triggers a full
+# rebuild. This can also be turned on with `blogofile build --incremental`
+site.incremental = False
+# How the _site directory is updated:
+#  "wipe" - delete everything in _site, then build into it
+#  "sync" - build into a staging directory (in site.cache_dir), then move
+#           only the files that changed into _site, each with an atomic
+#           rename, and remove the outputs of the previous build that
+#           are no longer produced.
+#           The web server never sees a half-built site, and unchanged
+#           files keep their mtime.
+site.output_mode = "wipe"
+# Compare each output with the existing file (size first, then a digest)
+# and leave identical files untouched, so their mtime doesn't change and
+# rsync or a CDN doesn't see them as modified. With the "wipe" output
+# mode, _site is then no longer emptied first; outputs of the previous
+# build that are no longer produced are removed at the end of the build
+# instead. Files that blogofile didn't record writing (e.g. written by a
+# controller without bf.writer.add_output) are never removed.
+site.write_if_changed = False
+# Number of processes used to render the templates in the site directory.
+# 0 means one per CPU. Can also be set with `blogofile build --jobs N`
+site.jobs = 1
+# Directory where blogofile keeps data between builds (like the
+# incremental build manifest.) It is never copied into _site.
+site.cache_dir = ".blogofile-cache"
+# Directory where the outputs of filters (markdown, rst, ...) are kept
+# between builds, and its maximum size in bytes. Only filters whose output
+# is a function of their input and config alone, and that say so by
+# setting "pure" to True in their config, are cached. None turns the
+# cache off.
+site.filter_cache_dir = ".blogofile-cache/filters"
+site.filter_cache_size = 256 * 1024 * 1024
+# Directory where the compiled _filters and _controllers modules are kept,
+# so they aren't compiled again until they change (and no .pyc files end
+# up next to them.) None turns it off.
+site.bytecode_cache_dir = ".blogofile-cache/pyc"
 # These are the default ignore patterns for excluding files and dirs
 # from the _site directory
 # These can be strings or compiled patterns.
@@ -55,10 +108,13 @@ site.file_ignore_patterns = [
     ".*/.(git|hg)ignore$",
     # CVS dir
     ".*/CVS$",
+    # Blogofile cache dir
+    r".*/\.blogofile-cache$",
     ]
 
 from blogofile.template import MakoTemplate, JinjaTemplate, \
     MarkdownTemplate, RestructuredTextTemplate, TextileTemplate
+from blogofile.filter import FilterChain
 #The site base template filename:
 site.base_template = "site.mako"
 #Template engines mapped to file extensions:
@@ -71,6 +127,11 @@ templates.engines = HC(
     textile = TextileTemplate
     )
 
+# Directory where compiled templates are kept between builds, so they are
+# only compiled again when their source changes. None turns it off.
+# `blogofile templates compile` fills it without building the site.
+templates.cache_dir = ".blogofile-cache/templates"
+
 #Template content blocks:
 templates.content_blocks = HC(
     mako = HC(
@@ -85,8 +146,8 @@ templates.content_blocks = HC(
         pattern = re.compile("_^"), #Regex that matches nothing
         replacement = "~~!`FILTER_CONTENT_HERE`!~~",
         default_chains = HC(
-            markdown = "syntax_highlight, markdown",
-            rst = "syntax_highlight, rst"
+            markdown = FilterChain("syntax_highlight, markdown"),
+            rst = FilterChain("syntax_highlight, rst")
             )
         )
     )
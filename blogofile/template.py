@@ -4,20 +4,27 @@ Template abstraction for Blogofile to support multiple engines.
 
 Templates are dictionaries. Any key/value pairs stored are supplied to
 the underlying template as name/values.
+
+Compiled templates are kept on disk under templates.cache_dir, so later
+builds don't have to compile them again: Mako modules are named after
+the template source they were compiled from, and Jinja2 uses its
+bytecode cache, which checks the source checksum itself.
+
+Mako and Jinja2 are only imported once a template of theirs is used.
 """
 from __future__ import print_function
+import contextlib
 import copy
+import hashlib
+import io
+import itertools
 import logging
 import os.path
 import re
 import sys
 import tempfile
-
-import jinja2
-
-import mako
-import mako.lookup
-import mako.template
+import threading
+from collections import OrderedDict
 
 from . import filter as _filter
 from . import util
@@ -36,8 +43,171 @@ class TemplateEngineError(Exception):
     pass
 
 
+def get_cache_dir(engine_name):
+    """Return the directory for an engine's compiled templates, creating
+    it if needed, or None if templates.cache_dir is turned off.
+    """
+    cache_dir = bf.config.templates.cache_dir
+    if not cache_dir:
+        return None
+    path = os.path.join(cache_dir, engine_name)
+    util.mkdir(path)
+    return path
+
+
+def source_key(uri, src):
+    """Cache key for a template: a digest of its uri and source.
+    """
+    if not isinstance(src, bytes):
+        src = src.encode("utf-8")
+    h = hashlib.sha1(uri.encode("utf-8"))
+    h.update(b"\0")
+    h.update(src)
+    return h.hexdigest()
+
+
+def __freshen_module(module_filename, filename):
+    # Mako recompiles a module that is older than its template file.
+    # The module name already guarantees that the source is the same, so
+    # don't let a checkout that only touched the template invalidate it.
+    try:
+        if os.path.getmtime(module_filename) < os.path.getmtime(filename):
+            os.utime(module_filename, None)
+    except OSError:
+        pass
+
+
+def mako_module_filename(filename, uri):
+    """modulename_callable for Mako lookups.
+
+    Name the compiled module after the template's uri and source, so that
+    a module is only ever reused for exactly the source it came from.
+    """
+    cache_dir = get_cache_dir("mako")
+    if cache_dir is None:
+        return None
+    with open(filename, "rb") as f:
+        module_filename = os.path.join(
+            cache_dir, source_key(uri, f.read()) + ".py")
+    __freshen_module(module_filename, filename)
+    return module_filename
+
+
+def compile_mako(lookup, src=None, filename=None):
+    """Compile a Mako template passed as source, or as a file path rather
+    than a name in the lookup, through the compiled template cache.
+    """
+    if src is None:
+        with open(filename, "rb") as f:
+            src = f.read().decode("utf-8")
+    import mako.template
+    cache_dir = get_cache_dir("mako")
+    if cache_dir is None:
+        return mako.template.Template(
+            src, output_encoding="utf-8", lookup=lookup)
+    key = source_key("", src)
+    if filename is None:
+        # Mako only caches modules of templates that are files:
+        filename = os.path.join(cache_dir, key + ".mako")
+        if not os.path.exists(filename):
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(src.encode("utf-8"))
+            util.replace_file(tmp_path, filename)
+    module_filename = os.path.join(cache_dir, key + ".py")
+    __freshen_module(module_filename, filename)
+    # A memory: uri, like Mako gives templates passed as text, so that
+    # relative <%inherit>s and <%include>s resolve the same way:
+    return mako.template.Template(
+        uri="memory:" + key, filename=filename,
+        module_filename=module_filename, input_encoding="utf-8",
+        output_encoding="utf-8", lookup=lookup)
+
+
+def compile_jinja(environment, src):
+    """Compile Jinja2 source through the environment's bytecode cache.
+    """
+    bcc = environment.bytecode_cache
+    if bcc is None:
+        return environment.from_string(src)
+    bucket = bcc.get_bucket(environment, source_key("", src), None, src)
+    code = bucket.code
+    if code is None:
+        code = environment.compile(src)
+        bucket.code = code
+        bcc.set_bucket(bucket)
+    return environment.template_class.from_code(
+        environment, code, environment.make_globals(None), None)
+
+
+class CompiledTemplateCache(object):
+    """An LRU of the compiled templates that were given as file paths.
+
+    Templates are keyed by their lookup, absolute path and mtime, so a
+    template that a controller renders thousands of times is only
+    compiled (or loaded from templates.cache_dir) once per build, and an
+    edited template is picked up by the next build.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.__templates = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, path, lookup, compile_template):
+        """Return the compiled template for path, calling
+        compile_template() to compile it if it isn't cached.
+        """
+        st = os.stat(path)
+        return self.__get(
+            (lookup, os.path.abspath(path), st.st_mtime, st.st_size),
+            compile_template)
+
+    def get_src(self, src, lookup, compile_template):
+        """Return the compiled template for the template source src.
+        """
+        return self.__get((lookup, source_key("", src)), compile_template)
+
+    def __get(self, key, compile_template):
+        with self.__lock:
+            try:
+                compiled = self.__templates.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.__templates[key] = compiled
+                return compiled
+        compiled = compile_template()
+        with self.__lock:
+            self.__templates[key] = compiled
+            while len(self.__templates) > self.maxsize:
+                self.__templates.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self.__lock:
+            self.__templates.clear()
+
+
+compiled_templates = CompiledTemplateCache()
+
+# (base engine name, template engine name, base template source digest)
+# -> base template converted to the template engine, for this build:
+converted_base_templates = {}
+__converted_base_templates_lock = threading.Lock()
+
+# Held while a template renders: rendering sets up bf.template_context,
+# so controllers running in threads take turns.
+render_lock = threading.RLock()
+
+
 class Template(dict):
     name = "base"
+    # Can the engine take bf_base_template as source, in
+    # base_template_src, rather than as a file path?
+    loads_base_template_src = False
+    base_template_src = None
+    # Have site.template_vars already been put in the template's attrs?
+    template_vars_added = False
 
     def __init__(self, template_name, caller=None):
         dict.__init__(self)
@@ -51,22 +221,73 @@ class Template(dict):
         raise NotImplementedError(
             "Template base class cannot be used directly")
 
-    def write(self, path, rendered):
+    def stream(self, path):
+        """Render the template to the specified path on disk, writing
+        the output as it is produced rather than holding all of it in
+        memory. Returns nothing.
+
+        Engines that can't do that render the whole output first.
+        """
+        self.render(path)
+
+    def __prepare_output(self, path):
         path = util.path_join(bf.writer.output_dir, path)
+        rel_path = os.path.relpath(path, bf.writer.output_dir)
         # Create the parent directories if they don't exist:
         util.mkdir(os.path.split(path)[0])
-        if bf.config.site.overwrite_warning and os.path.exists(path):
+        if bf.config.site.overwrite_warning and \
+                bf.writer.already_written(rel_path):
             logger.warn("Location is used more than once: {0}".format(path))
+        bf.writer.add_output(rel_path)
+        return path
+
+    @contextlib.contextmanager
+    def open_output(self, path, errors="strict"):
+        """Open a path in the _site dir for a streaming render, as a
+        utf-8 text file.
+
+        With site.write_if_changed the output goes to a temporary file
+        first, which only replaces the existing file if it's different.
+        """
+        path = self.__prepare_output(path)
+        if bf.config.site.write_if_changed:
+            out_path = "{0}.{1}.tmp".format(path, os.getpid())
+        else:
+            out_path = path
+        try:
+            with io.open(out_path, "w", encoding="utf-8", errors=errors,
+                         newline="") as f:
+                yield f
+        except:
+            if out_path != path and os.path.exists(out_path):
+                os.remove(out_path)
+            raise
+        if out_path != path:
+            if util.same_contents(path, out_path):
+                os.remove(out_path)
+                bf.writer.stats["unchanged"] += 1
+                return
+            util.replace_file(out_path, path)
+        bf.writer.stats["written"] += 1
+
+    def write(self, path, rendered):
+        path = self.__prepare_output(path)
+        if bf.config.site.write_if_changed and \
+                util.same_contents(path, rendered):
+            bf.writer.stats["unchanged"] += 1
+            return
         with open(path, "wb") as f:
             f.write(rendered)
+        bf.writer.stats["written"] += 1
 
     def render_prep(self, path):
         """Gather all the information we want to provide to the
         template before rendering.
         """
-        for name, obj in list(bf.config.site.template_vars.items()):
-            if name not in self:
-                self[name] = obj
+        if not self.template_vars_added:
+            for name, obj in list(bf.config.site.template_vars.items()):
+                if name not in self:
+                    self[name] = obj
         # Create a context object that is fresh for each template render:
         bf.template_context = Cache(**self)
         bf.template_context.template_name = self.template_name
@@ -86,10 +307,14 @@ class Template(dict):
 
 class MakoTemplate(Template):
     name = "mako"
+    loads_base_template_src = True
     template_lookup = None
 
     def __init__(self, template_name, caller=None, lookup=None, src=None):
+        import mako.lookup
         Template.__init__(self, template_name, caller)
+        # (what bf_base_template was resolved from, the base template):
+        self.__base_template = (None, None)
         self.create_lookup()
         if lookup:
             #M ake sure it's a mako environment:
@@ -104,16 +329,12 @@ class MakoTemplate(Template):
         #  2) template_name can be a path to a file
         #  3) template_name can be a name to lookup
         if src:
-            self.mako_template = mako.template.Template(
-                src,
-                output_encoding="utf-8",
-                lookup=self.template_lookup)
+            self.mako_template = compile_mako(self.template_lookup, src=src)
         elif os.path.isfile(template_name):
-            with open(self.template_name) as t_file:
-                self.mako_template = mako.template.Template(
-                    t_file.read(),
-                    output_encoding="utf-8",
-                    lookup=self.template_lookup)
+            self.mako_template = compiled_templates.get(
+                template_name, self.template_lookup,
+                lambda: compile_mako(self.template_lookup,
+                                     filename=template_name))
         else:
             self.mako_template = self.template_lookup.get_template(
                 template_name)
@@ -122,10 +343,12 @@ class MakoTemplate(Template):
     @classmethod
     def create_lookup(cls):
         if MakoTemplate.template_lookup is None:
+            import mako.lookup
             MakoTemplate.template_lookup = mako.lookup.TemplateLookup(
                 directories=[".", base_template_dir],
                 input_encoding='utf-8', output_encoding='utf-8',
-                encoding_errors='replace')
+                encoding_errors='replace',
+                modulename_callable=mako_module_filename)
 
     @classmethod
     def add_default_template_path(cls, path):
@@ -140,20 +363,49 @@ class MakoTemplate(Template):
         if path not in lookup.directories:
             lookup.directories.append(path)
 
+    def __get_base_template(self):
+        """Resolve bf_base_template, reusing the template resolved by the
+        previous render if it comes from the same place.
+        """
+        if self.base_template_src is not None:
+            source = ("src", self.base_template_src)
+        elif "bf_base_template" in self:
+            source = ("name", os.path.split(self["bf_base_template"])[1])
+        else:
+            source = ("name", bf.config.site.base_template)
+        if self.__base_template[0] == source:
+            return self.__base_template[1]
+        if source[0] == "src":
+            base_template = compiled_templates.get_src(
+                self.base_template_src, self.template_lookup,
+                lambda: compile_mako(self.template_lookup,
+                                     src=self.base_template_src))
+        else:
+            base_template = self.template_lookup.get_template(source[1])
+        self.__base_template = (source, base_template)
+        return base_template
+
     def render(self, path=None):
+        return self.__render(path)
+
+    def stream(self, path):
+        self.__render(path, stream=True)
+
+    def __render(self, path, stream=False):
+        import mako.exceptions
+        import mako.runtime
         self.render_prep(path)
         # Make sure bf_base_template is defined
-        if "bf_base_template" in self:
-            bf_base_template = os.path.split(self["bf_base_template"])[1]
-            self.template_lookup.put_template(
-                "bf_base_template", self.template_lookup.get_template(
-                    bf_base_template))
-        else:
-            self.template_lookup.put_template(
-                "bf_base_template",
-                self.template_lookup.get_template(
-                    bf.config.site.base_template))
+        self.template_lookup.put_template(
+            "bf_base_template", self.__get_base_template())
         try:
+            if stream:
+                # Render into a buffer that is the output file:
+                with self.open_output(
+                        path, self.mako_template.encoding_errors) as f:
+                    self.mako_template.render_context(
+                        mako.runtime.Context(f, **self), **self)
+                return
             rendered = self.mako_template.render(**self)
             if path:
                 self.write(path, rendered)
@@ -167,14 +419,32 @@ class MakoTemplate(Template):
             self.render_cleanup()
 
 
-class JinjaTemplateLoader(jinja2.FileSystemLoader):
+class JinjaTemplateLoader(object):
+    """A Jinja2 FileSystemLoader that also loads bf_base_template.
+
+    jinja2 is only imported once a loader is made: the instances are of
+    a subclass that also derives from jinja2.FileSystemLoader.
+    """
+    # cls -> its subclass deriving from jinja2.FileSystemLoader (which
+    # maps to itself):
+    _loader_classes = {}
+
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(_jinja_loader_class(cls))
+
     def __init__(self, searchpath):
-        jinja2.FileSystemLoader.__init__(self, searchpath)
+        super(JinjaTemplateLoader, self).__init__(searchpath)
         self.bf_base_template = bf.util.path_join(
             "_templates", bf.config.site.base_template)
+        # Source of bf_base_template, when it's not loaded from a file:
+        self.bf_base_template_src = None
 
     def get_source(self, environment, template):
-        if template == "bf_base_template":
+        import jinja2
+        src = self.bf_base_template_src
+        if template == "bf_base_template" and src is not None:
+            return (src, None, lambda: self.bf_base_template_src is src)
+        elif template == "bf_base_template":
             with open(self.bf_base_template) as f:
                 return (f.read(), self.bf_base_template, lambda: False)
         else:
@@ -182,11 +452,40 @@ class JinjaTemplateLoader(jinja2.FileSystemLoader):
                     .get_source(environment, template))
 
 
+def _jinja_loader_class(cls):
+    """Return the subclass of cls (a JinjaTemplateLoader) that also
+    derives from jinja2.FileSystemLoader.
+    """
+    try:
+        return cls._loader_classes[cls]
+    except KeyError:
+        import jinja2
+        loader_class = type(cls.__name__, (cls, jinja2.FileSystemLoader),
+                            {"__module__": cls.__module__})
+        cls._loader_classes[cls] = loader_class
+        cls._loader_classes[loader_class] = loader_class
+        return loader_class
+
+
+def jinja_environment(loader):
+    """Create a Jinja2 Environment using the compiled template cache.
+    """
+    import jinja2
+    cache_dir = get_cache_dir("jinja2")
+    if cache_dir is None:
+        bytecode_cache = None
+    else:
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+    return jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache)
+
+
 class JinjaTemplate(Template):
     name = "jinja2"
+    loads_base_template_src = True
     template_lookup = None
 
     def __init__(self, template_name, caller=None, lookup=None, src=None):
+        import jinja2
         Template.__init__(self, template_name, caller)
         self.create_lookup()
         if lookup:
@@ -210,9 +509,9 @@ class JinjaTemplate(Template):
     @classmethod
     def create_lookup(cls):
         if cls.template_lookup is None:
-            cls.template_lookup = jinja2.Environment(
-                loader=JinjaTemplateLoader([base_template_dir,
-                                            bf.writer.temp_proc_dir]))
+            cls.template_lookup = jinja_environment(
+                JinjaTemplateLoader([base_template_dir,
+                                     bf.writer.temp_proc_dir]))
 
     @classmethod
     def add_default_template_path(cls, path):
@@ -226,8 +525,20 @@ class JinjaTemplate(Template):
         if path not in lookup.loader.searchpath:
             lookup.loader.searchpath.append(path)
 
+    def __compile_file(self):
+        with open(self.template_name) as t_file:
+            return compile_jinja(self.template_lookup, t_file.read())
+
     def render(self, path=None):
+        return self.__render(path)
+
+    def stream(self, path):
+        self.__render(path, stream=True)
+
+    def __render(self, path, stream=False):
         # Ensure that bf_base_template is set:
+        self.template_lookup.loader.bf_base_template_src = (
+            self.base_template_src)
         if "bf_base_template" in self:
             self.template_lookup.loader.bf_base_template = (
                 self["bf_base_template"])
@@ -235,16 +546,21 @@ class JinjaTemplate(Template):
             self["bf_base_template"] = (
                 self.template_lookup.loader.bf_base_template)
         if self.src:
-            self.jinja_template = self.template_lookup.from_string(self.src)
+            self.jinja_template = compile_jinja(
+                self.template_lookup, self.src)
         elif os.path.isfile(self.template_name):
-            with open(self.template_name) as t_file:
-                self.jinja_template = self.template_lookup.from_string(
-                    t_file.read())
+            self.jinja_template = compiled_templates.get(
+                self.template_name, self.template_lookup, self.__compile_file)
         else:
             self.jinja_template = self.template_lookup.get_template(
                 self.template_name)
         self.render_prep(path)
         try:
+            if stream:
+                with self.open_output(path) as f:
+                    for chunk in self.jinja_template.generate(self):
+                        f.write(chunk)
+                return
             rendered = bytes(self.jinja_template.render(self), "utf-8")
             if path:
                 self.write(path, rendered)
@@ -259,6 +575,7 @@ class JinjaTemplate(Template):
 
 class FilterTemplate(Template):
     name = "filter"
+    loads_base_template_src = True
     chain = None
 
     def __init__(self, template_name, caller=None, lookup=None, src=None):
@@ -277,8 +594,12 @@ class FilterTemplate(Template):
             # Run the filter chain:
             html = _filter.run_chain(self.chain, src)
             # Place the html into the base template:
-            with open(self["bf_base_template"]) as f:
-                html = f.read().replace(self.marker, html)
+            if self.base_template_src is not None:
+                base_template_src = self.base_template_src
+            else:
+                with open(self["bf_base_template"]) as f:
+                    base_template_src = f.read()
+            html = base_template_src.replace(self.marker, html)
             html = bytes(html, "utf-8")
             if path:
                 self.write(path, html)
@@ -319,6 +640,34 @@ def get_base_template_src():
         return f.read()
 
 
+def get_converted_base_template(base_engine, template_engine):
+    """Return the base template rendered with base_engine, and converted
+    into a template for template_engine.
+
+    The conversion is done once per build for each pair of engines and
+    version of the base template.
+    """
+    base_template_src = get_base_template_src()
+    key = (base_engine.name, template_engine.name,
+           source_key("", base_template_src))
+    with __converted_base_templates_lock:
+        try:
+            return converted_base_templates[key]
+        except KeyError:
+            pass
+    # Replace the content block with our own marker:
+    prev_content_block = bf.config.templates.content_blocks[base_engine.name]
+    new_content_block = (
+        bf.config.templates.content_blocks[template_engine.name])
+    base_template_src = prev_content_block.pattern.sub(
+        template_content_place_holder.pattern, base_template_src)
+    html = str(base_engine(None, src=base_template_src).render(), "utf-8")
+    html = template_content_place_holder.sub(
+        new_content_block.replacement, html)
+    with __converted_base_templates_lock:
+        return converted_base_templates.setdefault(key, html)
+
+
 def materialize_alternate_base_engine(template_name, location, attrs={},
                                       lookup=None, base_engine=None,
                                       caller=None):
@@ -329,13 +678,16 @@ def materialize_alternate_base_engine(template_name, location, attrs={},
       1) Load the base template source, and mark the content block
          for later replacement.
 
-      2) Materialize the base template in a temporary location with
-         attrs.
+      2) Materialize the base template with the base engine.
 
       3) Convert the HTML to new template type by replacing the marker.
 
-      4) Materialize the template setting bf_base_template to
-         the new base template we created.
+      4) Materialize the template with the new base template we created,
+         as source if the template engine can load it that way, or else
+         by setting bf_base_template to a file.
+
+    Steps 1-3 only happen once per build, see
+    get_converted_base_template.
     """
     # Since we're mucking with the template attrs, make sure we copy
     # them and don't modify the original ones:
@@ -344,50 +696,245 @@ def materialize_alternate_base_engine(template_name, location, attrs={},
         base_engine = get_engine_for_template_name(
             bf.config.site.base_template)
     template_engine = get_engine_for_template_name(template_name)
-    base_template_src = get_base_template_src()
     if not lookup:
         lookup = base_engine.template_lookup
     else:
         base_engine.add_default_template_path(bf.writer.temp_proc_dir)
-    # Replace the content block with our own marker:
-    prev_content_block = bf.config.templates.content_blocks[base_engine.name]
-    new_content_block = (
-        bf.config.templates.content_blocks[template_engine.name])
-    base_template_src = prev_content_block.pattern.sub(
-        template_content_place_holder.pattern, base_template_src)
-    html = str(base_engine(None, src=base_template_src).render(), "utf-8")
-    html = template_content_place_holder.sub(
-        new_content_block.replacement, html)
-    new_base_template = tempfile.mktemp(
-        suffix="." + template_engine.name, prefix="bf_template",
-        dir=bf.writer.temp_proc_dir)
-    new_base_template_name = os.path.split(new_base_template)[1]
-    with open(new_base_template, "w") as f:
+    html = get_converted_base_template(base_engine, template_engine)
+    if template_engine.loads_base_template_src:
+        materialize_template(
+            template_name, location, attrs, base_engine=template_engine,
+            base_template_src=html)
+        return
+    attrs["bf_base_template"] = write_converted_base_template(
+        html, template_engine)
+    materialize_template(
+        template_name, location, attrs, base_engine=template_engine)
+
+
+def write_converted_base_template(html, template_engine):
+    """Write a converted base template to a file for engines that can't
+    take it as source, once per build. Returns the path of the file.
+    """
+    new_base_template = os.path.join(
+        bf.writer.temp_proc_dir, "bf_template_{0}.{1}".format(
+            source_key("", html), template_engine.name))
+    if not os.path.exists(new_base_template):
         logger.debug(
             "Writing intermediate base template: {0}"
             .format(new_base_template))
-        f.write(html)
-    attrs["bf_base_template"] = new_base_template
-    materialize_template(
-        template_name, location, attrs, base_engine=template_engine)
-    os.remove(new_base_template)
+        fd, tmp_path = tempfile.mkstemp(dir=bf.writer.temp_proc_dir)
+        with os.fdopen(fd, "w") as f:
+            f.write(html)
+        util.replace_file(tmp_path, new_base_template)
+    return new_base_template
 
 
 def materialize_template(template_name, location, attrs={}, lookup=None,
-                         base_engine=None, caller=None):
+                         base_engine=None, caller=None,
+                         base_template_src=None):
     """Render a named template with attrs to a location in the _site dir.
+
+    base_template_src, if given, is used as the source of the base
+    template, for engines that support it.
     """
     # Find the appropriate template engine based on the file ending:
     template_engine = get_engine_for_template_name(template_name)
     if not base_engine:
         base_engine = get_engine_for_template_name(
             bf.config.site.base_template)
-    # Is the base engine the same as the template engine?
-    if base_engine == template_engine or base_engine == template_engine.name:
-        template = template_engine(template_name, caller=caller, lookup=lookup)
-        template.update(attrs)
-        template.render(location)
-    else:
-        materialize_alternate_base_engine(
-            template_name, location, attrs=attrs, caller=caller, lookup=lookup,
-            base_engine=base_engine)
+    with render_lock:
+        # Is the base engine the same as the template engine?
+        if base_engine == template_engine or \
+                base_engine == template_engine.name:
+            template = template_engine(
+                template_name, caller=caller, lookup=lookup)
+            template.base_template_src = base_template_src
+            template.update(attrs)
+            # Nobody needs the rendered output, so don't hold it in memory:
+            template.stream(location)
+        else:
+            materialize_alternate_base_engine(
+                template_name, location, attrs=attrs, caller=caller,
+                lookup=lookup, base_engine=base_engine)
+
+
+class PageRenderer(object):
+    """Render one template to many pages, setting it up only once: the
+    engine, the compiled template, the base template and
+    site.template_vars.
+    """
+    def __init__(self, template_name, lookup=None, base_engine=None,
+                 caller=None):
+        template_engine = get_engine_for_template_name(template_name)
+        if not base_engine:
+            base_engine = get_engine_for_template_name(
+                bf.config.site.base_template)
+        self.defaults = dict(bf.config.site.template_vars.items())
+        base_template_src = None
+        if base_engine != template_engine and \
+                base_engine != template_engine.name:
+            # See materialize_alternate_base_engine
+            if lookup:
+                base_engine.add_default_template_path(
+                    bf.writer.temp_proc_dir)
+                lookup = None
+            html = get_converted_base_template(base_engine, template_engine)
+            if template_engine.loads_base_template_src:
+                base_template_src = html
+            else:
+                self.defaults["bf_base_template"] = (
+                    write_converted_base_template(html, template_engine))
+        self.template = template_engine(
+            template_name, caller=caller, lookup=lookup)
+        self.template.base_template_src = base_template_src
+        self.template.template_vars_added = True
+
+    def render(self, location, attrs={}):
+        """Render the template with attrs to a location in the _site dir.
+        """
+        with render_lock:
+            self.template.clear()
+            self.template.update(self.defaults)
+            self.template.update(attrs)
+            self.template.stream(location)
+
+
+# The PageRenderer that worker processes forked by materialize_many use:
+_page_renderer = None
+
+
+def _materialize_page(page):
+    location, attrs = page
+    return (location,) + bf.writer.capture_outputs(
+        _page_renderer.render, location, attrs)
+
+
+def materialize_many(template_name, pages, lookup=None, base_engine=None,
+                     caller=None, workers=None):
+    """Render a named template once for each (location, attrs) in pages.
+
+    This does the same as calling materialize_template for every page,
+    but only sets the template up once. pages is consumed lazily, so it
+    can be a generator. With workers > 1, the pages are rendered in that
+    many worker processes, forked after the template is set up; attrs
+    must then be picklable.
+    """
+    global _page_renderer
+    renderer = PageRenderer(template_name, lookup=lookup,
+                            base_engine=base_engine, caller=caller)
+    workers = util.job_count(workers) if workers is not None else 1
+    pool = None
+    if workers > 1:
+        _page_renderer = renderer
+        pool = util.process_pool(workers)
+        if pool is None:
+            _page_renderer = None
+            logger.warn("Cannot start worker processes, "
+                        "rendering {0} serially".format(template_name))
+    if pool is None:
+        for location, attrs in pages:
+            renderer.render(location, attrs)
+        return
+    pages = iter(pages)
+    try:
+        while True:
+            # Only hand the workers a few pages at a time, so we never
+            # hold all of them in memory:
+            batch = list(itertools.islice(pages, workers * 16))
+            if not batch:
+                break
+            for location, outputs, stats, error in pool.imap(
+                    _materialize_page, batch, chunksize=4):
+                if error is not None:
+                    raise TemplateEngineError(
+                        "Error rendering template {0} to {1}:\n{2}"
+                        .format(template_name, location, error))
+                bf.writer.merge_outputs(outputs, stats)
+    finally:
+        _page_renderer = None
+        pool.terminate()
+        pool.join()
+
+
+def __iter_template_files(directory, ignore=False):
+    """Yield (path, path relative to directory, engine) for the Mako and
+    Jinja2 templates in directory, skipping the site's ignored files if
+    ignore is True.
+    """
+    for root, dirs, files in os.walk(directory):
+        if ignore:
+            # Ignore patterns match the paths the writer walks:
+            if root.startswith("./"):
+                root = root[2:]
+            for d in list(dirs):
+                if util.should_ignore_path(util.path_join(root, d)):
+                    dirs.remove(d)
+        for fn in files:
+            path = util.path_join(root, fn)
+            if ignore and util.should_ignore_path(path):
+                continue
+            try:
+                engine = get_engine_for_template_name(fn)
+            except TemplateEngineError:
+                continue
+            if issubclass(engine, (MakoTemplate, JinjaTemplate)):
+                rel_path = os.path.relpath(path, directory)
+                yield path, rel_path.replace(os.sep, "/"), engine
+
+
+def compile_templates(args):
+    """Compile the templates of the site and of its enabled plugins into
+    the compiled template cache, e.g. to warm it up in CI.
+    """
+    from . import config, plugin
+    config.init_interactive(args)
+    plugin.init_plugins()
+    if not bf.config.templates.cache_dir:
+        print("templates.cache_dir is not set, there is nothing to compile")
+        return
+    MakoTemplate.create_lookup()
+    jinja_lookup = jinja_environment(
+        JinjaTemplateLoader([base_template_dir]))
+    # Jinja2 only looks up the base template by name:
+    jinja_base_template = bf.config.site.base_template.replace(os.sep, "/")
+    # (Mako lookup, directory, are the templates looked up by name?)
+    sources = [(MakoTemplate.template_lookup, ".", False),
+               (MakoTemplate.template_lookup, base_template_dir, True)]
+    for name, plugin_ns in sorted(bf.config.plugins.items()):
+        if plugin_ns.enabled and "mod" in plugin_ns:
+            tools = plugin.PluginTools(plugin_ns.mod.__name__)
+            sources.append((tools.template_lookup,
+                            os.path.join(tools.get_src_dir(), "_templates"),
+                            True))
+    compiled = failed = 0
+    for mako_lookup, directory, by_name in sources:
+        for path, uri, engine in __iter_template_files(
+                directory, ignore=not by_name):
+            is_mako = issubclass(engine, MakoTemplate)
+            try:
+                if not by_name:
+                    if is_mako:
+                        compile_mako(mako_lookup, filename=path)
+                    else:
+                        with open(path) as f:
+                            compile_jinja(jinja_lookup, f.read())
+                elif is_mako:
+                    mako_lookup.get_template(uri)
+                elif directory == base_template_dir and \
+                        uri == jinja_base_template:
+                    jinja_lookup.get_template("bf_base_template")
+                else:
+                    continue
+            except Exception as e:
+                logger.error("Error compiling template {0}: {1}"
+                             .format(path, e))
+                failed += 1
+            else:
+                logger.info("Compiled template: " + path)
+                compiled += 1
+    print("Compiled {0} templates into {1}".format(
+            compiled, bf.config.templates.cache_dir))
+    if failed:
+        print("{0} templates failed to compile".format(failed))
+        sys.exit(1)
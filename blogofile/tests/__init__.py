@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile.
+
+While they run, XDG_CACHE_HOME is a temporary directory, so the index of
+installed plugins (see blogofile.plugin_index) isn't written to the
+user's own cache.
+"""
+import atexit
+import os
+import shutil
+from tempfile import mkdtemp
+
+cache_home = mkdtemp(prefix="blogofile_tests_")
+os.environ["XDG_CACHE_HOME"] = cache_home
+atexit.register(shutil.rmtree, cache_home, True)
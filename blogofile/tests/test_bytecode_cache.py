@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile bytecode_cache module.
+"""
+import os
+import shutil
+import sys
+from tempfile import mkdtemp
+try:
+    import unittest2 as unittest        # For Python 2.6
+except ImportError:
+    import unittest                     # flake8 ignore # NOQA
+from mock import patch
+from .. import bytecode_cache
+
+
+class TestBytecodeCache(unittest.TestCase):
+    """Unit tests for loading modules through the bytecode cache.
+    """
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cache_dir = os.path.join(self.tmp, "pyc")
+        self.path = os.path.join(self.tmp, "shout.py")
+        self._write(self.path, "def run(content):\n"
+                               "    return content.upper()\n")
+
+    def _write(self, path, source):
+        with open(path, "w") as f:
+            f.write(source)
+
+    def _load(self, path):
+        self.addCleanup(sys.modules.pop, "bf_test_module", None)
+        return bytecode_cache.load_module(
+            "bf_test_module", path, self.cache_dir)
+
+    def test_load_module(self):
+        """the module is imported, and its code cached
+        """
+        mod = self._load(self.path)
+        self.assertEqual(mod.run("hi"), "HI")
+        self.assertEqual(mod.__file__, self.path)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_not_compiled_again(self):
+        """an unchanged source is loaded from the cache
+        """
+        self._load(self.path)
+        with patch.object(bytecode_cache, "compile") as mock_compile:
+            mod = self._load(self.path)
+        self.assertFalse(mock_compile.called)
+        self.assertEqual(mod.run("hi"), "HI")
+
+    def test_changed_source_replaces_entry(self):
+        """a changed source is compiled again, and its old entry removed
+        """
+        self._load(self.path)
+        self._write(self.path, "def run(content):\n"
+                               "    return content.lower()\n")
+        mod = self._load(self.path)
+        self.assertEqual(mod.run("HI"), "hi")
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_package(self):
+        """packages are loaded from their __init__.py
+        """
+        package = os.path.join(self.tmp, "loud")
+        os.mkdir(package)
+        self._write(os.path.join(package, "__init__.py"), "value = 42\n")
+        mod = self._load(package)
+        self.assertEqual(mod.value, 42)
+        self.assertEqual(mod.__path__, [package])
+
+    def test_no_bytecode_next_to_source(self):
+        """no .pyc files are written next to the source
+        """
+        self._load(self.path)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ["pyc", "shout.py"])
+
+    def test_cache_turned_off(self):
+        """without a cache directory, modules are just compiled
+        """
+        self.cache_dir = None
+        self.assertEqual(self._load(self.path).run("hi"), "HI")
+        self.assertEqual(sorted(os.listdir(self.tmp)), ["shout.py"])
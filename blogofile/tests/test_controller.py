@@ -0,0 +1,594 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile controller module.
+"""
+import os
+import shutil
+import sys
+import textwrap
+import threading
+from tempfile import mkdtemp
+try:
+    import unittest2 as unittest        # For Python 2.6
+except ImportError:
+    import unittest                     # flake8 ignore # NOQA
+from mock import patch
+from .. import cache
+from .. import config
+from .. import controller
+from .. import event_loop
+from .. import exception
+from .. import template
+from .. import util
+from .. import writer
+from ..cache import HierarchicalCache as HC
+try:
+    import asyncio
+except ImportError:
+    # Python < 3.4
+    asyncio = None
+
+# Coroutine functions are a syntax error before Python 3.5, so the tests
+# that need them build them with exec:
+has_coroutines = sys.version_info >= (3, 5)
+
+
+class FakeController(object):
+    """A controller module that records when it ran.
+    """
+    def __init__(self, name, log, event=None, wait_for=None):
+        self.__file__ = name + ".py"
+        self.name = name
+        self.log = log
+        self.event = event
+        self.wait_for = wait_for
+
+    def run(self):
+        if self.wait_for is not None:
+            # Only finishes if the other controller runs at the same time:
+            self.wait_for.wait(5)
+        self.log.append(self.name)
+        if self.event is not None:
+            self.event.set()
+
+
+if has_coroutines:
+    exec(textwrap.dedent('''
+        class AsyncFakeController(FakeController):
+            """A controller module with a coroutine run().
+            """
+            async def run(self):
+                if self.wait_for is not None:
+                    await asyncio.wait_for(self.wait_for.wait(), 5)
+                self.log.append(self.name)
+                if self.event is not None:
+                    self.event.set()
+        '''))
+
+
+class TestDependencyGraph(unittest.TestCase):
+    """Unit tests for ordering controllers by their declarations.
+    """
+    def _controllers(self, **declarations):
+        controllers = []
+        for priority, name in enumerate(("c", "b", "a")):
+            c = HC(priority=priority)
+            c.update(declarations.get(name, {}))
+            controllers.insert(0, (name, c))
+        return controllers
+
+    def test_undeclared_keep_priority_order(self):
+        """controllers without declarations run in priority order
+        """
+        graph = controller.dependency_graph(self._controllers())
+        self.assertEqual(graph, {0: set(), 1: set([0]), 2: set([1])})
+
+    def test_after_and_before(self):
+        """after and before add dependencies, by name
+        """
+        graph = controller.dependency_graph(self._controllers(
+                a={"after": ["c"]}, b={"before": "c"}, c={"after": []}))
+        self.assertEqual(graph, {0: set([2]), 1: set(), 2: set([1])})
+
+    def test_overlapping_outputs(self):
+        """controllers writing the same outputs run in priority order
+        """
+        graph = controller.dependency_graph(self._controllers(
+                a={"outputs": ["blog/*"], "after": []},
+                b={"outputs": ["photos"], "after": []},
+                c={"outputs": ["blog/index.html"], "after": []}))
+        self.assertEqual(graph, {0: set(), 1: set(), 2: set([0])})
+
+    def test_declarations_without_after_keep_priority_order(self):
+        """controllers that don't declare after or before stay in
+        priority order, whatever else they declare
+        """
+        graph = controller.dependency_graph(self._controllers(
+                a={"outputs": ["blog"]}, b={"thread_safe": True},
+                c={"after": []}))
+        self.assertEqual(graph, {0: set(), 1: set([0]), 2: set()})
+
+    def test_cycle(self):
+        """controllers that wait for each other can't run
+        """
+        self.assertRaises(
+            exception.ControllerDependencyError, controller.dependency_graph,
+            self._controllers(a={"after": "b"}, b={"after": "a"}))
+
+
+class TestRunAll(unittest.TestCase):
+    """Unit tests for running the controllers.
+    """
+    def setUp(self):
+        self.addCleanup(cache.reset_bf)
+        self.addCleanup(config.reset_config)
+        self.log = []
+
+    def _add(self, name, priority, **kw):
+        c = config.controllers[name]
+        c.enabled = True
+        c.priority = priority
+        c.mod = FakeController(name, self.log, kw.pop("event", None),
+                               kw.pop("wait_for", None))
+        c.update(kw)
+
+    def test_priority_order(self):
+        """undeclared controllers run by priority, highest first
+        """
+        self._add("low", 10)
+        self._add("high", 90)
+        self._add("middle", 50)
+        controller.run_all([config])
+        self.assertEqual(self.log, ["high", "middle", "low"])
+
+    def test_after(self):
+        """a controller runs after the ones it declares
+        """
+        self._add("sitemap", 90, after=["blog"])
+        self._add("blog", 10, thread_safe=False, after=[])
+        controller.run_all([config])
+        self.assertEqual(self.log, ["blog", "sitemap"])
+
+    def test_thread_safe_run_concurrently(self):
+        """independent thread safe controllers run at the same time
+        """
+        config.site.jobs = 2
+        blog_done = threading.Event()
+        self._add("photos", 90, thread_safe=True, after=[],
+                  wait_for=blog_done)
+        self._add("blog", 10, thread_safe=True, after=[], event=blog_done)
+        controller.run_all([config])
+        self.assertEqual(self.log, ["blog", "photos"])
+
+
+@unittest.skipUnless(has_coroutines, "coroutines need Python 3.5")
+class TestAsyncControllers(unittest.TestCase):
+    """Unit tests for controllers with a coroutine run().
+    """
+    def setUp(self):
+        self.addCleanup(cache.reset_bf)
+        self.addCleanup(config.reset_config)
+        self.addCleanup(event_loop.shutdown)
+        self.log = []
+
+    def _add(self, name, priority, **kw):
+        c = config.controllers[name]
+        c.enabled = True
+        c.priority = priority
+        c.mod = AsyncFakeController(name, self.log, kw.pop("event", None),
+                                    kw.pop("wait_for", None))
+        c.update(kw)
+
+    def test_coroutine_run(self):
+        """coroutine controllers run to completion, in priority order
+        """
+        self._add("low", 10)
+        self._add("high", 90)
+        controller.run_all([config])
+        self.assertEqual(self.log, ["high", "low"])
+
+    def test_shared_event_loop(self):
+        """coroutines of concurrent controllers share one event loop
+        """
+        config.site.jobs = 2
+        blog_done = asyncio.Event()
+        self._add("photos", 90, thread_safe=True, after=[],
+                  wait_for=blog_done)
+        self._add("blog", 10, thread_safe=True, after=[], event=blog_done)
+        controller.run_all([config])
+        self.assertEqual(self.log, ["blog", "photos"])
+
+    def test_cannot_wait_on_the_loop(self):
+        """waiting for a coroutine from the event loop itself fails
+        """
+        functions = {"event_loop": event_loop}
+        exec(textwrap.dedent('''
+            async def one():
+                return 1
+
+            async def nested():
+                return event_loop.call(one)
+            '''), functions)
+        self.assertRaises(RuntimeError, event_loop.call, functions["nested"])
+
+    def test_stopped_before_fork(self):
+        """the event loop is stopped before worker processes are forked
+        """
+        self._add("blog", 10)
+        controller.run_all([config])
+        self.assertIsNotNone(event_loop._thread)
+        pool = util.process_pool(2)
+        try:
+            self.assertIsNone(event_loop._thread)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_no_fork_while_busy(self):
+        """no worker processes are forked while coroutines are running
+        """
+        started = threading.Event()
+        finish = threading.Event()
+        functions = {"started": started, "finish": finish,
+                     "asyncio": asyncio}
+        exec(textwrap.dedent('''
+            async def wait():
+                started.set()
+                while not finish.is_set():
+                    await asyncio.sleep(0.01)
+            '''), functions)
+        thread = threading.Thread(target=event_loop.call,
+                                  args=(functions["wait"],))
+        thread.start()
+        try:
+            started.wait(5)
+            self.assertIs(util.can_fork(), False)
+            self.assertIsNone(util.process_pool(2))
+        finally:
+            finish.set()
+            thread.join()
+        # The idle loop is stopped to fork:
+        self.assertIs(util.can_fork(ignore_event_loop=True), True)
+        pool = util.process_pool(2)
+        try:
+            self.assertIsNotNone(pool)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_no_fork_with_threads_alive(self):
+        """no worker processes are forked while another thread runs
+        """
+        finish = threading.Event()
+        thread = threading.Thread(target=finish.wait)
+        thread.start()
+        try:
+            self.assertIs(util.can_fork(), False)
+            self.assertIsNone(util.process_pool(2))
+        finally:
+            finish.set()
+            thread.join()
+
+
+class TestProcessSafeControllers(unittest.TestCase):
+    """Unit tests for running controllers in worker processes.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_templates")
+        os.mkdir("_controllers")
+        with open(os.path.join("_templates", "site.mako"), "w") as f:
+            f.write("<html>${next.body()}</html>")
+        with open(os.path.join("_templates", "page.mako"), "w") as f:
+            f.write('<%inherit file="bf_base_template" />${pid}')
+        with open(os.path.join("_controllers", "pages.py"), "w") as f:
+            f.write(
+                "import os\n"
+                "from blogofile.cache import bf\n"
+                "config = {'process_safe': True}\n"
+                "def run():\n"
+                "    bf.template.materialize_template(\n"
+                "        'page.mako', 'page.html', {'pid': os.getpid()})\n")
+        with open("_config.py", "w") as f:
+            f.write("controllers.pages.enabled = True\n")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def test_outputs_recorded(self):
+        """pages a controller writes in a worker are recorded by the build
+        """
+        cache.reset_bf()
+        config.init("_config.py")
+        site_writer = writer.Writer(output_dir="_site")
+        site_writer.write_site()
+        with open(os.path.join("_site", "page.html")) as f:
+            pid = f.read()
+        self.assertNotEqual(pid, "<html>{0}</html>".format(os.getpid()))
+        self.assertIn("page.html", site_writer.written)
+        self.assertEqual(site_writer.stats["written"], 1)
+
+    def test_no_threads_alive_when_forking(self):
+        """the pool of one batch is shut down before forking the next
+        """
+        with open(os.path.join("_controllers", "more.py"), "w") as f:
+            f.write(
+                "import os\n"
+                "from blogofile.cache import bf\n"
+                "config = {'process_safe': True, 'after': 'pages'}\n"
+                "def run():\n"
+                "    bf.template.materialize_template(\n"
+                "        'page.mako', 'more.html', {'pid': os.getpid()})\n")
+        with open("_config.py", "a") as f:
+            f.write("controllers.more.enabled = True\n")
+        cache.reset_bf()
+        config.init("_config.py")
+        process_pool = getattr(controller, "__process_pool")
+        threads = []
+
+        def check_threads(workers):
+            threads.append(threading.active_count())
+            return process_pool(workers)
+        with patch.object(controller, "__process_pool", check_threads):
+            writer.Writer(output_dir="_site").write_site()
+        self.assertEqual(threads, [1, 1])
+        self.assertTrue(os.path.exists(os.path.join("_site", "more.html")))
+
+    def test_event_loop_stopped_before_fork(self):
+        """the event loop is stopped before the workers are forked
+        """
+        cache.reset_bf()
+        config.init("_config.py")
+        with patch.object(event_loop, "prepare_fork",
+                          wraps=event_loop.prepare_fork) as mock_prepare:
+            writer.Writer(output_dir="_site").write_site()
+        self.assertTrue(mock_prepare.called)
+
+    def test_runs_here_while_event_loop_busy(self):
+        """the controller runs in this process if the loop can't stop
+        """
+        cache.reset_bf()
+        config.init("_config.py")
+        with patch.object(event_loop, "prepare_fork", return_value=False):
+            writer.Writer(output_dir="_site").write_site()
+        with open(os.path.join("_site", "page.html")) as f:
+            self.assertEqual(f.read(), "<html>{0}</html>".format(os.getpid()))
+
+
+@unittest.skipUnless(has_coroutines, "coroutines need Python 3.5")
+class TestAsyncHelpers(unittest.TestCase):
+    """Unit tests for the helpers of coroutine controllers.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_templates")
+        os.mkdir("_controllers")
+        os.mkdir("_notes")
+        for name in ("one", "two"):
+            with open(os.path.join("_notes", name + ".txt"), "w") as f:
+                f.write(name.upper())
+        with open(os.path.join("_templates", "site.mako"), "w") as f:
+            f.write("<html>${next.body()}</html>")
+        with open(os.path.join("_templates", "note.mako"), "w") as f:
+            f.write('<%inherit file="bf_base_template" />${note}')
+        with open(os.path.join("_controllers", "notes.py"), "w") as f:
+            f.write(
+                "import asyncio\n"
+                "from blogofile.cache import bf\n"
+                "async def run():\n"
+                "    names = ['one', 'two']\n"
+                "    notes = await asyncio.gather(*[\n"
+                "        bf.event_loop.read_source('_notes/' + n + '.txt')\n"
+                "        for n in names])\n"
+                "    await asyncio.gather(*[\n"
+                "        bf.event_loop.materialize_template(\n"
+                "            'note.mako', n + '.html', {'note': note})\n"
+                "        for n, note in zip(names, notes)])\n")
+        with open("_config.py", "w") as f:
+            f.write("controllers.notes.enabled = True\n")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def test_read_and_materialize(self):
+        """sources read and pages rendered in the thread pool are written
+        """
+        cache.reset_bf()
+        config.init("_config.py")
+        site_writer = writer.Writer(output_dir="_site")
+        site_writer.write_site()
+        with open(os.path.join("_site", "two.html")) as f:
+            self.assertEqual(f.read(), "<html>TWO</html>")
+        self.assertEqual(site_writer.written,
+                         set(["one.html", "two.html"]))
+
+
+class TestLazyControllerLoading(unittest.TestCase):
+    """Unit tests for importing controllers only when they run.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_controllers")
+        for name in ("used", "unused"):
+            self._write(os.path.join("_controllers", name + ".py"),
+                        "import os\n"
+                        "config = {'priority': 90, 'option': 'module'}\n"
+                        "open('imported_' + __name__, 'w').close()\n"
+                        "def run():\n"
+                        "    pass\n")
+        self._write("_config.py", "controllers.used.enabled = True\n"
+                    "controllers.used.option = 'user'\n")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def _write(self, path, content):
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_not_imported_on_config_load(self):
+        """loading the config only registers the controllers
+        """
+        cache.reset_bf()
+        config.init("_config.py")
+        self.assertTrue(controller.is_pending(config.controllers.used))
+        self.assertFalse(os.path.exists("imported_used"))
+
+    def test_only_enabled_imported(self):
+        """building imports the enabled controllers, and only those
+        """
+        cache.reset_bf()
+        config.init("_config.py")
+        writer.Writer(output_dir="_site").write_site()
+        self.assertTrue(os.path.exists("imported_used"))
+        self.assertFalse(os.path.exists("imported_unused"))
+        self.assertNotIn("mod", config.controllers.unused)
+
+    def test_settings_kept(self):
+        """user settings override the controller's, which override the
+        defaults
+        """
+        cache.reset_bf()
+        config.init("_config.py")
+        controller.load_pending_controllers(config.controllers)
+        self.assertEqual(config.controllers.used.option, "user")
+        self.assertEqual(config.controllers.used.priority, 90)
+        self.assertTrue(config.controllers.used.enabled)
+
+    def test_enabled_by_module_config(self):
+        """a controller whose own config enables it still runs
+        """
+        self._write(os.path.join("_controllers", "own.py"),
+                    "config = {'enabled': True}\n"
+                    "def run():\n"
+                    "    open('ran_own', 'w').close()\n")
+        self._write(os.path.join("_controllers", "computed.py"),
+                    "config = dict([('enabled', True)])\n"
+                    "def run():\n"
+                    "    open('ran_computed', 'w').close()\n")
+        self._write(os.path.join("_controllers", "off.py"),
+                    "from blogofile.cache import HierarchicalCache\n"
+                    "config = HierarchicalCache(enabled=False)\n"
+                    "open('imported_off', 'w').close()\n")
+        cache.reset_bf()
+        config.init("_config.py")
+        writer.Writer(output_dir="_site").write_site()
+        self.assertTrue(os.path.exists("ran_own"))
+        self.assertTrue(os.path.exists("ran_computed"))
+        self.assertFalse(os.path.exists("imported_off"))
+        self.assertFalse(os.path.exists("imported_unused"))
+
+    def test_discovery_index(self):
+        """a directory is listed again only when it changes
+        """
+        found = controller.discover_controllers("_controllers")
+        self.assertEqual(sorted(found), ["unused", "used"])
+        os.remove(os.path.join("_controllers", "unused.py"))
+        os.utime("_controllers", (0, 0))
+        found = controller.discover_controllers("_controllers")
+        self.assertEqual(sorted(found), ["used"])
+
+
+class TestControllerInputs(unittest.TestCase):
+    """Unit tests for skipping controllers whose inputs didn't change.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_controllers")
+        os.mkdir("_photos")
+        self._write(os.path.join("_photos", "cat.jpg"), "meow")
+        self._write(os.path.join("_controllers", "photos.py"),
+                    "import os, shutil\n"
+                    "from blogofile.cache import bf\n"
+                    "config = {'inputs': ['_photos/*.jpg'],\n"
+                    "          'config_keys': ['site.url'],\n"
+                    "          'outputs_only': True}\n"
+                    "runs = []\n"
+                    "def run():\n"
+                    "    runs.append(True)\n"
+                    "    for fn in os.listdir('_photos'):\n"
+                    "        shutil.copy(os.path.join('_photos', fn),\n"
+                    "            os.path.join(bf.writer.output_dir, fn))\n"
+                    "        bf.writer.add_output(fn)\n")
+        self._write("_config.py", "site.incremental = True\n"
+                    "controllers.photos.enabled = True\n")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def _write(self, path, content):
+        with open(path, "w") as f:
+            f.write(content)
+
+    def _build(self, force=None, url=None):
+        cache.reset_bf()
+        config.init("_config.py")
+        if force:
+            config.site.force_controllers = force
+        if url:
+            config.site.url = url
+        writer.Writer(output_dir="_site").write_site()
+        return len(config.controllers.photos.mod.runs)
+
+    def test_skipped_when_inputs_unchanged(self):
+        """the controller is skipped, and its outputs are kept
+        """
+        self.assertEqual(self._build(), 1)
+        self.assertEqual(self._build(), 0)
+        self.assertEqual(os.listdir("_site"), ["cat.jpg"])
+
+    def test_runs_when_input_changed(self):
+        """a changed or new input file runs the controller again
+        """
+        self._build()
+        self._write(os.path.join("_photos", "dog.jpg"), "woof")
+        self.assertEqual(self._build(), 1)
+        self.assertEqual(sorted(os.listdir("_site")),
+                         ["cat.jpg", "dog.jpg"])
+
+    def test_runs_when_config_key_changed(self):
+        """a changed config key runs the controller again
+        """
+        self._build()
+        self.assertEqual(self._build(url="http://blog.example.com"), 1)
+
+    def test_force_controller(self):
+        """a forced controller runs even if its inputs didn't change
+        """
+        self._build()
+        self.assertEqual(self._build(force=["photos"]), 1)
+
+    def test_runs_unless_outputs_only(self):
+        """a controller that may set up state for the build always runs
+        """
+        with open("_config.py", "a") as f:
+            f.write("controllers.photos.outputs_only = False\n")
+        self._build()
+        self.assertEqual(self._build(), 1)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile copier module.
+"""
+import os
+import shutil
+from tempfile import mkdtemp
+try:
+    import unittest2 as unittest        # For Python 2.6
+except ImportError:
+    import unittest                     # flake8 ignore # NOQA
+from mock import patch
+from .. import copier
+
+
+class TestCopyEngine(unittest.TestCase):
+    """Unit tests for the static file CopyEngine.
+    """
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.src = os.path.join(self.tmp, "src.txt")
+        self.dst = os.path.join(self.tmp, "dst.txt")
+        with open(self.src, "w") as f:
+            f.write("static content")
+
+    def _copy(self, mode, threads=1):
+        engine = copier.CopyEngine(mode, threads)
+        engine.copy(self.src, self.dst)
+        engine.wait()
+        engine.shutdown()
+        return engine
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_unknown_mode(self):
+        """CopyEngine refuses modes it doesn't know
+        """
+        self.assertRaises(copier.CopyEngineError, copier.CopyEngine, "bogus")
+
+    def test_copy(self):
+        """copy mode makes an independent copy
+        """
+        engine = self._copy("copy")
+        self.assertEqual(self._read(self.dst), "static content")
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+        self.assertEqual(engine.stats["copied"], 1)
+
+    def test_copy_in_thread_pool(self):
+        """copies submitted to a thread pool are done after wait
+        """
+        self._copy("copy", threads=4)
+        self.assertEqual(self._read(self.dst), "static content")
+
+    def test_hardlink(self):
+        """hardlink mode links the destination to the source
+        """
+        engine = self._copy("hardlink")
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+        self.assertEqual(engine.stats["linked"], 1)
+
+    def test_hardlink_fallback_is_remembered(self):
+        """a device that can't hard link is only tried once
+        """
+        engine = copier.CopyEngine("hardlink")
+        with patch.object(copier.os, "link",
+                          side_effect=OSError(18, "EXDEV")) as mock_link:
+            engine.copy(self.src, self.dst)
+            engine.copy(self.src, self.dst)
+        self.assertEqual(mock_link.call_count, 1)
+        self.assertEqual(engine.stats["copied"], 2)
+        self.assertEqual(self._read(self.dst), "static content")
+
+    def test_hardlink_not_written_through(self):
+        """copying over a previous hard link doesn't modify the source
+        """
+        os.link(self.src, self.dst)
+        self._copy("copy")
+        with open(self.dst, "w") as f:
+            f.write("changed")
+        self.assertEqual(self._read(self.src), "static content")
+
+    def test_symlink(self):
+        """symlink mode links to the absolute source path
+        """
+        self._copy("symlink")
+        self.assertEqual(os.readlink(self.dst), os.path.abspath(self.src))
+
+    def test_auto_copies_and_keeps_mtime(self):
+        """auto mode copies the content and the source's mtime
+        """
+        self._copy("auto")
+        self.assertEqual(self._read(self.dst), "static content")
+        self.assertEqual(int(os.stat(self.src).st_mtime),
+                         int(os.stat(self.dst).st_mtime))
+
+    def test_auto_skips_unchanged(self):
+        """auto mode skips destinations with the same size and mtime
+        """
+        self._copy("auto")
+        engine = self._copy("auto")
+        self.assertEqual(engine.stats["skipped"], 1)
+
+    def test_auto_copies_edit_within_the_second(self):
+        """auto mode copies a same size edit with the same whole second
+        mtime
+        """
+        self._copy("auto")
+        with open(self.src, "w") as f:
+            f.write("Static content")
+        os.utime(self.src, (1000, 1000))
+        os.utime(self.dst, (1000, 1000))
+        self._copy("auto")
+        self.assertEqual(self._read(self.dst), "Static content")
+
+    def test_auto_copies_edit_with_other_nanoseconds(self):
+        """auto mode copies an edit whose mtime differs within the second
+        """
+        self._copy("auto")
+        with open(self.src, "w") as f:
+            f.write("Static content")
+        os.utime(self.src, (1000.25, 1000.25))
+        os.utime(self.dst, (1000.5, 1000.5))
+        self._copy("auto")
+        self.assertEqual(self._read(self.dst), "Static content")
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile filter module.
+"""
+import os
+import shutil
+import threading
+from tempfile import mkdtemp
+try:
+    import unittest2 as unittest        # For Python 2.6
+except ImportError:
+    import unittest                     # flake8 ignore # NOQA
+from mock import patch
+from .. import cache
+from .. import config
+from .. import filter as _filter
+from .. import filter_cache
+from .. import template
+from .. import writer
+
+
+class Upper(object):
+    @staticmethod
+    def run(content):
+        return content.upper()
+
+
+class Reverse(object):
+    @staticmethod
+    def run(content):
+        return content[::-1]
+
+
+class TestFilterChain(unittest.TestCase):
+    """Unit tests for compiled filter chains.
+    """
+    def setUp(self):
+        self.addCleanup(cache.reset_bf)
+        self.addCleanup(config.reset_config)
+        config.filters.upper.mod = Upper
+        config.filters.reverse.mod = Reverse
+
+    def test_parse_chain(self):
+        """a chain string is split into filter names, skipping none
+        """
+        chain = _filter.FilterChain("upper, none,reverse")
+        self.assertEqual(chain.names, ("upper", "reverse"))
+
+    def test_run_chain(self):
+        """content runs through the filters in order
+        """
+        self.assertEqual(_filter.run_chain("upper, reverse", "abc"), "CBA")
+        self.assertEqual(_filter.run_chain(["reverse"], "abc"), "cba")
+
+    def test_chain_cached_per_string(self):
+        """the same chain string gives the same compiled chain
+        """
+        self.assertIs(_filter.get_chain("upper, reverse"),
+                      _filter.get_chain("upper, reverse"))
+
+    def test_filters_resolved_once(self):
+        """filters are looked up on the first run only
+        """
+        chain = _filter.FilterChain("upper, reverse")
+        with patch.object(_filter, "get_filter_config",
+                          wraps=_filter.get_filter_config) as mock_get_filter:
+            chain.run("abc")
+            chain.run("abc")
+        self.assertEqual(mock_get_filter.call_count, 2)
+
+    def test_filters_resolved_again_after_init(self):
+        """initializing the filters makes chains look them up again
+        """
+        chain = _filter.FilterChain("upper")
+        chain.run("abc")
+        config.filters.upper.mod = Reverse
+        _filter.init_filters()
+        self.assertEqual(chain.run("abc"), "cba")
+
+    def test_no_debug_logging_when_disabled(self):
+        """the content isn't logged unless debug logging is enabled
+        """
+        chain = _filter.FilterChain("upper")
+        chain.filters()
+        with patch.object(_filter.logger, "isEnabledFor", return_value=False):
+            with patch.object(_filter.logger, "debug") as mock_debug:
+                chain.run("abc")
+        self.assertFalse(mock_debug.called)
+
+
+class TestFilterOutputCache(unittest.TestCase):
+    """Unit tests for caching the outputs of filter chains.
+    """
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(cache.reset_bf)
+        self.addCleanup(config.reset_config)
+        self.addCleanup(setattr, _filter, "output_cache", None)
+        _filter.output_cache = filter_cache.FilterCache(self.tmp, 2 ** 20)
+        # Filters need a module file, and to be pure, to be cached:
+        for name, f in (("upper", Upper), ("reverse", Reverse)):
+            config.filters[name].mod = f
+            config.filters[name].pure = True
+            f.__file__ = __file__
+            self.addCleanup(delattr, f, "__file__")
+
+    def _run(self, chain, content):
+        with patch.object(Upper, "run", wraps=Upper.run) as mock_run:
+            result = _filter.run_chain(chain, content)
+        return result, mock_run.call_count
+
+    def test_output_cached(self):
+        """a pure filter only runs once for the same input
+        """
+        self.assertEqual(self._run("upper", "abc"), ("ABC", 1))
+        self.assertEqual(self._run("upper", "abc"), ("ABC", 0))
+        self.assertEqual(self._run("upper", "abd"), ("ABD", 1))
+        self.assertEqual(_filter.output_cache.stats,
+                         {"hits": 1, "misses": 2})
+
+    def test_config_is_part_of_key(self):
+        """changing a filter's config invalidates its cached outputs
+        """
+        self._run("upper", "abc")
+        config.filters.upper.style = "loud"
+        _filter.init_filters()
+        self.assertEqual(self._run("upper", "abc"), ("ABC", 1))
+
+    def test_package_versions_are_part_of_key(self):
+        """upgrading a package the filter uses invalidates its outputs
+        """
+        config.filters.upper.packages = ["Markdown"]
+        _filter.init_filters()
+        with patch.object(_filter, "_package_version", return_value="1.0"):
+            self._run("upper", "abc")
+        _filter.init_filters()
+        with patch.object(_filter, "_package_version", return_value="2.0"):
+            self.assertEqual(self._run("upper", "abc"), ("ABC", 1))
+
+    def test_impure_filter_not_cached(self):
+        """filters that aren't pure always run
+        """
+        config.filters.upper.pure = False
+        self._run("upper, reverse", "abc")
+        self.assertEqual(self._run("upper, reverse", "abc"), ("CBA", 1))
+
+    def test_undeclared_filter_not_cached(self):
+        """filters that don't declare they are pure always run
+        """
+        del config.filters.upper["pure"]
+        _filter.init_filters()
+        self._run("upper", "abc")
+        self.assertEqual(self._run("upper", "abc"), ("ABC", 1))
+
+
+class TestRunChainMany(unittest.TestCase):
+    """Unit tests for running a filter chain over many contents.
+    """
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(cache.reset_bf)
+        self.addCleanup(config.reset_config)
+        self.path = os.path.join(self.tmp, "upper.py")
+        with open(self.path, "w") as f:
+            f.write("def run(content):\n"
+                    "    return content.upper()\n")
+        _filter.load_filter("upper", self.path)
+
+    def test_order_preserved(self):
+        """outputs come back in the order of the contents
+        """
+        contents = [str(n) + "x" for n in range(50)]
+        self.assertEqual(_filter.run_chain_many("upper", contents, workers=2),
+                         [c.upper() for c in contents])
+
+    def test_not_process_safe_runs_serially(self):
+        """chains with a filter that isn't process safe run serially
+        """
+        config.filters.upper.process_safe = False
+        with patch.object(_filter.util, "process_pool") as mock_pool:
+            outputs = _filter.run_chain_many("upper", ["a", "b"], workers=2)
+        self.assertFalse(mock_pool.called)
+        self.assertEqual(outputs, ["A", "B"])
+
+    def test_runs_serially_without_fork(self):
+        """where this process can't fork, the chain runs serially
+        """
+        with patch.object(_filter.util, "can_fork", return_value=False):
+            outputs = _filter.run_chain_many("upper", ["a", "b"], workers=2)
+        self.assertEqual(outputs, ["A", "B"])
+
+    def test_no_workers_from_other_threads(self):
+        """worker processes are only forked from the main thread
+        """
+        pools = []
+        thread = threading.Thread(
+            target=lambda: pools.append(_filter.util.process_pool(2)))
+        thread.start()
+        thread.join()
+        self.assertEqual(pools, [None])
+
+
+class Shout(object):
+    @staticmethod
+    def run(content):
+        return content.upper() + "!"
+
+    @staticmethod
+    def run_stream(chunks):
+        for chunk in chunks:
+            yield chunk.upper()
+        yield "!"
+
+
+class TestFilterCapabilities(unittest.TestCase):
+    """Unit tests for the capabilities filters declare.
+    """
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(cache.reset_bf)
+        self.addCleanup(config.reset_config)
+        self.addCleanup(setattr, _filter, "output_cache", None)
+
+    def _load(self, name, source):
+        path = os.path.join(self.tmp, name + ".py")
+        with open(path, "w") as f:
+            f.write(source)
+        return _filter.load_filter(name, path)
+
+    def test_defaults(self):
+        """filters that declare nothing get the default capabilities
+        """
+        self._load("upper", "def run(content):\n"
+                            "    return content.upper()\n")
+        self.assertEqual(_filter.get_capabilities(config.filters.upper),
+                         {"pure": False, "thread_safe": False,
+                          "process_safe": True, "streaming": False,
+                          "cost_hint": 1.0})
+
+    def test_declared_in_filter_config(self):
+        """capabilities come from the filter's config, normalized
+        """
+        self._load("upper", "config = {'thread_safe': 1,\n"
+                            "          'cost_hint': '0.5'}\n"
+                            "def run(content):\n"
+                            "    return content.upper()\n")
+        self.assertIs(config.filters.upper.thread_safe, True)
+        self.assertEqual(config.filters.upper.cost_hint, 0.5)
+
+    def test_streaming_needs_run_stream(self):
+        """filters without run_stream can't be streaming
+        """
+        self._load("upper", "config = {'streaming': True}\n"
+                            "def run(content):\n"
+                            "    return content.upper()\n")
+        self.assertIs(config.filters.upper.streaming, False)
+
+    def test_chain_capabilities(self):
+        """a chain can do what all its filters can, and costs their total
+        """
+        config.filters.upper.mod = Upper
+        config.filters.upper.thread_safe = True
+        config.filters.upper.cost_hint = 0.25
+        config.filters.reverse.mod = Reverse
+        config.filters.reverse.pure = False
+        capabilities = _filter.FilterChain("upper, reverse").capabilities()
+        self.assertIs(capabilities["pure"], False)
+        self.assertIs(capabilities["thread_safe"], False)
+        self.assertEqual(capabilities["cost_hint"], 1.25)
+
+    def test_stream(self):
+        """chains of streaming filters stream, others run all at once
+        """
+        config.filters.shout.mod = Shout
+        config.filters.shout.streaming = True
+        config.filters.upper.mod = Upper
+        chain = _filter.FilterChain("shout, shout")
+        self.assertEqual(list(chain.stream(iter(["a", "b"]))),
+                         ["A", "B", "!", "!"])
+        chain = _filter.FilterChain("shout, upper")
+        self.assertEqual(list(chain.stream(iter(["a", "b"]))), ["AB!"])
+
+    def test_cheap_chain_runs_serially(self):
+        """chains cheaper than a cost_hint of 1 don't start workers
+        """
+        config.filters.upper.mod = Upper
+        config.filters.upper.cost_hint = 0.1
+        _filter.init_filters()
+        with patch.object(_filter.util, "process_pool") as mock_pool:
+            outputs = _filter.run_chain_many("upper", ["a", "b"], workers=2)
+        self.assertFalse(mock_pool.called)
+        self.assertEqual(outputs, ["A", "B"])
+
+    def test_thread_safe_chain_runs_in_threads(self):
+        """chains that aren't process safe but are thread safe use threads
+        """
+        config.filters.upper.mod = Upper
+        config.filters.upper.process_safe = False
+        config.filters.upper.thread_safe = True
+        _filter.init_filters()
+        with patch.object(_filter.futures, "ThreadPoolExecutor",
+                          wraps=_filter.futures.ThreadPoolExecutor) \
+                as mock_executor:
+            outputs = _filter.run_chain_many("upper", ["a", "b"], workers=2)
+        self.assertTrue(mock_executor.called)
+        self.assertEqual(outputs, ["A", "B"])
+
+    def test_cached_outputs_not_sent_to_workers(self):
+        """outputs already in the filter cache are read in this process
+        """
+        _filter.output_cache = filter_cache.FilterCache(self.tmp, 2 ** 20)
+        config.filters.upper.mod = Upper
+        config.filters.upper.pure = True
+        Upper.__file__ = __file__
+        self.addCleanup(delattr, Upper, "__file__")
+        _filter.init_filters()
+        _filter.run_chain("upper", "a")
+        with patch.object(_filter, "_run_chain_parallel",
+                          return_value=["B"]) as mock_parallel:
+            outputs = _filter.run_chain_many("upper", ["a", "b"], workers=2)
+        self.assertEqual(outputs, ["A", "B"])
+        self.assertEqual(mock_parallel.call_args[0][1], ["b"])
+        self.assertEqual(_filter.output_cache.stats,
+                         {"hits": 1, "misses": 2})
+
+
+class TestLazyFilterLoading(unittest.TestCase):
+    """Unit tests for loading registered filters on first use.
+    """
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(cache.reset_bf)
+        self.addCleanup(config.reset_config)
+        self.directory = os.path.join(self.tmp, "_filters")
+        os.mkdir(self.directory)
+        with open(os.path.join(self.directory, "shout.py"), "w") as f:
+            f.write("config = {'aliases': ['loud'], 'suffix': '!',\n"
+                    "          'style': 'plain'}\n"
+                    "initialized = []\n"
+                    "def init():\n"
+                    "    initialized.append(True)\n"
+                    "def run(content):\n"
+                    "    return content.upper() + config['suffix']\n")
+
+    def test_registered_not_imported(self):
+        """preloading only registers the filters
+        """
+        with patch.object(_filter.bytecode_cache, "load_module") \
+                as mock_load:
+            _filter.preload_filters(directory=self.directory)
+        self.assertFalse(mock_load.called)
+        self.assertTrue(_filter.is_pending(config.filters.shout))
+
+    def test_imported_and_initialized_on_first_use(self):
+        """the first get_filter imports the filter and runs its init
+        """
+        _filter.preload_filters(directory=self.directory)
+        mod = _filter.get_filter("shout")
+        self.assertEqual(mod.initialized, [True])
+        self.assertIs(_filter.get_filter("shout"), mod)
+        self.assertEqual(mod.initialized, [True])
+
+    def test_user_settings_override_filter_config(self):
+        """settings made before the filter loads win over its defaults
+        """
+        _filter.preload_filters(directory=self.directory)
+        config.filters.shout.style = "fancy"
+        self.assertEqual(_filter.run_chain("shout", "hi"), "HI!")
+        self.assertEqual(config.filters.shout.style, "fancy")
+        self.assertEqual(config.filters.shout.suffix, "!")
+
+    def test_alias_loads_pending_filters(self):
+        """an alias resolves to a filter that isn't loaded yet
+        """
+        _filter.preload_filters(directory=self.directory)
+        self.assertEqual(_filter.run_chain("loud", "hi"), "HI!")
+        self.assertIs(config.filters.loud, config.filters.shout)
+
+    def test_unknown_filter(self):
+        """names that no filter has still raise FilterNotLoaded
+        """
+        _filter.preload_filters(directory=self.directory)
+        self.assertRaises(_filter.exception.FilterNotLoaded,
+                          _filter.get_filter, "whisper")
+
+
+def _has_module(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+class TestBuiltinFilters(unittest.TestCase):
+    """Unit tests for the filters that come with blogofile.
+    """
+    def setUp(self):
+        self.addCleanup(cache.reset_bf)
+        self.addCleanup(config.reset_config)
+        _filter.preload_builtin_filters()
+
+    def test_registered(self):
+        """the built-in filters are registered, not loaded
+        """
+        for name in ("markdown", "rst", "syntax_highlight"):
+            self.assertTrue(_filter.is_pending(config.filters[name]))
+            self.assertTrue(_filter.is_builtin(config.filters[name]))
+
+    def test_declared_capabilities_kept(self):
+        """a filter's own config isn't overwritten by the defaults
+        """
+        if not _has_module("pygments"):
+            self.skipTest("Pygments is not installed")
+        _filter.get_filter("syntax_highlight")
+        self.assertIs(config.filters.syntax_highlight.thread_safe, True)
+        self.assertEqual(config.filters.syntax_highlight.name,
+                         "Syntax Highlighter")
+
+    @unittest.skipUnless(_has_module("pygments"), "needs Pygments")
+    def test_syntax_highlight(self):
+        """$$code blocks are highlighted, and the rest left alone
+        """
+        html = _filter.run_chain(
+            "syntax_highlight",
+            "Some code:\n$$code(lang=python)\nimport os\n$$/code\nDone")
+        self.assertTrue(html.startswith("Some code:\n<div class="))
+        self.assertIn("pygments_murphy", html)
+        self.assertTrue(html.endswith("</div>\n\nDone"))
+
+    @unittest.skipUnless(_has_module("pygments"), "needs Pygments")
+    def test_syntax_highlight_memoized(self):
+        """the same block is only highlighted once
+        """
+        mod = _filter.get_filter("syntax_highlight")
+        source = "$$code(lang=python, linenums=True)\nx = 1\n$$/code"
+        with patch.object(mod.pygments, "highlight",
+                          wraps=mod.pygments.highlight) as mock_highlight:
+            first = mod.run(source)
+            second = mod.run(" " + source)
+        self.assertEqual(mock_highlight.call_count, 1)
+        self.assertEqual(" " + first, second)
+
+    @unittest.skipUnless(_has_module("pygments"), "needs Pygments")
+    def test_syntax_highlight_arguments(self):
+        """$$code arguments can be quoted
+        """
+        mod = _filter.get_filter("syntax_highlight")
+        self.assertEqual(mod.parse_args("(lang=python, style='a, b')"),
+                         {"lang": "python", "style": "a, b"})
+        self.assertEqual(mod.parse_args(None), {})
+
+    @unittest.skipUnless(_has_module("markdown"), "needs Markdown")
+    def test_markdown_instance_reused(self):
+        """each thread converts with one Markdown instance
+        """
+        mod = _filter.get_filter("markdown")
+        self.assertEqual(mod.run("*hi*"), "<p><em>hi</em></p>")
+        md = mod.get_markdown()
+        self.assertEqual(mod.run("hi"), "<p>hi</p>")
+        self.assertIs(mod.get_markdown(), md)
+
+    @unittest.skipUnless(_has_module("docutils"), "needs docutils")
+    def test_rst_settings_reused(self):
+        """docutils settings are only built once
+        """
+        mod = _filter.get_filter("rst")
+        self.assertIn("<em>hi</em>", mod.run("*hi*"))
+        settings = mod._settings
+        mod.run("again")
+        self.assertIs(mod._settings, settings)
+
+    def test_missing_package(self):
+        """a filter whose package isn't installed fails on first use
+        """
+        with patch.dict("sys.modules", {"markdown": None}):
+            self.assertRaises(ImportError, _filter.get_filter, "markdown")
+
+
+@unittest.skipUnless(_has_module("markdown"), "needs Markdown")
+class TestMarkdownExtensions(unittest.TestCase):
+    """Unit tests for enabling Markdown extensions in _config.py.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_templates")
+        with open(os.path.join("_templates", "site.mako"), "w") as f:
+            f.write("${next.body()}")
+        with open("index.html.mako", "w") as f:
+            f.write('${bf.filter.run_chain("markdown", '
+                    '"# Title\\n\\nTerm\\n: Definition\\n\\n'
+                    '| a |\\n|---|\\n| b |")}')
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def _build(self, settings):
+        with open("_config.py", "w") as f:
+            f.write(settings)
+        cache.reset_bf()
+        config.init("_config.py")
+        writer.Writer(output_dir="_site").write_site()
+        with open(os.path.join("_site", "index.html")) as f:
+            return f.read()
+
+    def test_enabled_settings(self):
+        """only the extensions set enabled are loaded, those Markdown 3
+        removed are replaced
+        """
+        html = self._build(
+            "filters.markdown.extensions.def_list.enabled = True\n"
+            "filters.markdown.extensions.headerid.enabled = True\n"
+            "filters.markdown.extensions.tables.enabled = False\n")
+        self.assertIn("<dl>", html)
+        self.assertIn('<h1 id="title">Title</h1>', html)
+        self.assertNotIn("<table>", html)
+
+    def test_list_of_names(self):
+        """extensions can be given as a list of names
+        """
+        html = self._build('filters.markdown.extensions = ["tables"]\n')
+        self.assertIn("<table>", html)
+        self.assertNotIn("<dl>", html)
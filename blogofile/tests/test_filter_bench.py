@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile filter_bench module.
+"""
+import os
+import shutil
+from tempfile import mkdtemp
+try:
+    import unittest2 as unittest        # For Python 2.6
+except ImportError:
+    import unittest                     # flake8 ignore # NOQA
+from .. import filter_bench
+
+
+class TestFilterBench(unittest.TestCase):
+    """Unit tests for benchmarking filters.
+    """
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_read_corpus_strips_front_matter(self):
+        """posts are benchmarked without their YAML header
+        """
+        with open(os.path.join(self.tmp, "post.markdown"), "w") as f:
+            f.write("---\ntitle: Post\n---\nThe body\n")
+        with open(os.path.join(self.tmp, "page.txt"), "w") as f:
+            f.write("No header --- here\n")
+        self.assertEqual(filter_bench.read_corpus(self.tmp),
+                         ["No header --- here\n", "The body\n"])
+
+    def test_percentile(self):
+        """percentiles are taken by nearest rank
+        """
+        values = list(range(1, 101))
+        self.assertEqual(filter_bench.percentile(values, 50), 50)
+        self.assertEqual(filter_bench.percentile(values, 99), 99)
+        self.assertEqual(filter_bench.percentile([3], 99), 3)
+
+    def test_bench(self):
+        """the results cover every document, every time round
+        """
+        calls = []
+        results = filter_bench.bench(calls.append, ["ab", u"é"], repeat=2)
+        self.assertEqual(results["docs"], 4)
+        self.assertEqual(results["bytes"], 8)
+        # Twice round the corpus, and once more to measure memory:
+        self.assertEqual(calls, ["ab", u"é"] * 3)
+        self.assertEqual(sorted(results),
+                         ["bytes", "docs", "docs_per_sec", "mb_per_sec",
+                          "p50_ms", "p99_ms", "peak_memory", "seconds"])
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile filter_cache module.
+"""
+import os
+import shutil
+from tempfile import mkdtemp
+try:
+    import unittest2 as unittest        # For Python 2.6
+except ImportError:
+    import unittest                     # flake8 ignore # NOQA
+from .. import filter_cache
+
+
+class TestFilterCache(unittest.TestCase):
+    """Unit tests for the on-disk FilterCache.
+    """
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cache = filter_cache.FilterCache(self.tmp, 10)
+
+    def test_miss(self):
+        """a key that was never set is a miss
+        """
+        self.assertEqual(self.cache.get("abcd"), None)
+        self.assertEqual(self.cache.stats, {"hits": 0, "misses": 1})
+
+    def test_hit(self):
+        """the content set for a key is returned
+        """
+        self.cache.set("abcd", u"héllo")
+        self.assertEqual(self.cache.get("abcd"), u"héllo")
+        self.assertEqual(self.cache.stats, {"hits": 1, "misses": 0})
+
+    def test_trim_evicts_least_recently_used(self):
+        """entries used least recently are evicted first
+        """
+        for key in ("aa01", "aa02", "aa03"):
+            self.cache.set(key, "12345")
+        os.utime(os.path.join(self.tmp, "aa", "aa01"), (100, 100))
+        os.utime(os.path.join(self.tmp, "aa", "aa02"), (300, 300))
+        os.utime(os.path.join(self.tmp, "aa", "aa03"), (200, 200))
+        self.assertEqual(self.cache.trim(), 1)
+        self.assertEqual(self.cache.get("aa01"), None)
+        self.assertEqual(self.cache.get("aa02"), "12345")
+        self.assertEqual(self.cache.get("aa03"), "12345")
+
+    def test_trim_within_size(self):
+        """nothing is evicted while the cache fits
+        """
+        self.cache.set("aa01", "12345")
+        self.assertEqual(self.cache.trim(), 0)
@@ -8,6 +8,7 @@ import argparse
 import logging
 import os
 import platform
+import subprocess
 import sys
 try:
     import unittest2 as unittest        # For Python 2.6
@@ -479,6 +480,37 @@ class TestBuildParser(unittest.TestCase):
         args = self._parse_args(['build'])
         self.assertEqual(args.func, main.do_build)
 
+    def test_build_parser_incremental_default(self):
+        """build parser sets incremental default to False
+        """
+        args = self._parse_args(['build'])
+        self.assertFalse(args.incremental)
+
+    def test_build_parser_incremental(self):
+        """build parser sets incremental to True w/ --incremental
+        """
+        args = self._parse_args(['build', '--incremental'])
+        self.assertTrue(args.incremental)
+
+    def test_build_parser_jobs_default(self):
+        """build parser sets jobs default to None
+        """
+        args = self._parse_args(['build'])
+        self.assertEqual(args.jobs, None)
+
+    def test_build_parser_jobs(self):
+        """build parser sets jobs to N w/ --jobs N
+        """
+        args = self._parse_args(['build', '--jobs', '4'])
+        self.assertEqual(args.jobs, 4)
+
+    def test_build_parser_force_controllers(self):
+        """build parser collects --force-controller NAME options
+        """
+        args = self._parse_args(['build', '--force-controller', 'photos',
+                                 '--force-controller', 'blog'])
+        self.assertEqual(args.force_controllers, ['photos', 'blog'])
+
 
 class TestServeParser(unittest.TestCase):
     """Unit tests for serve sub-command parser.
@@ -575,3 +607,85 @@ class TestFiltersParser(unittest.TestCase):
         """
         args = self._parse_args('filters list'.split())
         self.assertEqual(args.func, main._filter.list_filters)
+
+    def test_filters_parser_func_bench_filters(self):
+        """filters bench action function is filter_bench.bench_filters
+        """
+        args = self._parse_args('filters bench'.split())
+        self.assertEqual(args.func, main.filter_bench.bench_filters)
+
+    def test_filters_bench_options(self):
+        """filters bench takes chains, a corpus, and a JSON switch
+        """
+        args = self._parse_args(
+            ['filters', 'bench', '--chain', 'a, b', '--chain', 'c',
+             '--corpus', 'docs', '--json'])
+        self.assertEqual(args.chain, ['a, b', 'c'])
+        self.assertEqual(args.corpus, 'docs')
+        self.assertTrue(args.json)
+        self.assertEqual(args.repeat, 1)
+
+
+class TestTemplatesParser(unittest.TestCase):
+    """Unit tests for templates sub-command parser.
+    """
+    def _parse_args(self, *args):
+        """Set up sub-command parser, parse args, and return result.
+        """
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers()
+        main._setup_templates_parser(subparsers)
+        return parser.parse_args(*args)
+
+    def test_templates_parser_func_compile_templates(self):
+        """templates compile action function is template.compile_templates
+        """
+        args = self._parse_args('templates compile'.split())
+        self.assertEqual(args.func, main.template.compile_templates)
+
+
+class TestStartup(unittest.TestCase):
+    """Startup time of the command line tool.
+    """
+    # Modules that no sub-command needs just to start:
+    heavy_modules = ("mako", "jinja2", "http.server", "asyncio",
+                     "multiprocessing", "pkg_resources", "zipfile")
+    # Microseconds to import blogofile.main, with plenty of headroom:
+    budget = 500000
+
+    def _import_times(self):
+        """Import blogofile.main in a new interpreter, and return the
+        cumulative import time of each module, from python -X importtime.
+        """
+        root = os.path.dirname(os.path.dirname(main.__file__))
+        process = subprocess.Popen(
+            [sys.executable, "-X", "importtime", "-c",
+             "import blogofile.main"],
+            cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        times = {}
+        for line in stderr.decode("utf-8").splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            self_us, cumulative, name = line[12:].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+        return times
+
+    @unittest.skipIf(sys.version_info < (3, 7), "needs -X importtime")
+    def test_no_heavy_imports(self):
+        """importing blogofile.main doesn't import template engines,
+        the web server, asyncio or multiprocessing
+        """
+        times = self._import_times()
+        self.assertIn("blogofile.main", times)
+        for name in self.heavy_modules:
+            self.assertNotIn(name, times)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "needs -X importtime")
+    def test_import_time_budget(self):
+        """importing blogofile.main stays within its time budget
+        """
+        times = self._import_times()
+        self.assertLess(times["blogofile.main"], self.budget)
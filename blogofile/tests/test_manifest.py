@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile manifest module.
+"""
+import os
+import shutil
+from tempfile import mkdtemp
+try:
+    import unittest2 as unittest        # For Python 2.6
+except ImportError:
+    import unittest                     # flake8 ignore # NOQA
+from .. import manifest
+
+
+class TestManifest(unittest.TestCase):
+    """Unit tests for the incremental build Manifest.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_site")
+        with open("page.txt", "w") as f:
+            f.write("hello")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+
+    def _make_one(self, config_digest="abc"):
+        return manifest.Manifest(
+            os.path.join(".blogofile-cache", "manifest.json"), config_digest)
+
+    def _build(self, m, source, output):
+        m.begin(source)
+        with open(os.path.join("_site", output), "w") as f:
+            f.write("out")
+        m.add_output(output)
+        m.end()
+        m.save()
+
+    def test_load_without_previous_build(self):
+        """load returns False when there is no previous manifest
+        """
+        self.assertFalse(self._make_one().load())
+
+    def test_unchanged_source(self):
+        """is_unchanged is True for an untouched source with its outputs
+        """
+        self._build(self._make_one(), "page.txt", "page.txt")
+        m = self._make_one()
+        self.assertTrue(m.load())
+        self.assertTrue(m.is_unchanged("page.txt", "_site"))
+
+    def test_changed_source(self):
+        """is_unchanged is False once the source content changes
+        """
+        self._build(self._make_one(), "page.txt", "page.txt")
+        with open("page.txt", "w") as f:
+            f.write("hello, world")
+        m = self._make_one()
+        m.load()
+        self.assertFalse(m.is_unchanged("page.txt", "_site"))
+
+    def test_missing_output(self):
+        """is_unchanged is False if an output was deleted from _site
+        """
+        self._build(self._make_one(), "page.txt", "page.txt")
+        os.remove(os.path.join("_site", "page.txt"))
+        m = self._make_one()
+        m.load()
+        self.assertFalse(m.is_unchanged("page.txt", "_site"))
+
+    def test_config_change_discards_manifest(self):
+        """load returns False if the config digest changed
+        """
+        self._build(self._make_one(), "page.txt", "page.txt")
+        m = self._make_one(config_digest="def")
+        self.assertFalse(m.load())
+        self.assertFalse(m.is_unchanged("page.txt", "_site"))
+
+    def test_stale_outputs(self):
+        """outputs not produced by the current build are stale
+        """
+        self._build(self._make_one(), "page.txt", "page.txt")
+        m = self._make_one()
+        m.load()
+        m.add_output("index.html")
+        self.assertEqual(m.stale_outputs(), ["page.txt"])
+
+    def test_kept_outputs_are_not_stale(self):
+        """outputs of sources carried over from the last build are kept
+        """
+        self._build(self._make_one(), "page.txt", "page.txt")
+        m = self._make_one()
+        m.load()
+        m.keep("page.txt")
+        self.assertEqual(m.stale_outputs(), [])
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 """Unit tests for blogofile plugin module.
 """
+import os
+import shutil
+import sys
+from tempfile import mkdtemp
 try:
     import unittest2 as unittest        # For Python 2.6
 except ImportError:
     import unittest                     # flake8 ignore # NOQA
 from mock import Mock
 from mock import patch
+from .. import cache
+from .. import config
 from .. import plugin
+from .. import plugin_index
 
 
 class TestGetByName(unittest.TestCase):
@@ -19,9 +26,159 @@ class TestGetByName(unittest.TestCase):
         return plugin.get_by_name(*args)
 
     def test_get_by_name(self):
-        """get_by_name returns plugin with matching name
+        """get_by_name returns the module of the plugin with matching name
         """
         mock_plugin = Mock(__dist__={'config_name': 'foo'})
         with patch.object(plugin, 'iter_plugins', return_value=[mock_plugin]):
             p = self._call_fut('foo')
-        self.assertEqual(p, mock_plugin)
+        self.assertEqual(p, mock_plugin.load.return_value)
+
+
+class InstalledPluginsMixin(object):
+    """Plugins installed in a temporary site-packages directory.
+    """
+    def setUp(self):
+        self.path = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self._install("bf_index_one")
+        sys.path.insert(0, self.path)
+        self.addCleanup(sys.path.remove, self.path)
+        cache_home = mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_home)
+        environ = patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home})
+        environ.start()
+        self.addCleanup(environ.stop)
+        plugin_index.reset()
+        self.addCleanup(plugin_index.reset)
+        self.addCleanup(self._forget_modules)
+
+    def _install(self, name):
+        """Install a plugin called name in the temporary site-packages.
+        """
+        os.mkdir(os.path.join(self.path, name))
+        with open(os.path.join(self.path, name, "__init__.py"), "w") as f:
+            f.write("def setup(parser, parser_template):\n"
+                    "    parser.add_argument('--shout')\n"
+                    "__dist__ = {{'config_name': '{0}', 'name': '{0}',\n"
+                    "            'version': '0.1', 'author': 'Joe',\n"
+                    "            'url': 'http://example.com',\n"
+                    "            'description': 'Testing',\n"
+                    "            'command_parser_setup': setup}}\n"
+                    "from blogofile.cache import HierarchicalCache as HC\n"
+                    "config = HC(greeting='hello', colour='red',\n"
+                    "            post=HC(per_page=5, layout='full'))\n"
+                    .format(name))
+        dist_info = os.path.join(self.path, name + "-0.1.dist-info")
+        os.mkdir(dist_info)
+        with open(os.path.join(dist_info, "METADATA"), "w") as f:
+            f.write("Metadata-Version: 2.1\nName: {0}\nVersion: 0.1\n"
+                    .format(name))
+        with open(os.path.join(dist_info, "entry_points.txt"), "w") as f:
+            f.write("[blogofile.plugins]\n{0} = {0}\n".format(name))
+
+    def _forget_modules(self):
+        for name in ("bf_index_one", "bf_index_two"):
+            sys.modules.pop(name, None)
+
+    def _names(self):
+        return sorted(p.__dist__["config_name"]
+                      for p in plugin_index.get_plugins()
+                      if p.__dist__["config_name"].startswith("bf_index"))
+
+
+class TestPluginIndex(InstalledPluginsMixin, unittest.TestCase):
+    """Unit tests for the cached index of installed plugins.
+    """
+    def test_metadata_without_import(self):
+        """a cached index has the metadata, without importing the plugin
+        """
+        plugin_index.get_plugins()
+        self.assertTrue(os.path.exists(plugin_index.get_index_path()))
+        plugin_index.reset()
+        self._forget_modules()
+        p = [p for p in plugin_index.get_plugins()
+             if p.__dist__["config_name"] == "bf_index_one"][0]
+        self.assertEqual(p.__dist__["version"], "0.1")
+        self.assertTrue(p.has_commands)
+        self.assertNotIn("bf_index_one", sys.modules)
+        self.assertEqual(p.load().__name__, "bf_index_one")
+
+    def test_invalidated_by_install(self):
+        """installing a plugin rebuilds the index
+        """
+        self.assertEqual(self._names(), ["bf_index_one"])
+        self._install("bf_index_two")
+        os.utime(self.path, (0, 0))
+        plugin_index.reset()
+        self.assertEqual(self._names(), ["bf_index_one", "bf_index_two"])
+
+    def test_lazy_command_parser(self):
+        """a plugin's commands are set up when they are used
+        """
+        from .. import main
+        plugin_index.get_plugins()
+        plugin_index.reset()
+        self._forget_modules()
+        parser, subparsers = main.setup_command_parser()
+        self.assertNotIn("bf_index_one", sys.modules)
+        args = parser.parse_args(["bf_index_one", "--shout", "hey"])
+        self.assertEqual(args.shout, "hey")
+
+
+class TestLoadEnabledPlugins(InstalledPluginsMixin, unittest.TestCase):
+    """Unit tests for loading only the plugins _config.py enables.
+    """
+    def setUp(self):
+        InstalledPluginsMixin.setUp(self)
+        self._install("bf_index_two")
+        # Index the plugins, as a previous run would have:
+        plugin_index.get_plugins()
+        plugin_index.reset()
+        self._forget_modules()
+        site_path = mkdtemp()
+        self.addCleanup(shutil.rmtree, site_path)
+        self.previous_dir = os.getcwd()
+        self.addCleanup(os.chdir, self.previous_dir)
+        os.chdir(site_path)
+        self.addCleanup(cache.reset_bf)
+        self.addCleanup(config.reset_config)
+        with open("_config.py", "w") as f:
+            f.write("post = plugins.bf_index_one.post\n"
+                    "post.layout = 'summary'\n"
+                    "plugins.bf_index_one.enabled = True\n"
+                    "one = plugins.bf_index_one\n"
+                    "one.colour = 'blue'\n"
+                    "greeting = one.greeting + ', world'\n"
+                    "post.per_page = post.per_page * 2\n"
+                    "plugins.bf_index_two.colour = 'green'\n")
+        cache.reset_bf()
+        config.init("_config.py")
+
+    def test_enabled_plugin_loaded(self):
+        """an enabled plugin is imported, with the settings of _config.py
+        """
+        one = config.plugins.bf_index_one
+        self.assertEqual(one.mod.__name__, "bf_index_one")
+        self.assertEqual(one.colour, "blue")
+        self.assertEqual(one.greeting, "hello")
+        self.assertTrue(config.one is one)
+
+    def test_defaults_seen_once_enabled(self):
+        """_config.py reads an enabled plugin's defaults
+        """
+        self.assertEqual(config.greeting, "hello, world")
+
+    def test_nested_alias(self):
+        """settings made through an alias of a nested stub aren't lost
+        """
+        post = config.plugins.bf_index_one.post
+        self.assertTrue(config.post is post)
+        self.assertEqual(post.layout, "summary")
+        self.assertEqual(post.per_page, 10)
+
+    def test_disabled_plugin_stays_stub(self):
+        """a plugin that isn't enabled isn't imported
+        """
+        self.assertNotIn("bf_index_two", sys.modules)
+        self.assertNotIn("mod", config.plugins.bf_index_two)
+        self.assertEqual(config.plugins.bf_index_two.colour, "green")
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile template module.
+"""
+import os
+import shutil
+from tempfile import mkdtemp
+try:
+    import unittest2 as unittest        # For Python 2.6
+except ImportError:
+    import unittest                     # flake8 ignore # NOQA
+import jinja2
+import mako.lookup
+from mock import patch
+from .. import cache
+from .. import config
+from .. import template
+from .. import writer
+
+
+class TestCompiledTemplateCache(unittest.TestCase):
+    """Unit tests for the on-disk compiled template cache.
+    """
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.addCleanup(config.reset_config)
+        config.templates.cache_dir = self.cache_dir
+        self.lookup = mako.lookup.TemplateLookup(
+            modulename_callable=template.mako_module_filename)
+
+    def _modules(self, engine_name):
+        return sorted(os.listdir(os.path.join(self.cache_dir, engine_name)))
+
+    def test_mako_module_is_reused(self):
+        """identical Mako source is only compiled once
+        """
+        t = template.compile_mako(self.lookup, src="${1 + 1}")
+        modules = self._modules("mako")
+        t2 = template.compile_mako(self.lookup, src="${1 + 1}")
+        self.assertEqual(self._modules("mako"), modules)
+        self.assertEqual(t.render(), t2.render())
+        self.assertEqual(t2.render(), b"2")
+
+    def test_mako_changed_source_compiles_again(self):
+        """a changed template gets a module of its own
+        """
+        path = os.path.join(self.cache_dir, "page.mako")
+        with open(path, "w") as f:
+            f.write("one")
+        template.compile_mako(self.lookup, filename=path)
+        with open(path, "w") as f:
+            f.write("two")
+        t = template.compile_mako(self.lookup, filename=path)
+        self.assertEqual(t.render(), b"two")
+        self.assertEqual(
+            len([m for m in self._modules("mako") if m.endswith(".py")]), 2)
+
+    def test_mako_cache_turned_off(self):
+        """nothing is written without templates.cache_dir
+        """
+        config.templates.cache_dir = None
+        t = template.compile_mako(self.lookup, src="${1 + 1}")
+        self.assertEqual(t.render(), b"2")
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_jinja_bytecode_is_cached(self):
+        """Jinja2 source compiles through the bytecode cache
+        """
+        env = template.jinja_environment(jinja2.DictLoader({}))
+        t = template.compile_jinja(env, "{{ 1 + 1 }}")
+        self.assertEqual(t.render(), "2")
+        self.assertEqual(len(self._modules("jinja2")), 1)
+        t = template.compile_jinja(env, "{{ 1 + 1 }}")
+        self.assertEqual(t.render(), "2")
+        self.assertEqual(len(self._modules("jinja2")), 1)
+
+
+class TestCompiledTemplateLRU(unittest.TestCase):
+    """Unit tests for the in-process cache of compiled file templates.
+    """
+    def setUp(self):
+        self.tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, "page.mako")
+        with open(self.path, "w") as f:
+            f.write("one")
+        self.cache = template.CompiledTemplateCache(maxsize=2)
+        self.compiled = []
+
+    def _compile(self):
+        self.compiled.append(self.path)
+        return len(self.compiled)
+
+    def test_compiled_once(self):
+        """a template file is only compiled once while it is unchanged
+        """
+        self.assertEqual(self.cache.get(self.path, None, self._compile), 1)
+        self.assertEqual(self.cache.get(self.path, None, self._compile), 1)
+        self.assertEqual(len(self.compiled), 1)
+
+    def test_modified_template_compiled_again(self):
+        """a new mtime means a new compiled template
+        """
+        self.cache.get(self.path, None, self._compile)
+        os.utime(self.path, (0, 0))
+        self.assertEqual(self.cache.get(self.path, None, self._compile), 2)
+
+    def test_keyed_by_lookup(self):
+        """the same file compiled for another lookup is compiled again
+        """
+        self.cache.get(self.path, "lookup1", self._compile)
+        self.assertEqual(
+            self.cache.get(self.path, "lookup2", self._compile), 2)
+
+    def test_least_recently_used_is_evicted(self):
+        """the cache holds at most maxsize templates
+        """
+        self.cache.get(self.path, "lookup1", self._compile)
+        self.cache.get(self.path, "lookup2", self._compile)
+        self.cache.get(self.path, "lookup1", self._compile)
+        self.cache.get(self.path, "lookup3", self._compile)
+        # lookup2 was evicted, lookup1 wasn't:
+        self.assertEqual(
+            self.cache.get(self.path, "lookup1", self._compile), 1)
+        self.assertEqual(
+            self.cache.get(self.path, "lookup2", self._compile), 4)
+
+
+class TestAlternateBaseEngine(unittest.TestCase):
+    """Unit tests for rendering templates in another engine than the
+    base template's.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_templates")
+        with open("_config.py", "w") as f:
+            f.write("")
+        with open(os.path.join("_templates", "site.mako"), "w") as f:
+            f.write("<html>${next.body()}</html>")
+        for page in ("one", "two"):
+            with open(page + ".html.jinja2", "w") as f:
+                f.write('{% extends "bf_base_template" %}'
+                        '{% block content %}' + page + '{% endblock %}')
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def _build(self):
+        cache.reset_bf()
+        config.init("_config.py")
+        writer.Writer(output_dir="_site").write_site()
+
+    def _read(self, path):
+        with open(os.path.join("_site", path)) as f:
+            return f.read()
+
+    def test_base_template_converted_once(self):
+        """the base template is converted once for all the pages
+        """
+        with patch.object(template.MakoTemplate, "render", autospec=True,
+                          side_effect=template.MakoTemplate.render) \
+                as mock_render:
+            self._build()
+        self.assertEqual(mock_render.call_count, 1)
+        self.assertEqual(self._read("one.html"), "<html>one</html>")
+        self.assertEqual(self._read("two.html"), "<html>two</html>")
+
+
+class TestStreamingRender(unittest.TestCase):
+    """Unit tests for rendering templates straight into their output file.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_templates")
+        with open("_config.py", "w") as f:
+            f.write("site.write_if_changed = True\n")
+        with open(os.path.join("_templates", "site.mako"), "w") as f:
+            f.write("<html>${next.body()}</html>")
+        with open("mako.html.mako", "w") as f:
+            f.write('<%inherit file="bf_base_template" />\n'
+                    '% for i in range(3):\n${i}\n% endfor\n')
+        with open("jinja.html.jinja2", "w") as f:
+            f.write("{% for i in range(3) %}{{ i }}\n{% endfor %}")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def _build(self):
+        cache.reset_bf()
+        config.init("_config.py")
+        writer.Writer(output_dir="_site").write_site()
+
+    def _read(self, path):
+        with open(os.path.join("_site", path)) as f:
+            return f.read()
+
+    def test_mako_output(self):
+        """streamed Mako output is the same as rendered output
+        """
+        self._build()
+        self.assertEqual(self._read("mako.html"), "<html>\n0\n1\n2\n</html>")
+
+    def test_jinja_output(self):
+        """streamed Jinja2 output is the same as rendered output
+        """
+        self._build()
+        self.assertEqual(self._read("jinja.html"), "0\n1\n2\n")
+
+    def test_unchanged_output_left_alone(self):
+        """with write_if_changed, identical streamed output isn't replaced
+        """
+        self._build()
+        os.utime(os.path.join("_site", "mako.html"), (0, 0))
+        self._build()
+        self.assertEqual(
+            os.stat(os.path.join("_site", "mako.html")).st_mtime, 0)
+        self.assertEqual(sorted(os.listdir("_site")),
+                         ["jinja.html", "mako.html"])
+
+
+class TestMaterializeMany(unittest.TestCase):
+    """Unit tests for rendering a template to many pages at once.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_templates")
+        os.mkdir("_controllers")
+        with open(os.path.join("_templates", "site.mako"), "w") as f:
+            f.write("<html>${next.body()}</html>")
+        with open(os.path.join("_templates", "page.mako"), "w") as f:
+            f.write('<%inherit file="bf_base_template" />${n}')
+        with open(os.path.join("_controllers", "pages.py"), "w") as f:
+            f.write(
+                "from blogofile.cache import bf\n"
+                "def run():\n"
+                "    pages = ((str(n) + '.html', {'n': n})\n"
+                "             for n in range(10))\n"
+                "    bf.template.materialize_many(\n"
+                "        'page.mako', pages,\n"
+                "        workers=bf.config.controllers.pages.workers)\n")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def _build(self, workers):
+        with open("_config.py", "w") as f:
+            f.write("controllers.pages.enabled = True\n"
+                    "controllers.pages.workers = {0}\n".format(workers))
+        cache.reset_bf()
+        config.init("_config.py")
+        site_writer = writer.Writer(output_dir="_site")
+        site_writer.write_site()
+        return site_writer
+
+    def _check(self, site_writer):
+        for n in range(10):
+            path = str(n) + ".html"
+            with open(os.path.join("_site", path)) as f:
+                self.assertEqual(f.read(), "<html>{0}</html>".format(n))
+            self.assertIn(path, site_writer.written)
+
+    def test_serial(self):
+        """every page is rendered with its own attrs
+        """
+        self._check(self._build(None))
+
+    def test_workers(self):
+        """pages rendered by workers are recorded by the build
+        """
+        site_writer = self._build(2)
+        self._check(site_writer)
+        self.assertEqual(site_writer.stats["written"], 10)
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for blogofile writer module.
+"""
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+try:
+    import unittest2 as unittest        # For Python 2.6
+except ImportError:
+    import unittest                     # flake8 ignore # NOQA
+from .. import cache
+from .. import config
+from .. import template
+from .. import writer
+
+
+class TestSyncOutputMode(unittest.TestCase):
+    """Unit tests for building with site.output_mode = "sync".
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        with open("_config.py", "w") as f:
+            f.write('site.output_mode = "sync"\n')
+        with open("style.css", "w") as f:
+            f.write("body {}")
+        with open("robots.txt", "w") as f:
+            f.write("User-agent: *")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+
+    def _build(self):
+        cache.reset_bf()
+        config.init("_config.py")
+        writer.Writer(output_dir="_site").write_site()
+
+    def test_site_dir_keeps_inode(self):
+        """the _site directory itself is never replaced
+        """
+        self._build()
+        inode = os.stat("_site").st_ino
+        self._build()
+        self.assertEqual(os.stat("_site").st_ino, inode)
+
+    def test_unchanged_files_are_left_alone(self):
+        """files with the same contents aren't replaced
+        """
+        self._build()
+        os.utime(os.path.join("_site", "style.css"), (0, 0))
+        self._build()
+        self.assertEqual(
+            os.stat(os.path.join("_site", "style.css")).st_mtime, 0)
+
+    def test_changed_files_are_replaced(self):
+        """files with different contents are moved into place
+        """
+        self._build()
+        with open("style.css", "w") as f:
+            f.write("body { color: red }")
+        self._build()
+        with open(os.path.join("_site", "style.css")) as f:
+            self.assertEqual(f.read(), "body { color: red }")
+
+    def test_files_no_longer_produced_are_removed(self):
+        """outputs whose source went away are removed from _site
+        """
+        self._build()
+        os.remove("robots.txt")
+        self._build()
+        self.assertEqual(os.listdir("_site"), ["style.css"])
+
+    def test_removal_ignores_mtimes(self):
+        """outputs no longer produced are removed, whatever their mtime
+        """
+        self._build()
+        os.remove("robots.txt")
+        leftover = os.path.join("_site", "robots.txt")
+        future = time.time() + 3600
+        os.utime(leftover, (future, future))
+        self._build()
+        self.assertFalse(os.path.exists(leftover))
+
+    def test_files_written_into_site_dir_are_kept(self):
+        """files controllers write straight into _site aren't removed
+        """
+        os.mkdir("_controllers")
+        with open(os.path.join("_controllers", "direct.py"), "w") as f:
+            f.write("import os, shutil\n"
+                    "from blogofile import util\n"
+                    "def run():\n"
+                    "    path = util.fs_site_path_helper('_site', 'img')\n"
+                    "    if not os.path.isdir(path):\n"
+                    "        os.makedirs(path)\n"
+                    "    shutil.copy('robots.txt', os.path.join(path, 'a'))\n")
+        with open("_config.py", "a") as f:
+            f.write("controllers.direct.enabled = True\n")
+        self._build()
+        self._build()
+        self.assertEqual(os.listdir(os.path.join("_site", "img")), ["a"])
+        self.assertEqual(sorted(os.listdir("_site")),
+                         ["img", "robots.txt", "style.css"])
+
+    def test_staging_dir_not_copied_into_itself(self):
+        """the cache dir is skipped even if the ignore patterns don't
+        """
+        with open("_config.py", "a") as f:
+            f.write('site.file_ignore_patterns = [".*/_.*"]\n')
+        self._build()
+        self.assertEqual(sorted(os.listdir("_site")),
+                         ["robots.txt", "style.css"])
+
+    def test_staging_dir_is_cleaned_up(self):
+        """the staging directory is removed after the build
+        """
+        self._build()
+        self.assertFalse(os.path.exists(
+            os.path.join(".blogofile-cache", "staging")))
+
+
+class TestWriteIfChanged(unittest.TestCase):
+    """Unit tests for building with site.write_if_changed = True.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        with open("_config.py", "w") as f:
+            f.write('site.write_if_changed = True\n')
+        with open("style.css", "w") as f:
+            f.write("body {}")
+        with open("robots.txt", "w") as f:
+            f.write("User-agent: *")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+
+    def _build(self):
+        cache.reset_bf()
+        config.init("_config.py")
+        site_writer = writer.Writer(output_dir="_site")
+        site_writer.write_site()
+        return site_writer
+
+    def test_unchanged_files_are_left_alone(self):
+        """files with the same contents aren't written again
+        """
+        self._build()
+        os.utime(os.path.join("_site", "style.css"), (0, 0))
+        site_writer = self._build()
+        self.assertEqual(
+            os.stat(os.path.join("_site", "style.css")).st_mtime, 0)
+        self.assertEqual(site_writer.copier.stats["skipped"], 2)
+
+    def test_changed_files_are_written(self):
+        """files with different contents are written
+        """
+        self._build()
+        with open("style.css", "w") as f:
+            f.write("body { color: red }")
+        site_writer = self._build()
+        with open(os.path.join("_site", "style.css")) as f:
+            self.assertEqual(f.read(), "body { color: red }")
+        self.assertEqual(site_writer.copier.stats["copied"], 1)
+
+    def test_files_no_longer_produced_are_removed(self):
+        """outputs whose source went away are removed from _site
+        """
+        self._build()
+        os.remove("robots.txt")
+        self._build()
+        self.assertEqual(os.listdir("_site"), ["style.css"])
+
+    def test_removal_ignores_mtimes(self):
+        """outputs no longer produced are removed, whatever their mtime
+        """
+        self._build()
+        os.remove("robots.txt")
+        leftover = os.path.join("_site", "robots.txt")
+        future = time.time() + 3600
+        os.utime(leftover, (future, future))
+        self._build()
+        self.assertFalse(os.path.exists(leftover))
+
+    def test_files_without_owner_are_kept(self):
+        """files the build didn't record writing are never removed
+        """
+        os.mkdir("_controllers")
+        with open(os.path.join("_controllers", "direct.py"), "w") as f:
+            f.write("import os, shutil\n"
+                    "def run():\n"
+                    "    os.mkdir(os.path.join('_site', 'direct'))\n"
+                    "    with open('_site/direct/a.txt', 'w') as f:\n"
+                    "        f.write('a')\n"
+                    "    shutil.copy('robots.txt', '_site/direct/b.txt')\n")
+        with open("_config.py", "a") as f:
+            f.write("controllers.direct.enabled = True\n")
+        self._build()
+        self.assertEqual(sorted(os.listdir(os.path.join("_site", "direct"))),
+                         ["a.txt", "b.txt"])
+        leftover = os.path.join("_site", "leftover.txt")
+        with open(leftover, "w") as f:
+            f.write("left over")
+        shutil.rmtree(os.path.join("_site", "direct"))
+        self._build()
+        self.assertEqual(sorted(os.listdir(os.path.join("_site", "direct"))),
+                         ["a.txt", "b.txt"])
+        self.assertTrue(os.path.exists(leftover))
+
+
+class TestAutoCopyMode(unittest.TestCase):
+    """Unit tests for building with site.copy_mode = "auto".
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        with open("_config.py", "w") as f:
+            f.write('site.copy_mode = "auto"\n')
+        with open("style.css", "w") as f:
+            f.write("body {}")
+        with open("robots.txt", "w") as f:
+            f.write("User-agent: *")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+
+    def _build(self):
+        cache.reset_bf()
+        config.init("_config.py")
+        site_writer = writer.Writer(output_dir="_site")
+        site_writer.write_site()
+        return site_writer
+
+    def test_unchanged_files_are_skipped(self):
+        """_site is kept, so unchanged static files aren't copied again
+        """
+        self._build()
+        site_writer = self._build()
+        self.assertEqual(site_writer.copier.stats["skipped"], 2)
+        self.assertEqual(site_writer.copier.stats["copied"], 0)
+
+    def test_files_no_longer_produced_are_removed(self):
+        """outputs whose source went away are removed from _site
+        """
+        self._build()
+        os.remove("robots.txt")
+        self._build()
+        self.assertEqual(os.listdir("_site"), ["style.css"])
+
+
+class TestIncrementalBuild(unittest.TestCase):
+    """Unit tests for building with site.incremental = True.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_controllers")
+        os.mkdir("_data")
+        os.mkdir("_templates")
+        with open(os.path.join("_templates", "site.mako"), "w") as f:
+            f.write("${next.body()}")
+        with open("_config.py", "w") as f:
+            f.write("site.incremental = True\n"
+                    "controllers.data.enabled = True\n")
+        with open(os.path.join("_controllers", "data.py"), "w") as f:
+            f.write("from blogofile.cache import bf\n"
+                    "def run():\n"
+                    "    with open('_data/value.txt') as f:\n"
+                    "        bf.config.site.value = f.read()\n")
+        with open(os.path.join("_data", "value.txt"), "w") as f:
+            f.write("one")
+        with open("value.html.mako", "w") as f:
+            f.write("value=${bf.config.site.value}")
+        with open("style.css", "w") as f:
+            f.write("body {}")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def _build(self):
+        cache.reset_bf()
+        config.init("_config.py")
+        writer.Writer(output_dir="_site").write_site()
+
+    def test_unchanged_static_files_are_skipped(self):
+        """static files that didn't change aren't copied again
+        """
+        self._build()
+        os.utime(os.path.join("_site", "style.css"), (0, 0))
+        self._build()
+        self.assertEqual(
+            os.stat(os.path.join("_site", "style.css")).st_mtime, 0)
+
+    def test_templates_are_rendered_again(self):
+        """unchanged templates see what the controllers set up this time
+        """
+        self._build()
+        with open(os.path.join("_data", "value.txt"), "w") as f:
+            f.write("two")
+        self._build()
+        with open(os.path.join("_site", "value.html")) as f:
+            self.assertEqual(f.read(), "value=two")
+
+    def test_controllers_writing_files_run_again(self):
+        """files controllers wrote themselves don't get in their way
+        """
+        with open(os.path.join("_controllers", "gallery.py"), "w") as f:
+            f.write("import shutil\n"
+                    "def run():\n"
+                    "    shutil.copytree('_data', '_site/gallery/img')\n")
+        with open("_config.py", "a") as f:
+            f.write("controllers.gallery.enabled = True\n")
+        self._build()
+        with open(os.path.join("_data", "value.txt"), "w") as f:
+            f.write("two")
+        self._build()
+        with open(os.path.join("_site", "gallery", "img", "value.txt")) as f:
+            self.assertEqual(f.read(), "two")
+        self._build()
+        self.assertEqual(os.listdir(os.path.join("_site", "gallery", "img")),
+                         ["value.txt"])
+
+
+class TestJobs(unittest.TestCase):
+    """Unit tests for rendering templates with site.jobs worker processes.
+    """
+    def setUp(self):
+        self.previous_dir = os.getcwd()
+        self.build_path = mkdtemp()
+        os.chdir(self.build_path)
+        os.mkdir("_templates")
+        with open(os.path.join("_templates", "site.mako"), "w") as f:
+            f.write("${next.body()}")
+        with open("_config.py", "w") as f:
+            f.write("")
+        for name in ("one", "two", "three", "four"):
+            with open(name + ".html.mako", "w") as f:
+                f.write("template " + name)
+        # Written to the same locations as two of the templates:
+        with open("two.html", "w") as f:
+            f.write("static two")
+        with open("four.html", "w") as f:
+            f.write("static four")
+
+    def tearDown(self):
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.build_path)
+        config.reset_config()
+        cache.reset_bf()
+        template.MakoTemplate.template_lookup = None
+        template.JinjaTemplate.template_lookup = None
+
+    def _build(self, jobs, output_dir):
+        cache.reset_bf()
+        config.init("_config.py")
+        config.site.jobs = jobs
+        writer.Writer(output_dir=output_dir).write_site()
+        contents = {}
+        for fn in os.listdir(output_dir):
+            with open(os.path.join(output_dir, fn)) as f:
+                contents[fn] = f.read()
+        return contents
+
+    def test_same_output_as_serial_build(self):
+        """outputs written more than once end up the same as with one job
+        """
+        self.assertEqual(self._build(2, "_site_parallel"),
+                         self._build(1, "_site_serial"))
@@ -3,6 +3,7 @@ from __future__ import print_function
 import re
 import os
 import sys
+import hashlib
 import logging
 import fileinput
 try:
@@ -66,6 +67,141 @@ def mkdir(newdir):
             os.mkdir(newdir)
 
 
+def file_digest(path, block_size=65536):
+    """Return the sha1 hex digest of a file's contents.
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def same_contents(path, other):
+    """Does the file at path contain exactly other?
+
+    other can be the path of another file, or a bytes object. Sizes
+    are compared first, so the contents only get hashed when they
+    might be identical.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    if isinstance(other, bytes):
+        if size != len(other):
+            return False
+        return file_digest(path) == hashlib.sha1(other).hexdigest()
+    try:
+        if size != os.path.getsize(other):
+            return False
+    except OSError:
+        return False
+    return file_digest(path) == file_digest(other)
+
+
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst if it already exists.
+
+    This is atomic on POSIX, and as close as we can get elsewhere.
+    """
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python < 3.3
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def remove_empty_dirs(path, root):
+    """Remove path, and its parents up to (but not including) root,
+    for as long as they are empty.
+    """
+    root = os.path.abspath(root)
+    path = os.path.abspath(path)
+    while path != root and path.startswith(root):
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+        path = os.path.dirname(path)
+
+
+def job_count(jobs):
+    """Number of parallel jobs to use for a jobs setting.
+
+    0 or None means one job per CPU.
+    """
+    import multiprocessing
+    if not jobs:
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+    return max(1, int(jobs))
+
+
+def can_fork(ignore_event_loop=False):
+    """Can this process fork worker processes right now?
+
+    Not where there's no fork() (Windows), nor in a worker process
+    itself (they can't have children), nor from any thread but the main
+    one, nor while any other thread is alive: the child would only have
+    the forking thread, and could find the locks of the others held
+    forever. Nor while coroutines run on the shared event loop.
+
+    If ignore_event_loop is True, the thread of an idle event loop
+    doesn't count: it can be stopped before forking, see
+    event_loop.prepare_fork.
+    """
+    import multiprocessing
+    import threading
+    from . import event_loop
+    if not hasattr(os, "fork") or multiprocessing.current_process().daemon:
+        return False
+    if event_loop.is_busy():
+        return False
+    try:
+        main_thread = threading.main_thread()
+    except AttributeError:
+        # Python < 3.4
+        main_thread = None
+    if main_thread is not None and \
+            threading.current_thread() is not main_thread:
+        return False
+    if ignore_event_loop:
+        current = threading.current_thread()
+        return not [t for t in threading.enumerate() if t is not current
+                    and not event_loop.is_loop_thread(t)]
+    return threading.active_count() == 1
+
+
+def process_pool(jobs, initializer=None, initargs=()):
+    """Start a pool of jobs worker processes forked from this one.
+
+    Forked workers inherit the loaded config, filters, controllers and
+    template lookups, so they can render anything this process can.
+    initializer, if given, is called with initargs in each worker.
+    Returns None if workers can't be forked now (see can_fork), callers
+    do the work serially then.
+    """
+    import multiprocessing
+    from . import event_loop
+    if not can_fork(ignore_event_loop=True) or \
+            not event_loop.prepare_fork() or not can_fork():
+        return None
+    try:
+        context = multiprocessing.get_context("fork")
+    except AttributeError:
+        # Python < 3.4, fork is the only start method on POSIX
+        context = multiprocessing
+    return context.Pool(jobs, initializer, initargs)
+
+
 def url_path_helper(*parts):
     """
     path_parts is a sequence of path parts to concatenate
@@ -5,17 +5,26 @@ the current working directory.
 
 __author__ = "Ryan McGuire (ryan@enigmacurry.com)"
 
+import collections
+import errno
+import fnmatch
+import hashlib
 import logging
 import os
 import re
 import shutil
 import tempfile
+import traceback
 
 from . import util
 from . import config
 from . import cache
 from . import filter as _filter
 from . import controller
+from . import copier
+from . import event_loop
+from . import filter_cache
+from . import manifest
 from . import plugin
 from . import template
 
@@ -23,6 +32,10 @@ from . import template
 logger = logging.getLogger("blogofile.writer")
 
 
+class TemplateRenderError(Exception):
+    pass
+
+
 class Writer(object):
 
     def __init__(self, output_dir):
@@ -31,6 +44,30 @@ class Writer(object):
         # referenced by other templates.
         self.base_template_dir = util.path_join(".", "_templates")
         self.output_dir = output_dir
+        # Where the finished site ends up. In "sync" output mode the
+        # build writes into a staging directory (output_dir) first:
+        self.target_dir = output_dir
+        self.staging_dir = None
+        # The incremental build manifest, if site.incremental is on:
+        self.manifest = None
+        # Paths (relative to output_dir) written during this build:
+        self.written = set()
+        # Paths (relative to target_dir) the previous build recorded:
+        self.previous_outputs = set()
+        # Files controllers wrote into target_dir without add_output, in
+        # the previous build and in this one:
+        self.previous_controller_outputs = set()
+        self.controller_outputs = set()
+        # target_dir before the controllers ran:
+        self.controllers_snapshot = None
+        # Is output_dir empty at the start of the build?
+        self.fresh_output_dir = True
+        # Files written, and files left alone by site.write_if_changed:
+        self.stats = {"written": 0, "unchanged": 0}
+        # Outputs written by the job a worker process is running:
+        self.captured_outputs = None
+        # Number of processes used to render templates:
+        self.jobs = util.job_count(self.config.site.jobs)
 
     def __load_bf_cache(self):
         # Template cache object, used to transfer state to/from each template:
@@ -39,17 +76,111 @@ class Writer(object):
         self.bf.logger = logger
 
     def write_site(self):
+        # Converted base templates last for one build:
+        template.converted_base_templates.clear()
         self.__load_bf_cache()
         self.__setup_temp_dir()
         try:
+            self.__setup_manifest()
+            self.__setup_filter_cache()
             self.__setup_output_dir()
             self.__calculate_template_files()
             self.__init_plugins()
             self.__init_filters_controllers()
             self.__run_controllers()
-            self.__write_files()
+            self.__setup_copier()
+            try:
+                self.__write_files()
+            finally:
+                self.copier.shutdown()
+            self.__sync_output_dir()
+            self.__prune_output_dir()
+            self.__finish_manifest()
+            self.__save_outputs()
+            self.__report()
+            self.__finish_filter_cache()
         finally:
+            _filter.output_cache = None
+            event_loop.shutdown()
             self.__delete_temp_dir()
+            self.__delete_staging_dir()
+
+    def add_output(self, path):
+        """Record that path (relative to output_dir) was written by this build.
+
+        Templates do this on their own; controllers that write files
+        directly can call this so incremental builds know about them.
+        """
+        path = os.path.normpath(path)
+        self.written.add(path)
+        if self.captured_outputs is not None:
+            self.captured_outputs.append(path)
+        if self.manifest is not None:
+            self.manifest.add_output(path)
+
+    def capture_outputs(self, func, *args):
+        """Call func(*args) in a worker process, capturing what it writes.
+
+        Returns (outputs written, write stats, formatted traceback or
+        None) for the parent process to pass to merge_outputs.
+        """
+        self.captured_outputs = []
+        stats = self.stats
+        self.stats = dict((k, 0) for k in stats)
+        cache_stats = self.__filter_cache_stats()
+        try:
+            func(*args)
+        except Exception:
+            return None, None, traceback.format_exc()
+        finally:
+            outputs, self.captured_outputs = self.captured_outputs, None
+            stats, self.stats = self.stats, stats
+        for stat, count in self.__filter_cache_stats().items():
+            stats[stat] = count - cache_stats[stat]
+        return outputs, stats, None
+
+    def merge_outputs(self, outputs, stats):
+        """Record the outputs and write stats of a worker process.
+        """
+        for stat, count in stats.items():
+            if stat.startswith("filter_cache_"):
+                _filter.output_cache.stats[stat[13:]] += count
+            else:
+                self.stats[stat] += count
+        for out in outputs:
+            self.add_output(out)
+
+    def __filter_cache_stats(self):
+        if _filter.output_cache is None:
+            return {}
+        return dict(("filter_cache_" + k, v)
+                    for k, v in _filter.output_cache.stats.items())
+
+    def __setup_filter_cache(self):
+        cache_dir = self.config.site.filter_cache_dir
+        if cache_dir:
+            _filter.output_cache = filter_cache.FilterCache(
+                cache_dir, self.config.site.filter_cache_size)
+        else:
+            _filter.output_cache = None
+
+    def __finish_filter_cache(self):
+        if _filter.output_cache is None:
+            return
+        stats = _filter.output_cache.stats
+        if stats["hits"] or stats["misses"]:
+            logger.info("Filter cache: {hits} hits, {misses} misses"
+                        .format(**stats))
+        _filter.output_cache.trim()
+
+    def already_written(self, path):
+        """Has path (relative to output_dir) already been written?
+        """
+        if self.fresh_output_dir:
+            return os.path.exists(util.path_join(self.output_dir, path))
+        # The previous outputs are still around, so only this build's
+        # outputs count:
+        return os.path.normpath(path) in self.written
 
     def __setup_temp_dir(self):
         """Create a directory for temporary data.
@@ -66,9 +197,150 @@ class Writer(object):
         "Cleanup and delete temporary directory"
         shutil.rmtree(self.temp_proc_dir)
 
+    def __setup_copier(self):
+        """Create the engine that copies static files to _site.
+        """
+        mode = self.config.site.copy_mode
+        if self.config.site.use_hard_links and mode == "copy":
+            mode = "hardlink"
+        self.copier = copier.CopyEngine(
+            mode, util.job_count(self.config.site.copy_threads),
+            write_if_changed=self.config.site.write_if_changed)
+
+    def __report(self):
+        written = self.stats["written"]
+        unchanged = self.stats["unchanged"]
+        for stat, count in self.copier.stats.items():
+            if stat == "skipped":
+                unchanged += count
+            else:
+                written += count
+        logger.info("Wrote {0} files, {1} unchanged".format(
+                written, unchanged))
+
+    def __config_digest(self):
+        """Digest of everything that, when changed, requires a full rebuild.
+        """
+        plugins = sorted(
+            "{0}={1}".format(name, p.mod.__dist__.get("version"))
+            for name, p in self.config.plugins.items() if "mod" in p)
+        h = hashlib.sha1()
+        h.update(self.bf.__version__.encode("utf-8"))
+        h.update(",".join(plugins).encode("utf-8"))
+        h.update(manifest.tree_digest(
+            ["_config.py", self.base_template_dir]).encode("utf-8"))
+        return h.hexdigest()
+
+    def __setup_manifest(self):
+        """Load the previous build's manifest for incremental builds.
+        """
+        if not self.config.site.incremental:
+            self.manifest = None
+            return
+        self.manifest = manifest.Manifest(
+            util.path_join(self.config.site.cache_dir, "manifest.json"),
+            self.__config_digest())
+        if self.manifest.load():
+            logger.info("Doing an incremental build")
+
+    def __finish_manifest(self):
+        """Remove outputs that are no longer produced and save the manifest.
+        """
+        if self.manifest is None:
+            return
+        for out in self.manifest.stale_outputs():
+            path = util.path_join(self.target_dir, out)
+            logger.info("Removing stale output: " + path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            util.remove_empty_dirs(os.path.dirname(path), self.target_dir)
+        self.manifest.save()
+
+    def __outputs_path(self):
+        """Where the outputs of each build are recorded, or None.
+        """
+        if not self.config.site.cache_dir:
+            return None
+        return util.path_join(self.config.site.cache_dir, "outputs.json")
+
+    def __produced(self):
+        """The outputs of this build: those written, and those kept from
+        the previous build by an incremental build.
+        """
+        produced = set(self.written)
+        produced.update(self.controller_outputs)
+        if self.manifest is not None:
+            produced.update(self.manifest.outputs())
+        return produced
+
+    def __save_outputs(self):
+        path = self.__outputs_path()
+        if path is not None:
+            manifest.save_outputs(path, self.__produced(),
+                                  self.controller_outputs)
+
+    def begin_controllers(self, keep=()):
+        """Get target_dir ready for the controllers to run.
+
+        Files that controllers wrote last time without add_output are
+        removed first, when target_dir was kept from the previous
+        build, so that they can write them again as if target_dir was
+        empty. Those matching keep, the outputs declared by the
+        controllers that are skipped, stay. Then what's in target_dir
+        is remembered, to find what the controllers write.
+        """
+        for rel_path in sorted(self.previous_controller_outputs):
+            if any(fnmatch.fnmatch(rel_path, pattern) or
+                   fnmatch.fnmatch(rel_path, pattern.rstrip("/") + "/*")
+                   for pattern in keep):
+                self.controller_outputs.add(rel_path)
+                continue
+            path = util.path_join(self.target_dir, rel_path)
+            if not os.path.isfile(path) and not os.path.islink(path):
+                continue
+            logger.debug("Removing previous controller output: " + path)
+            os.remove(path)
+            util.remove_empty_dirs(os.path.dirname(path), self.target_dir)
+        self.controllers_snapshot = manifest.snapshot(self.target_dir)
+
+    def __end_controllers(self):
+        """Find the files controllers wrote into target_dir without
+        recording them with add_output.
+        """
+        if self.controllers_snapshot is None:
+            return
+        before = self.controllers_snapshot
+        self.controllers_snapshot = None
+        for rel_path, st in manifest.snapshot(self.target_dir).items():
+            if before.get(rel_path) != st and rel_path not in self.written:
+                self.controller_outputs.add(rel_path)
+
     def __setup_output_dir(self):
         """Setup the staging directory"""
-        if os.path.isdir(self.output_dir):
+        output_mode = self.config.site.output_mode
+        if output_mode not in ("wipe", "sync"):
+            raise ValueError("Unknown site.output_mode: {0}"
+                             .format(output_mode))
+        path = self.__outputs_path()
+        if path is not None:
+            self.previous_outputs, self.previous_controller_outputs = \
+                manifest.load_outputs(path)
+        if output_mode == "sync":
+            # Build into a fresh staging directory, _site is left alone
+            # until __sync_output_dir:
+            self.staging_dir = util.path_join(
+                self.config.site.cache_dir, "staging")
+            self.__delete_staging_dir()
+            util.mkdir(self.staging_dir)
+            self.output_dir = self.staging_dir
+        elif self.__compares_outputs() or \
+                (self.manifest is not None and self.manifest.previous):
+            # Keep the previous outputs around, to compare against or
+            # because an incremental build is reusing them.
+            self.fresh_output_dir = False
+        elif os.path.isdir(self.output_dir):
             # I *would* just shutil.rmtree the whole thing and recreate it,
             # but I want the output_dir to retain its same inode on the
             # filesystem to be compatible with some HTTP servers.
@@ -84,6 +356,98 @@ class Writer(object):
                 except OSError:
                     pass
         util.mkdir(self.output_dir)
+        util.mkdir(self.target_dir)
+
+    def __compares_outputs(self):
+        """Are outputs compared with the existing files in _site, which
+        has to be kept from the previous build for that?
+        """
+        return bool(self.config.site.write_if_changed or
+                    self.config.site.copy_mode == "auto")
+
+    def __delete_staging_dir(self):
+        if self.staging_dir is not None and os.path.isdir(self.staging_dir):
+            shutil.rmtree(self.staging_dir)
+
+    def __sync_output_dir(self):
+        """Move what changed from the staging directory into _site.
+
+        Each changed file is moved into place with an atomic rename,
+        identical files are left alone (keeping their mtime), and
+        outputs of the previous build that this build didn't produce
+        are removed. Files written straight into _site, like those of
+        controllers using util.fs_site_path_helper("_site", ...), are
+        left alone. The _site directory itself is never replaced, so it
+        keeps its inode.
+        """
+        if self.staging_dir is None:
+            return
+        stats = {"replaced": 0, "unchanged": 0, "removed": 0}
+        staged = set()
+        for root, dirs, files in os.walk(self.staging_dir):
+            rel_root = os.path.relpath(root, self.staging_dir)
+            target_root = os.path.normpath(
+                util.path_join(self.target_dir, rel_root))
+            if os.path.lexists(target_root) and \
+                    not os.path.isdir(target_root):
+                os.remove(target_root)
+            util.mkdir(target_root)
+            for fn in files:
+                rel_path = os.path.normpath(os.path.join(rel_root, fn))
+                staged.add(rel_path)
+                src = os.path.join(root, fn)
+                dst = os.path.join(target_root, fn)
+                if os.path.isdir(dst) and not os.path.islink(dst):
+                    shutil.rmtree(dst)
+                if util.same_contents(src, dst):
+                    stats["unchanged"] += 1
+                    continue
+                try:
+                    util.replace_file(src, dst)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    # Staging is on another filesystem, copy next to
+                    # the destination and rename from there:
+                    tmp = dst + ".bf-tmp"
+                    shutil.copy2(src, tmp)
+                    util.replace_file(tmp, dst)
+                stats["replaced"] += 1
+        # Everything staged is an output, even what wasn't recorded
+        # with add_output:
+        self.written.update(staged)
+        stats["removed"] = self.__prune_target_dir(self.__produced())
+        logger.info("Synced {0}: {replaced} replaced, {unchanged} unchanged, "
+                    "{removed} removed".format(self.target_dir, **stats))
+
+    def __prune_output_dir(self):
+        """Remove files that are no longer produced from an output_dir
+        that wasn't emptied at the start of the build.
+        """
+        if self.staging_dir is None and not self.fresh_output_dir and \
+                self.__compares_outputs():
+            self.__prune_target_dir(self.__produced())
+
+    def __prune_target_dir(self, produced):
+        """Remove the outputs of the previous build that this build
+        didn't produce from target_dir.
+
+        produced is the set of paths (relative to target_dir) this
+        build produced. Only the outputs the previous build recorded
+        are removed: files written some other way, e.g. by a controller
+        that doesn't call add_output, have no known owner and are left
+        alone. Returns the number of files removed.
+        """
+        removed = 0
+        for rel_path in sorted(self.previous_outputs - produced):
+            path = util.path_join(self.target_dir, rel_path)
+            if not os.path.isfile(path) and not os.path.islink(path):
+                continue
+            logger.debug("Removing file no longer produced: " + path)
+            os.remove(path)
+            util.remove_empty_dirs(os.path.dirname(path), self.target_dir)
+            removed += 1
+        return removed
 
     def __calculate_template_files(self):
         """Build a regex for template file paths"""
@@ -99,13 +463,27 @@ class Writer(object):
         Convert all templates to straight HTML.  Copy other
         non-template files directly.
         """
+        if self.jobs > 1:
+            # Templates are rendered in a process pool after the walk,
+            # by the location they render to:
+            template_jobs = collections.OrderedDict()
+        else:
+            template_jobs = None
+        # The build's own directories are never walked, whatever the
+        # ignore patterns are:
+        build_dirs = set(os.path.abspath(d) for d in (
+                self.config.site.cache_dir, self.output_dir,
+                self.target_dir) if d)
         for root, dirs, files in os.walk("."):
             if root.startswith("./"):
                 root = root[2:]
             for d in list(dirs):
                 # Exclude some dirs
                 d_path = util.path_join(root, d)
-                if util.should_ignore_path(d_path):
+                if os.path.abspath(d_path) in build_dirs:
+                    logger.debug("Ignoring build directory: " + d_path)
+                    dirs.remove(d)
+                elif util.should_ignore_path(d_path):
                     logger.debug("Ignoring directory: " + d_path)
                     dirs.remove(d)
             try:
@@ -118,30 +496,140 @@ class Writer(object):
                     # Ignore this file.
                     logger.debug("Ignoring file: " + t_fn_path)
                     continue
-                elif self.template_file_regex.search(t_fn):
-                    logger.info("Processing template: " + t_fn_path)
-                    # Process this template file
-                    html_path = self.template_file_regex.sub("", t_fn)
-                    template.materialize_template(
-                        t_fn_path,
-                        util.path_join(root, html_path))
-                else:
-                    # Copy this non-template file
-                    f_path = util.path_join(root, t_fn)
-                    logger.debug("Copying file: " + f_path)
-                    out_path = util.path_join(self.output_dir, f_path)
-                    if self.config.site.overwrite_warning and \
-                            os.path.exists(out_path):
-                        logger.warn("Location is used more than once: {0}"\
-                                        .format(f_path))
-                    if self.config.site.use_hard_links:
-                        # Try hardlinking first, and if that fails copy
-                        try:
-                            os.link(f_path, out_path)
-                        except Exception:
-                            shutil.copyfile(f_path, out_path)
+                is_template = self.template_file_regex.search(t_fn)
+                # Templates are always rendered again: their output also
+                # depends on what the controllers put in bf.
+                if not is_template and self.manifest is not None and \
+                        self.manifest.is_unchanged(t_fn_path, self.target_dir):
+                    logger.debug("Unchanged since last build: " + t_fn_path)
+                    self.manifest.keep(t_fn_path)
+                elif template_jobs is not None and is_template:
+                    location = self.__template_location(root, t_fn)
+                    self.__render_queued(template_jobs, location)
+                    if os.path.normpath(location) in self.written:
+                        # It overwrites an earlier output, render it
+                        # now to keep the walk order:
+                        self.__render_template(t_fn_path, location)
                     else:
-                        shutil.copyfile(f_path, out_path)
+                        template_jobs[os.path.normpath(location)] = \
+                            (t_fn_path, location)
+                else:
+                    if template_jobs is not None:
+                        self.__render_queued(template_jobs, t_fn_path)
+                    self.__begin_source(t_fn_path)
+                    try:
+                        self.__write_file(root, t_fn)
+                    finally:
+                        self.__end_source()
+        # Don't fork the template workers while files are being copied,
+        # or with the copy threads alive:
+        self.copier.wait()
+        self.copier.shutdown()
+        self.__report_copies()
+        if template_jobs:
+            self.__render_templates(list(template_jobs.values()))
+
+    def __report_copies(self):
+        logger.info("Static files: {copied} copied, {linked} linked, "
+                    "{reflinked} reflinked, {skipped} unchanged"
+                    .format(**self.copier.stats))
+
+    def __begin_source(self, path):
+        if self.manifest is not None:
+            self.manifest.begin(path)
+
+    def __end_source(self):
+        if self.manifest is not None:
+            self.manifest.end()
+
+    def __template_location(self, root, t_fn):
+        """The location in _site a template file renders to.
+        """
+        return util.path_join(root, self.template_file_regex.sub("", t_fn))
+
+    def __render_template(self, t_fn_path, location):
+        """Render a template found by the walk, in this process.
+        """
+        self.__wait_for_copies(location)
+        self.__begin_source(t_fn_path)
+        try:
+            logger.info("Processing template: " + t_fn_path)
+            template.materialize_template(t_fn_path, location)
+        finally:
+            self.__end_source()
+
+    def __wait_for_copies(self, location):
+        """Wait for the pending copies if one of them may write location,
+        so that the template rendered there overwrites it, not the
+        other way around.
+        """
+        if os.path.normpath(location) in self.written:
+            self.copier.wait()
+
+    def __render_queued(self, template_jobs, path):
+        """Render the queued template that writes path right away, if
+        there is one, so that what writes path next overwrites it just
+        like in a serial build.
+        """
+        job = template_jobs.pop(os.path.normpath(path), None)
+        if job is not None:
+            self.__render_template(*job)
+
+    def __render_templates(self, template_jobs):
+        """Render the templates found by the walk in a process pool.
+
+        Workers are forked from this process after the controllers
+        have run, so they see exactly the same state a serial build
+        would. Each worker reports back the outputs it wrote. No two of
+        the templates write the same location, nor one that anything
+        else in the build writes: the walk renders those itself.
+        """
+        pool = util.process_pool(self.jobs)
+        if pool is None:
+            logger.warn("Cannot start worker processes on this platform, "
+                        "rendering templates serially")
+            for t_fn_path, location in template_jobs:
+                self.__render_template(t_fn_path, location)
+            return
+        logger.info("Rendering {0} templates with {1} processes".format(
+                len(template_jobs), self.jobs))
+        try:
+            for t_fn_path, outputs, stats, error in pool.imap(
+                    _render_template, template_jobs, chunksize=8):
+                if error is not None:
+                    raise TemplateRenderError(
+                        "Error rendering template {0}:\n{1}"
+                        .format(t_fn_path, error))
+                self.__begin_source(t_fn_path)
+                try:
+                    self.merge_outputs(outputs, stats)
+                finally:
+                    self.__end_source()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __write_file(self, root, t_fn):
+        """Write a single file from the source dir to _site.
+        """
+        t_fn_path = util.path_join(root, t_fn)
+        if self.template_file_regex.search(t_fn):
+            logger.info("Processing template: " + t_fn_path)
+            # Process this template file
+            location = self.__template_location(root, t_fn)
+            self.__wait_for_copies(location)
+            template.materialize_template(t_fn_path, location)
+        else:
+            # Copy this non-template file
+            f_path = util.path_join(root, t_fn)
+            logger.debug("Copying file: " + f_path)
+            out_path = util.path_join(self.output_dir, f_path)
+            if self.config.site.overwrite_warning and \
+                    self.already_written(f_path):
+                logger.warn("Location is used more than once: {0}"\
+                                .format(f_path))
+            self.add_output(f_path)
+            self.copier.copy(f_path, out_path)
 
     def __init_plugins(self):
         # Run plugin defined init methods
@@ -159,4 +647,19 @@ class Writer(object):
         for plugin in list(self.bf.config.plugins.values()):
             if plugin.enabled:
                 namespaces.append(plugin)
-        controller.run_all(namespaces)
+        try:
+            controller.run_all(namespaces)
+        finally:
+            self.__end_controllers()
+
+
+def _render_template(job):
+    """Render a single template in a worker process.
+
+    Returns (template path, outputs written, write stats,
+    formatted traceback or None)
+    """
+    t_fn_path, location = job
+    logger.info("Processing template: " + t_fn_path)
+    return (t_fn_path,) + cache.bf.writer.capture_outputs(
+        template.materialize_template, t_fn_path, location)
@@ -60,7 +60,8 @@ setup(
     license="MIT",
     classifiers=classifiers,
     packages=["blogofile", "blogofile.site_init"],
-    package_data={"blogofile.site_init": ["*.zip"]},
+    package_data={"blogofile": ["_filters/*.py"],
+                  "blogofile.site_init": ["*.zip"]},
     install_requires=install_requires,
     dependency_links=dependency_links,
     entry_points={